@@ -29,6 +29,7 @@ import gnome15.g15globals as g15globals
 import gnome15.util.g15convert as g15convert
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15scheduler as g15scheduler
 import gnome15.g15exceptions as g15exceptions
 import sys
 import os
@@ -299,6 +300,10 @@ class Driver(g15driver.AbstractDriver):
             logger.error("Failed to connect.", exc_info = e)
             raise g15exceptions.NotConnectedException()
         
+        # Frames are written and keys read on other threads, so errors arrive later
+        self.lg19.on_frame_error = self._on_frame_error
+        self.lg19.on_read_error = self._on_read_error
+        
         # Start listening for keys
         self.lg19.add_input_processor(self)  
 
@@ -314,6 +319,14 @@ class Driver(g15driver.AbstractDriver):
         else:
             raise Exception("Not connected")
           
+    def _on_frame_error(self, exception):
+        logger.debug("Failed to send buffer.", exc_info = exception)
+        g15scheduler.execute("G19", "FrameError", self._on_receive_error, exception)
+          
+    def _on_read_error(self, exception):
+        logger.debug("Failed to read keys.", exc_info = exception)
+        g15scheduler.execute("G19", "ReadError", self._on_receive_error, exception)
+          
     def _on_receive_error(self, exception):
         if self.is_connected():
             self.disconnect()
@@ -17,18 +17,16 @@
 import gnome15.g15locale as g15locale
 _ = g15locale.get_translation("gnome15-drivers").ugettext
 
-from threading import Thread
 from pyinputevent.pyinputevent import SimpleDevice
 
-import select 
 import pyinputevent.scancodes as S
 import gnome15.g15driver as g15driver
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.g15globals as g15globals
 import gnome15.g15uinput as g15uinput
+import gnome15.g15evdev as g15evdev
 import gconf
-import fcntl
 import os
 import gtk
 import cairo
@@ -59,8 +57,6 @@ g930_key_map = {
                S.KEY_VOLUMEUP  : g15driver.G_KEY_VOL_UP
                }
 
-# Other constants
-EVIOCGRAB = 0x40044590
 
 def show_preferences(device, parent, gconf_client):
     prefs = G930DriverPreferences(device, parent, gconf_client)
@@ -83,51 +79,6 @@ class G930DriverPreferences():
         self.window.run()
         self.window.hide()
         
-class KeyboardReceiveThread(Thread):
-    def __init__(self, device):
-        Thread.__init__(self)
-        self._run = True
-        self.name = "KeyboardReceiveThread-%s" % device.uid
-        self.setDaemon(True)
-        self.devices = []
-        
-    def deactivate(self):
-        self._run = False
-        for dev in self.devices:
-            logger.info("Ungrabbing %d", dev.fileno())
-            try :
-                fcntl.ioctl(dev.fileno(), EVIOCGRAB, 0)
-            except Exception as e:
-                logger.info("Failed ungrab.", exc_info = e)
-            logger.info("Closing %d", dev.fileno())
-            try :
-                self.fds[dev.fileno()].close()
-            except Exception as e:
-                logger.info("Failed close.", exc_info = e)
-            logger.info("Stopped %d", dev.fileno())
-        logger.info("Stopped all input devices")
-        
-    def run(self):        
-        self.poll = select.poll()
-        self.fds = {}
-        for dev in self.devices:
-            self.poll.register(dev, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLNVAL | select.POLLERR)
-            fcntl.ioctl(dev.fileno(), EVIOCGRAB, 1)
-            self.fds[dev.fileno()] = dev
-        while self._run:
-            for x, e in self.poll.poll(1000):
-                dev = self.fds[x]
-                try :
-                    if dev:
-                        dev.read()
-                except OSError as e:
-                    logger.debug('Could not read device file.', exc_info = e)
-                    # Ignore this error if deactivated
-                    if self._run:
-                        raise e
-        logger.info("Thread left")
-        
-            
 '''
 Abstract input device
 '''
@@ -136,11 +87,12 @@ class AbstractInputDevice(SimpleDevice):
         SimpleDevice.__init__(self, *args, **kwargs)
         self.callback = callback
         self.key_map = key_map
+        self.key_events = dict([ ( code, [ key ] ) for code, key in key_map.items() ])
 
     def _event(self, event_code, state):
-        if event_code in self.key_map:
-            key = self.key_map[event_code]
-            self.callback([key], state)
+        keys = self.key_events.get(event_code)
+        if keys is not None:
+            self.callback(list(keys), state)
         else:
             logger.warning("Unmapped key for event: %s", event_code)
         
@@ -178,7 +130,7 @@ class Driver(g15driver.AbstractDriver):
         g15driver.AbstractDriver.__init__(self, "g510")
         self.notify_handles = []
         self.on_close = on_close
-        self.key_thread = None
+        self.input_devices = None
         self.device = device
         self.connected = False
         self.conf_client = gconf.client_get_default()
@@ -234,15 +186,17 @@ class Driver(g15driver.AbstractDriver):
         pass
     
     def grab_keyboard(self, callback):
-        if self.key_thread != None:
+        if self.input_devices is not None:
             raise Exception("Keyboard already grabbed")
         
-        self.key_thread = KeyboardReceiveThread(self.device)
+        factories = []
         for devpath in self.mm_devices:
             logger.info("Adding input multi-media device %s", devpath)
-            self.key_thread.devices.append(MultiMediaDevice(self.grab_multimedia, callback, devpath, devpath))
+            factories.append(lambda devpath = devpath: MultiMediaDevice(self.grab_multimedia, callback, devpath, devpath))
             
-        self.key_thread.start()
+        devices = g15evdev.G15InputDeviceGroup(factories)
+        devices.open()
+        self.input_devices = devices
         
     '''
     Private
@@ -268,9 +222,10 @@ class Driver(g15driver.AbstractDriver):
             self.disconnect()
             
     def _stop_receiving_keys(self):
-        if self.key_thread != None:
-            self.key_thread.deactivate()
-            self.key_thread = None
+        if self.input_devices is not None:
+            self.input_devices.close()
+            self.input_devices = None
+            logger.info("Stopped all input devices")
             
     def _init_device(self):
         self._load_configuration()
@@ -21,17 +21,15 @@ from cStringIO import StringIO
 from pyinputevent.uinput import UInputDevice
 from pyinputevent.pyinputevent import InputEvent, SimpleDevice
 from pyinputevent.keytrans import *
-from threading import Thread
 
-import select 
 import pyinputevent.scancodes as S
 import gnome15.g15driver as g15driver
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.g15globals as g15globals
 import gnome15.g15uinput as g15uinput
+import gnome15.g15evdev as g15evdev
 import gconf
-import fcntl
 import os
 import gtk
 import cairo
@@ -510,8 +508,6 @@ device_info = {
        }
         
 
-# Other constants
-EVIOCGRAB = 0x40044590
 
 def show_preferences(device, parent, gconf_client):
     prefs = KernelDriverPreferences(device, parent, gconf_client)
@@ -572,50 +568,6 @@ class KernelDriverPreferences():
     def _do_calibrate(self, widget):
         g15uinput.calibrate(self._get_device_type())
     
-class KeyboardReceiveThread(Thread):
-    def __init__(self, device):
-        Thread.__init__(self)
-        self._run = True
-        self.name = "KeyboardReceiveThread-%s" % device.uid
-        self.setDaemon(True)
-        self.devices = []
-        
-    def deactivate(self):
-        self._run = False
-        for dev in self.devices:
-            logger.info("Ungrabbing %d", dev.fileno())
-            try :
-                fcntl.ioctl(dev.fileno(), EVIOCGRAB, 0)
-            except Exception as e:
-                logger.info("Failed ungrab.", exc_info = e)
-            logger.info("Closing %d", dev.fileno())
-            try :
-                self.fds[dev.fileno()].close()
-            except Exception as e:
-                logger.info("Failed close.", exc_info = e)
-            logger.info("Stopped %d", dev.fileno())
-        logger.info("Stopped all input devices")
-        
-    def run(self):        
-        self.poll = select.poll()
-        self.fds = {}
-        for dev in self.devices:
-            self.poll.register(dev, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLNVAL | select.POLLERR)
-            fcntl.ioctl(dev.fileno(), EVIOCGRAB, 1)
-            self.fds[dev.fileno()] = dev
-        while self._run:
-            for x, e in self.poll.poll(1000):
-                dev = self.fds[x]
-                try :
-                    if dev:
-                        dev.read()
-                except OSError as e:
-                    logger.debug('Could not read device file', exc_info = e)
-                    # Ignore this error if deactivated
-                    if self._run:
-                        raise e
-        logger.info("Thread left")
-        
 '''
 SimpleDevice implementation that does nothing with events. This is used to
 work-around a problem where X ends up getting the G19 F-key events
@@ -635,11 +587,12 @@ class AbstractInputDevice(SimpleDevice):
         SimpleDevice.__init__(self, *args, **kwargs)
         self.callback = callback
         self.key_map = key_map
+        self.key_events = dict([ ( code, [ key ] ) for code, key in key_map.items() ])
 
     def _event(self, event_code, state):
-        if event_code in self.key_map:
-            key = self.key_map[event_code]
-            self.callback([key], state)
+        keys = self.key_events.get(event_code)
+        if keys is not None:
+            self.callback(list(keys), state)
         else:
             logger.warning("Unmapped key for event: %s", event_code)
         
@@ -924,7 +877,7 @@ class Driver(g15driver.AbstractDriver):
         self.fb = None
         self.var_info = None
         self.on_close = on_close
-        self.key_thread = None
+        self.input_devices = None
         self.device = device
         self.device_info = None
         self.system_service = None
@@ -1135,7 +1088,7 @@ class Driver(g15driver.AbstractDriver):
                                "directory and the keyboard model you use.")
     
     def grab_keyboard(self, callback):
-        if self.key_thread != None:
+        if self.input_devices is not None:
             raise Exception("Keyboard already grabbed")
         
         # Configure the keymap
@@ -1151,17 +1104,27 @@ class Driver(g15driver.AbstractDriver):
         kernel_keymap_replacement = K_KEYMAPS[self.device.model_id]
         self.system_service.SetKeymap(self.device.uid, kernel_keymap_replacement)
               
-        self.key_thread = KeyboardReceiveThread(self.device)
+        # The devices are opened by the group, and again if they go away
+        factories = []
+        key_map = self.device_info.key_map
         for devpath in self.keyboard_devices:
             logger.info("Adding input device %s", devpath)
-            self.key_thread.devices.append(ForwardDevice(self, callback, self.device_info.key_map, devpath, devpath))
+            factories.append(lambda devpath = devpath: ForwardDevice(self, callback, key_map, devpath, devpath))
         for devpath in self.sink_devices:
             logger.info("Adding input sink device %s", devpath)
-            self.key_thread.devices.append(SinkDevice(devpath, devpath))
+            factories.append(lambda devpath = devpath: SinkDevice(devpath, devpath))
         for devpath in self.mm_devices:
             logger.info("Adding input multi-media device %s", devpath)
-            self.key_thread.devices.append(MultiMediaDevice(callback, self.device_info.key_map, devpath, devpath))
-        self.key_thread.start()
+            factories.append(lambda devpath = devpath: MultiMediaDevice(callback, key_map, devpath, devpath))
+        devices = g15evdev.G15InputDeviceGroup(factories)
+        try:
+            devices.open()
+        except:
+            self.system_service.SetKeymapSwitching(self.device.uid, self.keymap_switching)
+            self.system_service.SetKeymapIndex(self.device.uid, self.keymap_index)        
+            self.system_service.SetKeymap(self.device.uid, self.current_keymap)
+            raise
+        self.input_devices = devices
         
     '''
     Private
@@ -1242,15 +1205,16 @@ It should be launched automatically if Gnome15 is installed correctly.")
             "directory and the keyboard model you use.")
     
     def _stop_receiving_keys(self):
-        if self.key_thread != None:            
+        if self.input_devices is not None:            
             # Configure the keymap
             logger.info("Resetting keymap settings back to the way they were")
             self.system_service.SetKeymapSwitching(self.device.uid, self.keymap_switching)
             self.system_service.SetKeymapIndex(self.device.uid, self.keymap_index)        
             self.system_service.SetKeymap(self.device.uid, self.current_keymap)
             
-            self.key_thread.deactivate()
-            self.key_thread = None
+            self.input_devices.close()
+            self.input_devices = None
+            logger.info("Stopped all input devices")
             
     def _do_write_to_led(self, name, value):
         if not self.system_service:
@@ -28,12 +28,11 @@ import os.path
 import socket
 import cairo
 import gconf
-from PIL import ImageMath
 from PIL import Image
 from threading import Thread
 from threading import Lock
+from threading import Event
 import struct
-import time
 import logging
 import asyncore
 import sys
@@ -61,6 +60,14 @@ CLIENT_CMD_IS_FOREGROUND = ord('v')
 CLIENT_CMD_IS_USER_SELECTED = ord('u')
 CLIENT_CMD_KB_BACKLIGHT_COLOR = ord('r')
 
+# How long to wait for mx5500d to say hello (seconds)
+HANDSHAKE_TIMEOUT = 10.0
+
+# Lookup tables used to turn the dithered (0 or 255) greyscale image into one
+# byte per pixel, 1 for a lit pixel. Normally dark pixels are lit.
+MONO_LUT = [ 1 if i < 250 else 0 for i in range(256) ]
+MONO_LUT_INVERTED = [ 0 if i < 250 else 1 for i in range(256) ]
+
 KEY_MAP = {
         g15driver.G_KEY_G1  : 1<<0,
         g15driver.G_KEY_G2  : 1<<1,
@@ -121,14 +128,35 @@ class G15Dispatcher(asyncore.dispatcher):
         for k in KEY_MAP.keys():
             self.reverse_map[KEY_MAP[k]] = k
         self.received_handshake = False
+        self.handshake_event = Event()
+        self.frame = None
+        self.frame_lock = Lock()
         asyncore.dispatcher.__init__(self, sock=conn, map = map)
         
-    def wait_for_handshake(self):
-        while not self.received_handshake:
-            time.sleep(0.5)
+    def wait_for_handshake(self, timeout = HANDSHAKE_TIMEOUT):
+        self.handshake_event.wait(timeout)
+        if not self.received_handshake:
+            raise IOError("No handshake received from mx5500d")
+        
+    def set_frame(self, buf):
+        """
+        Set the next frame to send. Only the most recent frame is kept, so if
+        the daemon is slow to accept frames the stale ones are just dropped.
+        The frame is picked up by the asyncore thread once anything already
+        being written has gone.
+        
+        Keyword arguments:
+        buf        -- frame buffer, one byte per pixel
+        """
+        self.frame_lock.acquire()
+        try:
+            self.frame = buf
+        finally:
+            self.frame_lock.release()
         
     def handle_close(self):
-        self.received_handshake = True
+        self.handshake_event.set()
+        self.close()
         
     def handle_expt(self):
         data = self.socket.recv(1, socket.MSG_OOB)
@@ -199,6 +227,7 @@ class G15Dispatcher(asyncore.dispatcher):
                         raise Exception("Excepted G15 daemon handshake.")
                     self.out_buffer = "GBUF"
                     self.received_handshake = True
+                    self.handshake_event.set()
         except Exception as e:
             self.oob_buffer = ""
             self.out_buffer = ""
@@ -212,7 +241,7 @@ class G15Dispatcher(asyncore.dispatcher):
             return data
                 
     def writable(self):
-        return len(self.oob_buffer) > 0 or len(self.out_buffer) > 0
+        return len(self.oob_buffer) > 0 or len(self.out_buffer) > 0 or self.frame is not None
     
     def send_with_options(self, buffer, options = 0):
         try:
@@ -228,6 +257,13 @@ class G15Dispatcher(asyncore.dispatcher):
                 raise
 
     def handle_write(self):
+        if len(self.out_buffer) == 0 and self.frame is not None:
+            self.frame_lock.acquire()
+            try:
+                self.out_buffer = self.frame
+                self.frame = None
+            finally:
+                self.frame_lock.release()
         if len(self.out_buffer) > 0:
             sent = self.send(self.out_buffer)
             self.out_buffer = self.out_buffer[sent:]
@@ -340,36 +376,30 @@ class Driver(g15driver.AbstractDriver):
         try :           
             size = self.get_size()
             
-            # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
+            # PIL doesn't support 565, so paint anything other than a matching ARGB image into one first
+            if isinstance(img, cairo.ImageSurface) and img.get_format() == cairo.FORMAT_ARGB32 and \
+                    img.get_width() == size[0] and img.get_height() == size[1]:
+                argb_surface = img
+            else:
+                argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
+                argb_context = cairo.Context(argb_surface)
+                argb_context.set_source_surface(img)
+                argb_context.paint()
             
             # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
-            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
+            # colours dithered. The lookup table then gives one byte per pixel for the daemon
+            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", argb_surface.get_stride(), 1)
+            pil_img = pil_img.convert("1").convert("L")
             invert_control = self.get_control("invert_lcd")
-            if invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-    
-            # Covert image buffer to string
-            buf = ""
-            for x in list(pil_img.getdata()): 
-                buf += chr(x)
+            pil_img = pil_img.point(MONO_LUT if invert_control.value == 0 else MONO_LUT_INVERTED)
+            
+            # Pillow renamed tostring() to tobytes() (and later removed tostring())
+            buf = pil_img.tobytes() if hasattr(pil_img, "tobytes") else pil_img.tostring()
                 
             if len(buf) != self.device.lcd_size[0] * self.device.lcd_size[1]:
                 logger.warning("Invalid buffer size")
-            else:
-                try : 
-                    self.send(buf)
-                except IOError as e:
-                    logger.error("Failed to send buffer.", exc_info = e)
-                    self.disconnect()
+            elif self.dispatcher != None:
+                self.dispatcher.set_frame(buf)
         finally:
             self.lock.release()
             
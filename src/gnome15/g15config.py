@@ -47,6 +47,7 @@ import subprocess
 import shutil
 import zipfile
 import time
+import threading
 
 import logging
 logger = logging.getLogger(__name__)
@@ -80,7 +81,42 @@ IF_NAME="org.gnome15.Config"
 STOPPED = 0
 STARTING = 1
 STARTED = 2
-STOPPING = 3 
+STOPPING = 3
+
+# Number of profile rows added to the list in each idle callback
+PROFILE_ROWS_PER_BATCH = 50
+
+# Pixbufs loaded from files, keyed by path, size and modification time
+_pixbuf_cache = {}
+_pixbuf_cache_lock = threading.Lock()
+
+def get_pixbuf(path, width = -1, height = -1):
+    """
+    Get a pixbuf for an image file, scaled to the given size if one is
+    provided. Pixbufs are cached until the file is modified.
+    
+    Keyword arguments:
+    path        -- path of image file
+    width       -- width to load image at (or -1 for natural width)
+    height      -- height to load image at (or -1 for natural height)
+    """
+    key = ( path, width, height, os.path.getmtime(path) )
+    _pixbuf_cache_lock.acquire()
+    try:
+        pixbuf = _pixbuf_cache.get(key)
+    finally:
+        _pixbuf_cache_lock.release()
+    if pixbuf is None:
+        if width == -1 and height == -1:
+            pixbuf = gtk.gdk.pixbuf_new_from_file(path)
+        else:
+            pixbuf = gtk.gdk.pixbuf_new_from_file_at_size(path, width, height)
+        _pixbuf_cache_lock.acquire()
+        try:
+            _pixbuf_cache[key] = pixbuf
+        finally:
+            _pixbuf_cache_lock.release()
+    return pixbuf 
 
 class G15ConfigService(dbus.service.Object):
     """
@@ -230,6 +266,11 @@ class G15Config:
     adjusting = False
 
     def __init__(self, parent_window=None, service=None, options=None):
+        self._started_at = time.time()
+        self._interactive_at = None
+        self._profile_load_id = 0
+        self._profiles_loading = False
+        self.profiles = []
         self.parent_window = parent_window
         self._options = options
         self._controls_visible = False
@@ -529,6 +570,7 @@ class G15Config:
         else:            
             self.main_window.set_size_request(640, 600)
         self.id = None
+        gobject.idle_add(self._first_interactive)
         while True:
             opt = self.main_window.run()
             logger.debug("Option %s", str(opt))
@@ -541,6 +583,16 @@ class G15Config:
     '''
     Private
     '''
+    def _first_interactive(self):
+        self._interactive_at = time.time()
+        logger.debug("Configuration interactive after %.3f seconds", self._interactive_at - self._started_at)
+        self._check_fully_loaded()
+        
+    def _check_fully_loaded(self):
+        if self._interactive_at is not None and not self._profiles_loading:
+            logger.debug("Configuration fully loaded after %.3f seconds", time.time() - self._started_at)
+            self._started_at = None
+        
     def _devices_changed(self, device = None):
         self._load_devices()
         
@@ -897,8 +949,7 @@ class G15Config:
                 keys = gtk.HBox(spacing = 4)
                 for k in action_binding.keys:
                     fname = os.path.abspath("%s/key-%s.png" % (g15globals.image_dir, k))
-                    pixbuf = gtk.gdk.pixbuf_new_from_file(fname)
-                    pixbuf = pixbuf.scale_simple(22, 14, gtk.gdk.INTERP_BILINEAR)
+                    pixbuf = self._get_key_pixbuf(fname)
                     img = gtk.image_new_from_pixbuf(pixbuf)
                     img.show()
                     keys.add(img)
@@ -1576,8 +1627,8 @@ class G15Config:
                 icon_file = g15icontools.get_icon_path(["preferences-system-window", "preferences-system-windows", "gnome-window-manager", "window_fullscreen"])
             else:
                 icon_file = g15icontools.get_app_icon(self.conf_client,  device.model_id)
-            pixb = gtk.gdk.pixbuf_new_from_file(icon_file)
-            self.device_model.append([pixb.scale_simple(96, 96, gtk.gdk.INTERP_BILINEAR), device.model_fullname, 96, gtk.WRAP_WORD, pango.ALIGN_CENTER])
+            pixb = get_pixbuf(icon_file, 96, 96)
+            self.device_model.append([pixb, device.model_fullname, 96, gtk.WRAP_WORD, pango.ALIGN_CENTER])
             if previous_sel_device_name is not None and device.uid == previous_sel_device_name:
                 sel_device_name = device.uid
                 self.device_view.select_path((idx,))
@@ -1599,33 +1650,84 @@ class G15Config:
             self.no_device_selected.set_visible(True)
         
     def _load_profile_list(self):
+        """
+        Reload the list of profiles. The profile files are read on another
+        thread, then the rows are added in batches from idle callbacks, so
+        the window stays responsive however many profiles there are. Until
+        the new list arrives, the current list and selection remain.
+        """
+        self._profile_load_id += 1
+        if self.selected_device == None:
+            self.profiles_model.clear()
+            self.profiles = []
+            return
+        load_id = self._profile_load_id
+        device = self.selected_device
+        self._profiles_loading = True
+        def load():
+            try:
+                profiles = g15profile.get_profiles(device)
+            except Exception as e:
+                logger.error("Failed to load profiles.", exc_info = e)
+                profiles = []
+            gobject.idle_add(self._profiles_loaded, load_id, device, profiles)
+        thread = threading.Thread(target = load, name = "LoadProfiles")
+        thread.setDaemon(True)
+        thread.start()
+        
+    def _profiles_loaded(self, load_id, device, profiles):
+        if load_id != self._profile_load_id or device != self.selected_device:
+            # Superseded by a later load
+            return
+        
         current_selection = self.selected_profile
+        active = g15profile.get_active_profile(device)
+        active_id = active.id if active != None else ""
+        default_profile = g15profile.get_default_profile(device)
+        locked = g15profile.is_locked(device)
+        lock_icon = get_pixbuf(os.path.join(g15globals.image_dir, "locked.png")) if locked else None
+        
         self.profiles_model.clear()
-        if self.selected_device != None:
-            tree_selection = self.profiles_tree.get_selection()
-            active = g15profile.get_active_profile(self.selected_device)
-            active_id = ""
-            if active != None:
-                active_id = active.id
-            self.selected_profile = None
-            default_profile = g15profile.get_default_profile(self.selected_device)
-            self.profiles = g15profile.get_profiles(self.selected_device)
-            locked = g15profile.is_locked(self.selected_device)
-            for profile in self.profiles: 
-                weight = 400
-                selected = profile.id == active_id
-                if selected:
-                    weight = 700
-                lock_icon = gtk.gdk.pixbuf_new_from_file(os.path.join(g15globals.image_dir, "locked.png")) if locked and selected else None 
-                self.profiles_model.append([profile.name, weight, profile.id, profile == default_profile, not profile.read_only, lock_icon ])
-                if current_selection != None and profile.id == current_selection.id:
-                    tree_selection.select_path(self.profiles_model.get_path(self.profiles_model.get_iter(len(self.profiles_model) - 1)))
-                    self.selected_profile = profile         
-            if self.selected_profile == None:                
-                tree_selection.select_path(self.profiles_model.get_path(self.profiles_model.get_iter(0)))
-                self.selected_profile = self.profiles[0]
-            if self.selected_profile != None:                             
-                self._load_profile(self.selected_profile)
+        self.profiles = profiles
+        self.selected_profile = None
+        if current_selection != None:
+            for profile in profiles:
+                if profile.id == current_selection.id:
+                    self.selected_profile = profile
+                    break
+        if self.selected_profile == None and len(profiles) > 0:
+            self.selected_profile = profiles[0]
+        
+        rows = []
+        for profile in profiles:
+            selected = profile.id == active_id
+            rows.append([profile.name, 700 if selected else 400, profile.id, profile == default_profile, \
+                         not profile.read_only, lock_icon if selected else None ])
+        
+        # The first batch is added straight away, along with the selected 
+        # profile's details. The rest follow when the main loop is idle
+        self._add_profile_rows(load_id, rows, 0)
+        if self.selected_profile != None:
+            self._load_profile(self.selected_profile)
+        if len(rows) > PROFILE_ROWS_PER_BATCH:
+            gobject.idle_add(self._add_profile_rows, load_id, rows, PROFILE_ROWS_PER_BATCH)
+        
+    def _add_profile_rows(self, load_id, rows, start):
+        if load_id != self._profile_load_id:
+            return False
+        tree_selection = self.profiles_tree.get_selection()
+        end = min(len(rows), start + PROFILE_ROWS_PER_BATCH)
+        for i in range(start, end):
+            self.profiles_model.append(rows[i])
+            if self.profiles[i] is self.selected_profile:
+                tree_selection.select_path((i,))
+        if end < len(rows):
+            gobject.idle_add(self._add_profile_rows, load_id, rows, end)
+        else:
+            self._profiles_loading = False
+            if self._started_at is not None:
+                self._check_fully_loaded()
+        return False
                 
     def _load_parent_profiles(self):
         self.parent_profile_model.clear()
@@ -1670,12 +1772,14 @@ class G15Config:
             name = profile.window_name
             if name == None:
                 name = ""            
-            self.macros_model.clear()
             selected_macro = None
             macros = self._get_sorted_list()
             
-            # Build the macro model and set the initial selection
-            for macro in macros:
+            # Update the macro model in place (only rows that have actually
+            # changed are touched) and set the initial selection
+            while len(self.macros_model) > len(macros):
+                self.macros_model.remove(self.macros_model.get_iter(len(self.macros_model) - 1))
+            for i, macro in enumerate(macros):
                 if macro.activate_on == g15driver.KEY_STATE_HELD:
                     on_name = _("Hold")
                 elif macro.activate_on == g15driver.KEY_STATE_DOWN:
@@ -1688,9 +1792,13 @@ class G15Config:
                                           not profile.read_only, 
                                           macro.activate_on, 
                                           on_name  ]
-                self.macros_model.append(row)
+                if i < len(self.macros_model):
+                    if list(self.macros_model[i]) != row:
+                        self.macros_model[i] = row
+                else:
+                    self.macros_model.append(row)
                 if current_selection != None and macro.key_list_key == current_selection.key_list_key:
-                    tree_selection.select_path(self.macros_model.get_path(self.macros_model.get_iter(len(self.macros_model) - 1)))
+                    tree_selection.select_path((i,))
                     selected_macro = macro        
             if selected_macro == None and len(macros) > 0:            
                 tree_selection.select_path(self.macros_model.get_path(self.macros_model.get_iter(0)))
@@ -1810,7 +1918,24 @@ class G15Config:
         if path == None or path == "" or not os.path.exists(path):
             widget.set_from_stock(gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG)
         else:
-            widget.set_from_pixbuf(gtk.gdk.pixbuf_new_from_file_at_size(path, 48, 48))
+            widget.set_from_pixbuf(get_pixbuf(path, 48, 48))
+            
+    def _get_key_pixbuf(self, path):
+        # Key images are scaled to exactly this size, ignoring aspect ratio
+        key = ( path, "key", os.path.getmtime(path) )
+        _pixbuf_cache_lock.acquire()
+        try:
+            pixbuf = _pixbuf_cache.get(key)
+        finally:
+            _pixbuf_cache_lock.release()
+        if pixbuf is None:
+            pixbuf = gtk.gdk.pixbuf_new_from_file(path).scale_simple(22, 14, gtk.gdk.INTERP_BILINEAR)
+            _pixbuf_cache_lock.acquire()
+            try:
+                _pixbuf_cache[key] = pixbuf
+            finally:
+                _pixbuf_cache_lock.release()
+        return pixbuf
             
     def _load_windows(self):
         self.window_model.clear()  
@@ -24,6 +24,11 @@ import util.g15icontools as g15icontools
 import g15driver
 import g15devices
 import gobject
+import cairo
+import mmap
+import os
+import tempfile
+from threading import RLock
 
 
 from cStringIO import StringIO
@@ -40,18 +45,112 @@ CONTROL_ACQUISITION_IF_NAME="org.gnome15.Control"
 SCREEN_IF_NAME="org.gnome15.Screen"
 DEVICE_IF_NAME="org.gnome15.Device"
 
+# Page methods that may be used in a Draw() command list
+DRAW_COMMANDS = [ "NewSurface", "Save", "Restore", "DrawSurface", "SetLineWidth", "Line", "Rectangle", 
+                 "Circle", "Arc", "Foreground", "SetFont", "Text", "Image", "ImageData", "Redraw" ]
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
     
+# How long (in seconds) signals are held so that redundant ones may be dropped
+SIGNAL_COALESCE_WINDOW = 0.05
+
+class G15DBUSSignalOutbox():
+    """
+    Signals are queued here rather than emitted straight away, and are all 
+    sent together shortly afterwards on the main loop. Event signals (keys,
+    page creation and deletion etc) are always sent, in the order they were
+    raised. State signals (the visible page, a page title, the memory bank and
+    so on) carry a key, and if a newer signal with the same key arrives while 
+    an older one is waiting, only the newest is sent. May be used from any 
+    thread.
+    """
+    
+    def __init__(self, window = SIGNAL_COALESCE_WINDOW):
+        self.window = window
+        self.emitted = 0
+        self.suppressed = 0
+        self._lock = RLock()
+        self._pending = []
+        self._state = {}
+        self._flush_scheduled = False
+        
+    def event(self, signal, *args):
+        """
+        Queue an event signal
+        
+        Keyword arguments:
+        signal        -- signal method
+        args          -- signal arguments
+        """
+        self._add(None, signal, args)
+        
+    def state(self, key, signal, *args):
+        """
+        Queue a state signal, replacing any signal with the same key that has not
+        been sent yet
+        
+        Keyword arguments:
+        key           -- key identifying the state
+        signal        -- signal method
+        args          -- signal arguments
+        """
+        self._add(key, signal, args)
+        
+    def flush(self):
+        """
+        Send all queued signals now. Must be called on the main loop
+        """
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            self._pending = []
+            self._state = {}
+            self._flush_scheduled = False
+        finally:
+            self._lock.release()
+        for entry in pending:
+            if entry[1] is None:
+                continue
+            try:
+                entry[1](*entry[2])
+                self.emitted += 1
+            except Exception as e:
+                logger.debug("Failed to emit signal %s", str(entry[1]), exc_info = e)
+        return False
+        
+    """
+    Private
+    """
+    def _add(self, key, signal, args):
+        entry = [ key, signal, args ]
+        self._lock.acquire()
+        try:
+            if key is not None:
+                previous = self._state.get(key)
+                if previous is not None:
+                    # Blank the old one rather than remove it, so there is no
+                    # need to search the list
+                    previous[1] = None
+                    self.suppressed += 1
+                self._state[key] = entry
+            self._pending.append(entry)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                gobject.timeout_add(int(self.window * 1000), self.flush)
+        finally:
+            self._lock.release()
+    
 class AbstractG15DBUSService(dbus.service.Object):
     
-    def __init__(self, conn=None, object_path=None, bus_name=None):
+    def __init__(self, conn=None, object_path=None, bus_name=None, outbox = None):
         dbus.service.Object.__init__(self, conn, object_path, bus_name)
         self._reserved_keys = []
+        self._outbox = outbox
         
     def action_performed(self, binding):
-        self.Action(binding.action)
+        self._outbox.event(self.Action, binding.action)
                     
     def handle_key(self, keys, state, post):
         if not post:
@@ -61,9 +160,9 @@ class AbstractG15DBUSService(dbus.service.Object):
                     p.append(k)
             if len(p) > 0:
                 if state == g15driver.KEY_STATE_UP:
-                    gobject.idle_add(self.KeysReleased,p)
+                    self._outbox.event(self.KeysReleased, p)
                 elif state == g15driver.KEY_STATE_DOWN:
-                    gobject.idle_add(self.KeysPressed, p)
+                    self._outbox.event(self.KeysPressed, p)
                 return True
             
     def _set_receive_actions(self, enabled):
@@ -79,7 +178,7 @@ class AbstractG15DBUSService(dbus.service.Object):
 class G15DBUSDeviceService(AbstractG15DBUSService):
     
     def __init__(self, dbus_service, device):
-        AbstractG15DBUSService.__init__(self, dbus_service._bus_name, "%s/%s" % ( DEVICE_NAME, device.uid ) )
+        AbstractG15DBUSService.__init__(self, dbus_service._bus_name, "%s/%s" % ( DEVICE_NAME, device.uid ), outbox = dbus_service._outbox )
         self._dbus_service = dbus_service
         self._service = dbus_service._service
         self._device = device  
@@ -153,7 +252,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
     
     def __init__(self, dbus_service, screen):
         self._bus_name = "%s/%s" % ( SCREEN_NAME, screen.device.uid )
-        AbstractG15DBUSService.__init__(self, dbus_service._bus_name, self._bus_name )
+        AbstractG15DBUSService.__init__(self, dbus_service._bus_name, self._bus_name, outbox = dbus_service._outbox )
         self._dbus_service = dbus_service
         self._service = dbus_service._service
         self._screen = screen
@@ -173,41 +272,41 @@ class G15DBUSScreenService(AbstractG15DBUSService):
         if g15scheduler.run_on_gobject(self.memory_bank_changed, new_memory_bank):
             return
         logger.debug("Sending memory bank changed signel (%d)", new_memory_bank)
-        self.MemoryBankChanged(new_memory_bank)
+        self._outbox.state((self, "MemoryBankChanged"), self.MemoryBankChanged, new_memory_bank)
         
     def attention_cleared(self):
         if g15scheduler.run_on_gobject(self.attention_cleared):
             return
         logger.debug("Sending attention cleared signal")
-        self.AttentionCleared()
+        self._outbox.state((self, "Attention"), self.AttentionCleared)
         logger.debug("Sent attention cleared signal")
             
     def attention_requested(self, message):
         if g15scheduler.run_on_gobject(self.attention_requested, message):
             return
         logger.debug("Sending attention requested signal")
-        self.AttentionRequested(message if message != None else "")
+        self._outbox.state((self, "Attention"), self.AttentionRequested, message if message != None else "")
         logger.debug("Sent attention requested signal")
             
     def driver_connected(self, driver):
         if g15scheduler.run_on_gobject(self.driver_connected, driver):
             return
         logger.debug("Sending driver connected signal")
-        self.Connected(driver.get_name())
+        self._outbox.event(self.Connected, driver.get_name())
         logger.debug("Sent driver connected signal")
             
     def driver_connection_failed(self, driver, exception):
         if g15scheduler.run_on_gobject(self.driver_connection_failed, driver, exception):
             return
         logger.debug("Sending driver connection failed signal")
-        self.ConnectionFailed(driver.get_name(), str(exception))
+        self._outbox.event(self.ConnectionFailed, driver.get_name(), str(exception))
         logger.debug("Sent driver connection failed signal")
             
     def driver_disconnected(self, driver):
         if g15scheduler.run_on_gobject(self.driver_disconnected, driver):
             return
         logger.debug("Sending driver disconnected signal")
-        self.Disconnected(driver.get_name())
+        self._outbox.event(self.Disconnected, driver.get_name())
         logger.debug("Sent driver disconnected signal")
         
     def page_changed(self, page):
@@ -216,7 +315,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
         logger.debug("Sending page changed signal for %s", page.id)
         if page.id in self._dbus_pages:
             dbus_page = self._dbus_pages[page.id]
-            self.PageChanged(dbus_page._bus_name)
+            self._outbox.state((self, "PageChanged"), self.PageChanged, dbus_page._bus_name)
             logger.debug("Sent page changed signal for %s", page.id)
         else:
             logger.warn("Got page_changed event when no such page (%s) exists", page.id)
@@ -229,7 +328,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
             raise Exception("Page %s already in DBUS service.", page.id)
         dbus_page = G15DBUSPageService(self, page, self._dbus_service._page_sequence_number)
         self._dbus_pages[page.id] = dbus_page
-        self.PageCreated(dbus_page._bus_name, page.title)
+        self._outbox.event(self.PageCreated, dbus_page._bus_name, page.title)
         self._dbus_service._page_sequence_number += 1
         logger.debug("Sent new page signal for %s" % page.id)
         
@@ -238,7 +337,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
             return
         logger.debug("Sending title changed signal for %s", page.id)
         dbus_page = self._dbus_pages[page.id]
-        self.PageTitleChanged(dbus_page._bus_name, title)
+        self._outbox.state((self, "PageTitleChanged", dbus_page._bus_name), self.PageTitleChanged, dbus_page._bus_name, title)
         logger.debug("Sent title changed signal for %s", page.id)
     
     def deleting_page(self, page):
@@ -255,7 +354,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
             dbus_page = self._dbus_pages[page.id]
             if dbus_page in page.key_handlers: 
                 page.key_handlers.remove(dbus_page)
-            self.PageDeleting(dbus_page._bus_name, )
+            self._outbox.event(self.PageDeleting, dbus_page._bus_name)
         else:
             logger.warning("DBUS Page %s is deleting, but it never existed. Huh? %s",
                            page.id,
@@ -268,7 +367,8 @@ class G15DBUSScreenService(AbstractG15DBUSService):
         logger.debug("Sending page deleted signal for %s", page.id)
         if page.id in self._dbus_pages:
             dbus_page = self._dbus_pages[page.id]
-            self.PageDeleted(dbus_page._bus_name)
+            self._outbox.event(self.PageDeleted, dbus_page._bus_name)
+            dbus_page._close_shared_frame()
             dbus_page.remove_from_connection()
             del self._dbus_pages[page.id]
         else:
@@ -499,7 +599,7 @@ class G15DBUSScreenService(AbstractG15DBUSService):
             self._service.conf_client.notify_remove(h)
         
     def _cycle_screens_option_changed(self, client, connection_id, entry, args):
-        self.CyclingChanged(entry.value.get_bool())
+        self._outbox.state((self, "CyclingChanged"), self.CyclingChanged, entry.value.get_bool())
     
     def _get_dimmable_controls(self):
         controls = []
@@ -529,7 +629,7 @@ class G15DBUSControlAcquisition(AbstractG15DBUSService):
     
     def __init__(self, screen_service, acquisition, sequence_number):
         self._bus_name = "%s%s" % ( CONTROL_ACQUISITION_NAME , str( sequence_number ) )        
-        AbstractG15DBUSService.__init__(self, screen_service._dbus_service._bus_name, self._bus_name )
+        AbstractG15DBUSService.__init__(self, screen_service._dbus_service._bus_name, self._bus_name, outbox = screen_service._outbox )
         self._screen_service = screen_service
         self._sequence_number = sequence_number
         self._acquisition = acquisition        
@@ -598,12 +698,15 @@ class G15DBUSPageService(AbstractG15DBUSService):
     
     def __init__(self, screen_service, page, sequence_number):
         self._bus_name = "%s%s" % ( PAGE_NAME , str( sequence_number ) )        
-        AbstractG15DBUSService.__init__(self, screen_service._dbus_service._bus_name, self._bus_name )        
+        AbstractG15DBUSService.__init__(self, screen_service._dbus_service._bus_name, self._bus_name, outbox = screen_service._outbox )        
         self._screen_service = screen_service
         self._screen = self._screen_service._screen
         self._sequence_number = sequence_number
         self._page = page
         self._timer = None        
+        self._shared_frame = None
+        self._shared_frame_map = None
+        self._shared_frame_path = None
         self._page.key_handlers.append(self)
             
     @dbus.service.method(PAGE_IF_NAME, in_signature='b')
@@ -718,6 +821,62 @@ class G15DBUSPageService(AbstractG15DBUSService):
         file_str.close()
         self._page.image(img_surface, x, y)
     
+    @dbus.service.method(PAGE_IF_NAME, in_signature='a(sav)')
+    def Draw(self, commands):
+        """
+        Run a list of drawing commands in a single call. Each command is the 
+        name of one of the drawing methods of this interface (e.g. Line,
+        Rectangle, Text, DrawSurface or Redraw) along with its arguments. This 
+        saves a round trip for every primitive when building a whole frame.
+        """
+        for name, args in commands:
+            if not name in DRAW_COMMANDS:
+                raise Exception("Unknown draw command %s" % name)
+            getattr(self, name)(*args)
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='', out_signature='snnn')
+    def OpenSharedFrame(self):
+        """
+        Create a shared memory frame buffer the size of the screen. The path,
+        width, height and stride are returned. Clients map the file, write
+        ARGB32 pixels to it, then call FrameReady() to have it displayed.
+        """
+        self._close_shared_frame()
+        width, height = self._screen.driver.get_size()
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix = "gnome15-page-", dir = shm_dir)
+        try:
+            os.ftruncate(fd, stride * height)
+            self._shared_frame_map = mmap.mmap(fd, stride * height)
+        finally:
+            os.close(fd)
+        self._shared_frame_path = path
+        self._shared_frame = cairo.ImageSurface.create_for_data(self._shared_frame_map, cairo.FORMAT_ARGB32, width, height, stride)
+        return path, width, height, stride
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='')
+    def FrameReady(self):
+        """
+        Display the current contents of the shared frame buffer. A copy is 
+        taken, so the client may start writing the next frame straight away
+        """
+        if self._shared_frame is None:
+            raise Exception("No shared frame open")
+        self._shared_frame.mark_dirty()
+        width, height = self._shared_frame.get_width(), self._shared_frame.get_height()
+        frame = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(frame)
+        ctx.set_source_surface(self._shared_frame)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.paint()
+        self._page.buffer = frame
+        self._screen.redraw(self._page)
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='')
+    def CloseSharedFrame(self):
+        self._close_shared_frame()
+    
     @dbus.service.method(PAGE_IF_NAME, in_signature='')
     def CancelTimer(self):
         self._timer.cancel()
@@ -776,11 +935,25 @@ class G15DBUSPageService(AbstractG15DBUSService):
     def action_performed(self, binding):
         if self.IsVisible():
             AbstractG15DBUSService.action_performed(self, binding)
+            
+    """
+    Private
+    """
+    def _close_shared_frame(self):
+        if self._shared_frame is not None:
+            self._shared_frame = None
+            self._shared_frame_map.close()
+            self._shared_frame_map = None
+            try:
+                os.remove(self._shared_frame_path)
+            except OSError as e:
+                logger.debug("Could not remove shared frame %s", self._shared_frame_path, exc_info = e)
+            self._shared_frame_path = None
 
 class G15DBUSService(AbstractG15DBUSService):
     
     def __init__(self, service):        
-        AbstractG15DBUSService.__init__(self)
+        AbstractG15DBUSService.__init__(self, outbox = G15DBUSSignalOutbox())
         self._service = service
         logger.debug("Getting Session DBUS")
         self._bus = dbus.SessionBus()
@@ -937,6 +1110,14 @@ class G15DBUSService(AbstractG15DBUSService):
     def GetServerInformation(self):
         return ( g15globals.name, "Gnome15 Project", g15globals.version, "2.1" )
     
+    @dbus.service.method(IF_NAME, in_signature='', out_signature='uu')
+    def GetSignalStatistics(self):
+        """
+        Get the number of signals emitted, and the number dropped because a
+        newer signal for the same state replaced them
+        """
+        return ( self._outbox.emitted, self._outbox.suppressed )
+    
     @dbus.service.method(IF_NAME, in_signature='', out_signature='')
     def Stop(self):
         g15scheduler.queue("serviceQueue", "dbusShutdown", 0, self._service.shutdown)
@@ -177,8 +177,12 @@ FX_QUEUE = "ControlEffects"
 import util.g15scheduler as g15scheduler
 import time
 import colorsys
+import ctypes
+import ctypes.util
 from threading import Lock
+from threading import RLock
 from threading import Event
+from threading import Thread
 import logging
 logger = logging.getLogger(__name__)
 
@@ -302,6 +306,343 @@ class Control():
         """
         self.value = zeroize(self.default_value)
         
+"""
+Control animations. Fades and blinks of all drivers are driven by a single
+ticker thread, rather than a scheduled job per step
+"""
+
+# How many times a second control animations are updated
+ANIMATION_RATE = 50.0
+
+# Number of points in each of the precomputed easing curves
+EASING_STEPS = 256
+
+def _create_easing_curve(function):
+    return [ function(float(i) / ( EASING_STEPS - 1 )) for i in range(EASING_STEPS) ]
+
+EASE_LINEAR = "linear"
+EASE_IN_OUT = "ease-in-out"
+EASE_OUT = "ease-out"
+EASING_CURVES = {
+    EASE_LINEAR : _create_easing_curve(lambda x: x),
+    EASE_IN_OUT : _create_easing_curve(lambda x: x * x * ( 3.0 - 2.0 * x )),
+    EASE_OUT : _create_easing_curve(lambda x: 1.0 - ( 1.0 - x ) ** 2)
+    }
+
+def ease(curve, progress):
+    """
+    Look up how far through an animation the value should be, given how far
+    through it the time is.
+    
+    Keyword arguments:
+    curve        --    name of easing curve (one of EASE_*)
+    progress     --    fraction of the animation's duration that has passed
+    """
+    return EASING_CURVES[curve][int(round(min(1.0, max(0.0, progress)) * ( EASING_STEPS - 1 )))]
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [ ( "tv_sec", ctypes.c_long ), ( "tv_nsec", ctypes.c_long ) ]
+    
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno = True).clock_gettime
+    _clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(_Timespec) ]
+except (OSError, AttributeError) as e:
+    logger.debug("No clock_gettime, animations will use the wall clock", exc_info = e)
+    _clock_gettime = None
+    
+def monotonic():
+    """
+    Get the time (in seconds) from a clock that never goes backwards, so
+    animations are not upset by the system time being changed. Falls back to
+    the wall clock if the monotonic clock is not available.
+    """
+    if _clock_gettime is not None:
+        t = _Timespec()
+        if _clock_gettime(1, ctypes.byref(t)) == 0:
+            return t.tv_sec + t.tv_nsec * 1e-9
+    return time.time()
+
+class ControlAnimation(object):
+    """
+    Something that changes the value of a control acquisition over time
+    """
+    
+    def __init__(self, acquisition):
+        self.acquisition = acquisition
+        self.started = monotonic()
+        self.finished = False
+        
+    def get_value(self, now):
+        """
+        Get the value the control should have at the given time (from
+        monotonic()), setting finished when the animation is over.
+        """
+        raise NotImplementedError("Not implemented")
+    
+    def get_next_change(self, now):
+        """
+        Get the time (from monotonic()) at which the value will next change.
+        By default the value may change on every tick.
+        """
+        return now
+    
+    def on_finished(self):
+        pass
+    
+class FadeAnimation(ControlAnimation):
+    """
+    Fades a control to a target value. Colours are faded by their brightness
+    (the V of HSV), keeping the hue and saturation.
+    """
+    
+    def __init__(self, acquisition, target_val, duration, release = False, step = 1, curve = EASE_LINEAR):
+        ControlAnimation.__init__(self, acquisition)
+        self.start_val = acquisition.val
+        self.target_val = target_val
+        self.duration = duration
+        self.release = release
+        self.step = max(1, step)
+        self.curve = curve
+        if isinstance(target_val, tuple):
+            self._hs = acquisition.rgb_to_hsv(self.start_val)[:2]
+            self._from = acquisition.rgb_to_hsv(self.start_val)[2]
+            self._to = acquisition.rgb_to_hsv(target_val)[2]
+        else:
+            self._from = self.start_val
+            self._to = target_val
+            
+    def get_value(self, now):
+        progress = ( now - self.started ) / self.duration if self.duration > 0 else 1.0
+        if progress >= 1.0:
+            self.finished = True
+            val = self.target_val
+        else:
+            # Quantise to the step size, so the device is only written when that much has changed
+            level = self._from + ( self._to - self._from ) * ease(self.curve, progress)
+            level = self._from + int(( level - self._from ) / self.step) * self.step
+            if isinstance(self.target_val, tuple):
+                val = self.acquisition.hsv_to_rgb(self._hs + ( level, ))
+            else:
+                val = level
+        
+        # The fade owns the value of the acquisition while it runs
+        self.acquisition.val = val
+        return val
+    
+    def on_finished(self):
+        if self.release and not self.acquisition._released:
+            self.acquisition.driver.release_control(self.acquisition)
+    
+class BlinkAnimation(ControlAnimation):
+    """
+    Switches a control between its acquired value and an off value
+    """
+    
+    def __init__(self, acquisition, off_val, delay = 0.5, duration = None):
+        ControlAnimation.__init__(self, acquisition)
+        self.off_val = off_val
+        self.delay = delay
+        self.duration = duration
+        self._phase = -1
+        self._phase_val = None
+        
+    def get_value(self, now):
+        elapsed = now - self.started
+        if self.duration is not None and elapsed >= self.duration:
+            self.finished = True
+            return self.acquisition.val
+        phase = int(elapsed / self.delay) if self.delay > 0 else 0
+        if phase != self._phase:
+            self._phase = phase
+            if phase % 2 == 1:
+                self._phase_val = self.acquisition.val
+            elif isinstance(self.off_val, int) or isinstance(self.off_val, tuple):
+                self._phase_val = self.off_val
+            else:
+                self._phase_val = self.off_val()
+        return self._phase_val
+    
+    def get_next_change(self, now):
+        if self.delay <= 0:
+            return now
+        next_change = self.started + ( self._phase + 1 ) * self.delay
+        if self.duration is not None:
+            next_change = min(next_change, self.started + self.duration)
+        return next_change
+        
+class G15ControlAnimator(Thread):
+    """
+    Runs all control animations from one thread, ticking at ANIMATION_RATE
+    against the monotonic clock. When several acquisitions of the same
+    control are animating, only the one with priority (the most recently
+    acquired, as with adjust()) is written to the device. The device is
+    only written to when the value actually changes. The thread sleeps while
+    there is nothing to animate, and until the next change when all running
+    animations change only occasionally (such as a blink).
+    """
+    
+    def __init__(self, rate = ANIMATION_RATE):
+        Thread.__init__(self)
+        self.name = "ControlAnimator"
+        self.setDaemon(True)
+        self.interval = 1.0 / rate
+        self.writes = 0
+        self._lock = RLock()
+        self._wake = Event()
+        self._animations = {}
+        
+    def animate(self, animation):
+        """
+        Start an animation, replacing any other animation of the same
+        acquisition.
+        
+        Keyword arguments:
+        animation        --    ControlAnimation to start
+        """
+        self._lock.acquire()
+        try:
+            self._animations[animation.acquisition] = animation
+        finally:
+            self._lock.release()
+        self._wake.set()
+        
+    def cancel(self, acquisition, animation_class = ControlAnimation):
+        """
+        Stop the animation of an acquisition (if it is of the given class)
+        
+        Keyword arguments:
+        acquisition        --    control acquisition
+        animation_class    --    only cancel animations of this class
+        """
+        self._lock.acquire()
+        try:
+            animation = self._animations.get(acquisition)
+            if isinstance(animation, animation_class):
+                del self._animations[acquisition]
+                return True
+            return False
+        finally:
+            self._lock.release()
+        
+    def get_animation(self, acquisition):
+        return self._animations.get(acquisition)
+    
+    def tick(self, now = None):
+        """
+        Move all animations on to the given time (from monotonic()) and write
+        any controls whose value has changed. Returns the earliest time at which
+        any running animation will change again, or None if none are running.
+        
+        Keyword arguments:
+        now        --    time, defaults to the current time
+        """
+        if now is None:
+            now = monotonic()
+        self._lock.acquire()
+        try:
+            animations = self._animations.values()
+        finally:
+            self._lock.release()
+            
+        values = {}
+        controls = {}
+        finished = []
+        next_change = None
+        for animation in animations:
+            acquisition = animation.acquisition
+            try:
+                values[acquisition] = animation.get_value(now)
+                if not animation.finished:
+                    change = animation.get_next_change(now)
+                    next_change = change if next_change is None else min(next_change, change)
+            except Exception as e:
+                logger.error("Control animation failed", exc_info = e)
+                animation.finished = True
+            controls[( id(acquisition.driver), acquisition.control.id )] = acquisition
+            if animation.finished:
+                finished.append(animation)
+                
+        self._lock.acquire()
+        try:
+            for animation in finished:
+                if self._animations.get(animation.acquisition) is animation:
+                    del self._animations[animation.acquisition]
+        finally:
+            self._lock.release()
+        
+        for acquisition in controls.values():
+            driver = acquisition.driver
+            control = acquisition.control
+            acquisitions = driver.acquired_controls.get(control.id)
+            if not acquisitions:
+                continue
+            top = acquisitions[-1]
+            val = values[top] if top in values else top.val
+            if val is not None and val != control.value:
+                control.value = val
+                try:
+                    driver.update_control(control)
+                    self.writes += 1
+                except Exception as e:
+                    logger.warning("Failed to update control %s", control.id, exc_info = e)
+                
+        for animation in finished:
+            try:
+                animation.on_finished()
+            except Exception as e:
+                logger.error("Error finishing control animation", exc_info = e)
+        return next_change
+    
+    def run(self):
+        next_tick = monotonic()
+        while True:
+            # Cleared before ticking, so an animation started from now on 
+            # wakes the thread from any sleep below
+            self._lock.acquire()
+            try:
+                self._wake.clear()
+                idle = len(self._animations) == 0
+            finally:
+                self._lock.release()
+            if idle:
+                self._wake.wait()
+                next_tick = monotonic()
+                continue
+            
+            next_change = self.tick()
+            
+            # Tick against the clock rather than sleeping a fixed time, so any
+            # time taken writing to the device does not slow animations down
+            next_tick += self.interval
+            now = monotonic()
+            if next_tick < now:
+                # Running late, skip the missed ticks
+                next_tick = now
+                
+            # Nothing changes before the next change of any animation
+            if next_change is not None and next_change > next_tick:
+                next_tick = next_change
+            delay = next_tick - now
+            if delay > 0 and self._wake.wait(delay):
+                next_tick = monotonic()
+                
+_animator = None
+_animator_lock = Lock()
+
+def get_animator():
+    """
+    Get the animator shared by all drivers, starting it if required
+    """
+    global _animator
+    _animator_lock.acquire()
+    try:
+        if _animator is None:
+            _animator = G15ControlAnimator()
+            _animator.start()
+        return _animator
+    finally:
+        _animator_lock.release()
+        
 class AbstractControlAcquisition(object):
     
     def __init__(self, driver):
@@ -309,7 +650,6 @@ class AbstractControlAcquisition(object):
         self.val = None
         self.on_released = None
         self.reset_timer = None
-        self.fade_timer = None
         self.on = False
         self._released = False
         self._waiting = False
@@ -322,11 +662,11 @@ class AbstractControlAcquisition(object):
         self._condition.wait()   
         self._waiting = False
         
-    def fade(self, percentage = 100.0, duration = 1.0, release = False, step = 1):
+    def fade(self, percentage = 100.0, duration = 1.0, release = False, step = 1, curve = EASE_LINEAR):
         target_val = self.get_target_value(self.val, percentage)
         if self.val != target_val:
-            self.fade_cancelled = False
-            self._reduce( ( duration / float( self.val - target_val ) ) * step, target_val, release, step)
+            self.cancel_reset()
+            get_animator().animate(FadeAnimation(self, target_val, duration, release, step, curve))
         elif release:
             self.driver.release_control(self)
         
@@ -335,18 +675,12 @@ class AbstractControlAcquisition(object):
         
         
     def blink(self, off_val = 0, delay = 0.5, duration = None, blink_started = None):
-        if blink_started == None:
-            blink_started = time.time()
         self.cancel_fade()
         self.cancel_reset()
-        if self.on:
-            self.adjust(self.val)
-        else:
-            self.adjust(off_val if isinstance(off_val, int) or isinstance(off_val, tuple) else off_val())
-        self.on = not self.on
-        if duration == None or time.time() < blink_started + duration:
-            self.reset_timer = g15scheduler.queue(FX_QUEUE, "Blink", delay, self.blink, off_val, delay, duration, blink_started)
-        return self.reset_timer
+        animation = BlinkAnimation(self, off_val, delay, duration)
+        if blink_started is not None:
+            animation.started -= time.time() - blink_started
+        get_animator().animate(animation)
     
     def is_active(self):
         raise Exception("Not implemented")
@@ -381,13 +715,13 @@ class AbstractControlAcquisition(object):
         if self.reset_timer:            
             self.reset_timer.cancel()
             self.reset_timer = None
+        get_animator().cancel(self, BlinkAnimation)
         
     def get_value(self):
         return self.val
     
     def cancel_fade(self):
-        if self.fade_timer is not None:
-            self.fade_cancelled = True
+        get_animator().cancel(self, FadeAnimation)
     
     def _cleanup(self):
         self.cancel_reset()
@@ -396,16 +730,6 @@ class AbstractControlAcquisition(object):
     """
     Private
     """
-    def _reduce(self, interval, target_val, release, step):
-        if not self.fade_cancelled:
-            if self.val > target_val:
-                self.set_value(self.val - step)
-            if self.val == target_val:
-                if release:
-                    self.driver.release_control(self)
-            else:                
-                self.fade_timer = g15scheduler.queue(FX_QUEUE, "Fade", interval, self._reduce, interval, target_val, release, step)
-                
     def _notify_released(self):
         if self._released:
             raise Exception("Already released")  
@@ -436,17 +760,16 @@ class ControlAcquisition(AbstractControlAcquisition):
             self.control.value = val
             self.driver.update_control(self.control)
         
-    def fade(self, percentage = 100.0, duration = 1.0, release = False, step = 1):
+    def fade(self, percentage = 100.0, duration = 1.0, release = False, step = 1, curve = EASE_LINEAR):
         if isinstance(self.val, int):
-            AbstractControlAcquisition.fade(self, percentage, duration, release)
+            AbstractControlAcquisition.fade(self, percentage, duration, release, step, curve)
         else:
-            self.fade_cancelled = False
             target_val = self.get_target_value(self.val, percentage)
             h, s, v = self.rgb_to_hsv(self.val)
             t_h, t_s, t_v = self.rgb_to_hsv(target_val)
-            diff = float( v - t_v )
-            if diff > 0:
-                self._reduce( ( duration / diff ) * step, target_val, release, step)
+            if v - t_v > 0:
+                self.cancel_reset()
+                get_animator().animate(FadeAnimation(self, target_val, duration, release, step, curve))
             elif release:
                 self.driver.release_control(self)
         
@@ -467,27 +790,6 @@ class ControlAcquisition(AbstractControlAcquisition):
         r, g, b = colorsys.hsv_to_rgb(float(h) / 255.0, float(s) / 255.0, float(v) / 255.0)
         return ( int(r * 255.0), int(g * 255.0), int(b * 255.0 ))
     
-    """
-    Private
-    """
-    def _reduce(self, interval, target_val, release, step):
-        if not self.fade_cancelled:
-            if isinstance(self.val, int):
-                AbstractControlAcquisition._reduce(self, interval, target_val, release, step)
-            else:
-                if self.val > target_val:
-                    h, s, v = self.rgb_to_hsv(self.val)
-                    v = max(0, v - step)
-                    new_rgb = self.hsv_to_rgb((h, s, v))
-                    if new_rgb == self.val:
-                        new_rgb = target_val
-                    self.set_value(new_rgb)
-                if self.val <= target_val:
-                    if release and not self._released:
-                        self.driver.release_control(self)
-                else:
-                    g15scheduler.queue(FX_QUEUE, "Fade", interval, self._reduce, interval, target_val, release, step)
-        
 class AbstractDriver(object):
     
     def __init__(self, id):
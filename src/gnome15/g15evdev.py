@@ -0,0 +1,311 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2011 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reads the kernel input (evdev) devices used by the drivers. A single reactor
+thread watches every device through epoll, for all drivers and all screens.
+Events are read in batches and handed to the receive() method of the device
+they came from. Devices may be added and removed at any time (for example when
+a keyboard is plugged in or pulled out) without restarting anything. Drivers
+open their devices as a G15InputDeviceGroup, which reopens any device that goes
+away once it is back.
+"""
+
+from threading import Thread
+from threading import RLock
+import gnome15.util.g15scheduler as g15scheduler
+import select
+import struct
+import fcntl
+import errno
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+EVIOCGRAB = 0x40044590
+
+# struct input_event - a timeval, then type, code and value
+EVENT_FORMAT = "llHHi"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# Maximum number of events read from a device in one go
+READ_EVENTS = 64
+
+# Time between attempts to reopen a device that has gone away, and the number
+# of attempts made before giving up on it
+REOPEN_INTERVAL = 2.0
+REOPEN_ATTEMPTS = 30
+
+class G15InputEvent(object):
+    """
+    A single event read from an input device
+    """
+    __slots__ = [ "timestamp", "etype", "ecode", "evalue" ]
+
+    def __init__(self, timestamp, etype, ecode, evalue):
+        self.timestamp = timestamp
+        self.etype = etype
+        self.ecode = ecode
+        self.evalue = evalue
+
+    def __str__(self):
+        return "%f type=%d code=%d value=%d" % ( self.timestamp, self.etype, self.ecode, self.evalue )
+
+def decode_events(data):
+    """
+    Decode a buffer of raw input_event structures into a list of events. Any
+    partial event at the end is ignored.
+
+    Keyword arguments:
+    data        -- buffer read from the device
+    """
+    events = []
+    unpack = struct.unpack_from
+    for offset in range(0, len(data) - EVENT_SIZE + 1, EVENT_SIZE):
+        sec, usec, etype, ecode, evalue = unpack(EVENT_FORMAT, data, offset)
+        events.append(G15InputEvent(sec + usec / 1000000.0, etype, ecode, evalue))
+    return events
+
+class G15InputReactor(Thread):
+    """
+    Thread that reads from all registered input devices. Devices must provide
+    fileno(), close() and receive(event) (as pyinputevent's SimpleDevice does),
+    and may provide on_removed(), which is called if the device goes away.
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.name = "InputReactor"
+        self.setDaemon(True)
+        self._lock = RLock()
+        self._devices = {}
+        self._epoll = select.epoll()
+        self._wake_read, self._wake_write = os.pipe()
+        self._epoll.register(self._wake_read, select.EPOLLIN)
+
+    def add(self, device, grab = True):
+        """
+        Start reading events from a device.
+
+        Keyword arguments:
+        device        -- device to add
+        grab          -- grab the device so no other client gets its events
+        """
+        fd = device.fileno()
+        self._lock.acquire()
+        try:
+            if grab:
+                fcntl.ioctl(fd, EVIOCGRAB, 1)
+            try:
+                self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP)
+            except:
+                if grab:
+                    fcntl.ioctl(fd, EVIOCGRAB, 0)
+                raise
+            self._devices[fd] = device
+        finally:
+            self._lock.release()
+        logger.info("Added input device %d", fd)
+
+    def remove(self, device):
+        """
+        Stop reading events from a device, ungrab and close it.
+
+        Keyword arguments:
+        device        -- device to remove
+        """
+        self._lock.acquire()
+        try:
+            fd = device.fileno()
+            if self._devices.pop(fd, None) is None:
+                return
+            try :
+                self._epoll.unregister(fd)
+            except (IOError, ValueError) as e:
+                logger.debug("Failed to unregister %d", fd, exc_info = e)
+            logger.info("Ungrabbing %d", fd)
+            try :
+                fcntl.ioctl(fd, EVIOCGRAB, 0)
+            except Exception as e:
+                logger.info("Failed ungrab.", exc_info = e)
+            logger.info("Closing %d", fd)
+            try :
+                device.close()
+            except Exception as e:
+                logger.info("Failed close.", exc_info = e)
+        finally:
+            self._lock.release()
+
+        # Make sure the reactor is not still waiting on the old descriptor
+        os.write(self._wake_write, "x")
+
+    def run(self):
+        buffer_size = EVENT_SIZE * READ_EVENTS
+        while True:
+            try:
+                ready = self._epoll.poll()
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in ready:
+                if fd == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                    continue
+                # Hold the lock while reading so the device can't be closed 
+                # (and its descriptor reused) underneath us 
+                self._lock.acquire()
+                try:
+                    device = self._devices.get(fd)
+                    if device is None:
+                        continue
+                    data = os.read(fd, buffer_size)
+                except OSError as e:
+                    if e.errno in ( errno.EAGAIN, errno.EINTR ):
+                        continue
+                    logger.debug("Could not read device file %d", fd, exc_info = e)
+                    self._device_gone(device)
+                    continue
+                finally:
+                    self._lock.release()
+                if not data:
+                    self._device_gone(device)
+                    continue
+                for event in decode_events(data):
+                    try :
+                        device.receive(event)
+                    except Exception as e:
+                        logger.error("Error handling input event %s", str(event), exc_info = e)
+
+    """
+    Private
+    """
+    def _device_gone(self, device):
+        logger.info("Input device %d has gone", device.fileno())
+        self.remove(device)
+        if hasattr(device, "on_removed"):
+            try :
+                device.on_removed()
+            except Exception as e:
+                logger.error("Error handling input device removal", exc_info = e)
+
+_reactor = None
+_reactor_lock = RLock()
+
+def get_reactor():
+    """
+    Get the reactor shared by all drivers, starting it if required
+    """
+    global _reactor
+    _reactor_lock.acquire()
+    try:
+        if _reactor is None:
+            _reactor = G15InputReactor()
+            _reactor.start()
+        return _reactor
+    finally:
+        _reactor_lock.release()
+
+class G15InputDeviceGroup():
+    """
+    The input devices of one driver, opened, grabbed and released together.
+    Devices are created by factory functions (that open the device file), so
+    a device that goes away (for example after a USB reset) can be reopened.
+    """
+
+    def __init__(self, factories):
+        """
+        Keyword arguments:
+        factories        -- list of functions, each returning a new device
+        """
+        self._factories = list(factories)
+        self._devices = {}
+        self._lock = RLock()
+        self._closed = False
+
+    def open(self):
+        """
+        Open all of the devices and start reading from them. If any device
+        fails, those already opened are released again and the error raised.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                for factory in self._factories:
+                    self._devices[factory] = self._open_device(factory)
+            except:
+                self.close()
+                raise
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Release all of the devices. Any devices waiting to be reopened are
+        forgotten.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            reactor = get_reactor()
+            for device in self._devices.values():
+                reactor.remove(device)
+            self._devices = {}
+        finally:
+            self._lock.release()
+
+    """
+    Private
+    """
+    def _open_device(self, factory):
+        device = factory()
+        device.on_removed = lambda: self._device_removed(factory, device)
+        try:
+            get_reactor().add(device)
+        except:
+            device.close()
+            raise
+        return device
+
+    def _device_removed(self, factory, device):
+        self._lock.acquire()
+        try:
+            if self._closed or self._devices.get(factory) is not device:
+                return
+            del self._devices[factory]
+        finally:
+            self._lock.release()
+        logger.info("Will try to reopen input device")
+        g15scheduler.schedule("ReopenInputDevice", REOPEN_INTERVAL, self._reopen_device, factory, REOPEN_ATTEMPTS)
+
+    def _reopen_device(self, factory, attempts):
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            try:
+                self._devices[factory] = self._open_device(factory)
+                logger.info("Reopened input device %d", self._devices[factory].fileno())
+                return
+            except Exception as e:
+                logger.debug("Could not reopen input device", exc_info = e)
+        finally:
+            self._lock.release()
+        if attempts > 1:
+            g15scheduler.schedule("ReopenInputDevice", REOPEN_INTERVAL, self._reopen_device, factory, attempts - 1)
+        else:
+            logger.warning("Gave up waiting for input device to return")
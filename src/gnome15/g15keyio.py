@@ -21,9 +21,9 @@ or XTEST as well as injecting such keys
 
 import gnome15.g15locale as g15locale
 import gnome15.g15uinput as g15uinput
+import gnome15.g15profile as g15profile
 _ = g15locale.get_translation("macro-recorder", modfile = __file__).ugettext
 
-import time
 import logging
 logger = logging.getLogger(__name__)
  
@@ -81,9 +81,9 @@ class G15KeyRecorder():
         self._record_key = None
         self._record_thread = None
         self._last_keys = None
-        self._key_down = None
+        self._recording = g15profile.G15RecordedScript()
         
-        self.script = []
+        self.script = self._recording.rows
         self.on_add = None
         self.on_stop = None
         self.single_key = False
@@ -91,7 +91,7 @@ class G15KeyRecorder():
         self.emit_uinput = False
         
     def clear(self):
-        del self.script[:]
+        self._recording.clear()
         
     def is_recording(self):
         return self._record_thread is not None
@@ -142,15 +142,7 @@ class G15KeyRecorder():
                     self._record_key_callback(event, s)
                     
     def _record_key_callback(self, event, keyname):
-        if self._key_down == None:
-            self._key_down = time.time()
-        else:
-            now = time.time()
-            delay = time.time() - self._key_down
-            if self.output_delays:
-                self.script.append(["Delay", str(int(delay * 1000))])
-            self._key_down = now
-
+        self._recording.output_delays = self.output_delays
         if self.emit_uinput:            
             pr = event.type == X.KeyPress and "UPress" or "URelease"
             keyname =  g15uinput.get_keysym_to_uinput_mapping(keyname)  + " " + g15uinput.KEYBOARD
@@ -167,20 +159,22 @@ class G15KeyRecorder():
         if keydown is None:
             if event.type == X.KeyPress:
                 self._key_state[keyname] = True
-                self._add(pr, keyname)
+                self._add(event, pr, keyname)
             else:
                 # Got a release without getting a press - ignore
                 pass
         else:
             if event.type == X.KeyRelease:
-                self._add(pr, keyname)
+                self._add(event, pr, keyname)
                 del self._key_state[keyname]
                 
                 if self.single_key:
                     self.stop_record()
                     
-    def _add(self, pr, keyname):
-        self.script.append([pr, keyname])
+    def _add(self, event, pr, keyname):
+        # The X server time of the event is used, as it is monotonic and is
+        # not affected by any delay in the event reaching us
+        self._recording.add(event.time, pr, keyname)
         if self.on_add:
             self.on_add(pr, keyname)
             
@@ -191,16 +185,15 @@ class G15KeyRecorder():
     def stop_record(self):        
         if self._record_thread != None:
             self._record_thread.disable_record_context()
-        self._key_down = None
         self._record_key = None
         self._record_thread = None
         if self.on_stop is not None:
             self.on_stop(self)
         
     def _start_recording(self):      
-        self.script = []
+        self._recording = g15profile.G15RecordedScript(self.output_delays)
+        self.script = self._recording.rows
         self._key_state = {}
-        self._key_down = None
         self._record_thread = RecordThread(self._record_callback)
         self._record_thread.start()
         
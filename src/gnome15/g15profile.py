@@ -131,6 +131,11 @@ Defaults
 """
 DEFAULT_REPEAT_DELAY = -1.0
 
+"""
+Recorded delays are rounded to this many milliseconds
+"""
+DELAY_QUANTUM = 10
+
 
 __profile_dirs = []
 
@@ -408,6 +413,103 @@ def clone_macro(macro):
     m.repeat_delay = macro.repeat_delay
     return m
         
+def compile_script(script):
+    """
+    Parse the text of a macro script once, so it can be played back (any
+    number of times) without parsing every line again. A tuple of the list 
+    of operations and a map of label names to operation index is returned. 
+    Each operation is a tuple of the lower case operation name, the list of
+    arguments and the original line. The argument of a 'delay' is converted
+    to seconds.
+    
+    Keyword arguments:
+    script        -- script text
+    """
+    ops = []
+    labels = {}
+    for line in script.split("\n"):
+        split = line.split(" ")
+        op = split[0].lower()
+        args = split[1:]
+        if op == "label" and len(args) > 0:
+            labels[args[0].lower()] = len(ops)
+        elif op == "delay" and len(args) > 0:
+            try:
+                args = [ float(args[0]) / 1000.0 ]
+            except ValueError:
+                op = "invalid"
+        ops.append(( op, args, line ))
+    return ( ops, labels )
+
+class G15RecordedScript(object):
+    """
+    Builds the rows of a macro script from recorded key events. Each event
+    carries a timestamp from a monotonic clock (such as the X server time), 
+    and the gaps between them become 'Delay' rows. Delays are rounded to 
+    DELAY_QUANTUM and measured from where the previous delay ended, so rounding
+    errors never add up over a long recording. Gaps shorter than the quantum
+    produce no row at all.
+    """
+    
+    def __init__(self, output_delays = True, quantum = DELAY_QUANTUM):
+        """
+        Constructor
+        
+        Keyword arguments:
+        output_delays    --    whether to add delay rows
+        quantum          --    delay resolution in milliseconds
+        """
+        self.rows = []
+        self.output_delays = output_delays
+        self.quantum = quantum
+        self._time = None
+        
+    def add(self, timestamp, op, value):
+        """
+        Add an event, returning the rows added (the delay before it if any, 
+        then the event itself)
+        
+        Keyword arguments:
+        timestamp        --    time of event in milliseconds
+        op               --    operation (e.g. Press or Release)
+        value            --    key name
+        """
+        added = []
+        if self._time is None:
+            self._time = timestamp
+        elif self.output_delays:
+            # X server time wraps every 49 days or so, so only a difference of
+            # more than half the range is a wrap. Rounding may leave the time
+            # slightly ahead of the event, in which case there is no delay yet
+            elapsed = ( timestamp - self._time ) & 0xffffffff
+            if elapsed >= 0x80000000:
+                elapsed -= 0x100000000
+            delay = int(round(float(max(elapsed, 0)) / self.quantum)) * self.quantum
+            if delay > 0:
+                self._time = ( self._time + delay ) & 0xffffffff
+                added.append([ "Delay", str(delay) ])
+        else:
+            self._time = timestamp
+        added.append([ op, value ])
+        self.rows += added
+        return added
+    
+    def clear(self):
+        """
+        Remove all rows and forget the time of the last event, so the next
+        event starts a new recording without a delay before it
+        """
+        del self.rows[:]
+        self._time = None
+    
+    def to_script(self):
+        """
+        Get the script text
+        """
+        return "\n".join([ "%s %s" % ( row[0], row[1] ) for row in self.rows ])
+    
+    def __len__(self):
+        return len(self.rows)
 
 class G15Macro(object):
     """
@@ -440,6 +542,7 @@ class G15Macro(object):
         self.repeat_mode = REPEAT_WHILE_HELD
         self.type = MACRO_SCRIPT
         self.repeat_delay = DEFAULT_REPEAT_DELAY 
+        self._compiled = None
         section_name = "m%d" % self.memory
         if not self.profile.parser.has_section(section_name):
             self.profile.parser.add_section(section_name)
@@ -453,6 +556,17 @@ class G15Macro(object):
         """
         return is_uinput_type(self.type)
             
+    def get_compiled_script(self):
+        """
+        Get the script of this macro parsed by compile_script(). The result
+        is kept until the script text changes.
+        """
+        compiled = self._compiled
+        if compiled is None or compiled[0] is not self.macro:
+            compiled = ( self.macro, compile_script(self.macro) )
+            self._compiled = compiled
+        return compiled[1]
+            
     def compare(self, o):
         """
         Compare this macro with another for sorting purposes. Macros will
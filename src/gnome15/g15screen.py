@@ -286,6 +286,7 @@ class G15Screen():
         self.memory_bank_color_control = None
         self.acquired_controls = {}
         self.painters = []
+        self.frame_listeners = []
         self.fader = None
         self.mkey = 1
         self.temp_acquired_controls = {}
@@ -1399,6 +1400,11 @@ class G15Screen():
             else:
                 self.driver.paint(surface)
                 
+            # Frame listeners get the final surface while the lock is still held,
+            # they should copy what they need and return quickly
+            for listener in self.frame_listeners:
+                listener(surface)
+                
             self.old_canvas = canvas
             self.old_surface = surface
         finally:
@@ -424,21 +424,12 @@ class MacroScriptExecution(object):
         self.macro = macro
         self.handler = handler
         self.l = -1
-        self.macros = self.macro.macro.split("\n")
+        self.macros, self.labels = self.macro.get_compiled_script()
         self.wait_for_state = -2
         self.wait_for_keys = []
         self.down = 0
         self.all_keys_up = False
         self.cancelled = False
-        
-        # First parse to get where the labels are
-        self.labels = {}
-        for l in range(0, len(self.macros)):
-            macro_text = self.macros[l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if op == "label" and len(op) > 1:
-                self.labels[split[1].lower()] = l
                 
     def handle_key(self, keys, state_id, post):
         
@@ -461,6 +452,17 @@ class MacroScriptExecution(object):
             return True
                 
     def execute(self):
+        """
+        Run the script until it ends, or until it must wait for the state of
+        the macro keys to change (in which case True is returned, and this
+        should be called again once they have). 
+        
+        Delays are measured against a timeline that starts when execution
+        (re)starts, rather than just sleeping for each one in turn. This means
+        the time spent sending keys does not push every later event back.
+        """
+        profile = self.macro.profile
+        timeline = time.time()
         while True:
             if self.down == 0 and ( self.handler.cancelled or self.cancelled ):
                 logger.warning("Macro cancelled")
@@ -468,11 +470,9 @@ class MacroScriptExecution(object):
             self.l += 1
             if self.l == len(self.macros):
                 break
-            macro_text = self.macros[self.l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if len(split) > 1:
-                val = split[1]
+            op, args, macro_text = self.macros[self.l]
+            if len(args) > 0:
+                val = args[0]
                 if op == "goto":
                     val = val.lower()
                     if val in self.labels:
@@ -480,8 +480,10 @@ class MacroScriptExecution(object):
                     else:
                         logger.warning("Unknown goto label %s in macro script. Ignoring", val)
                 elif op == "delay":
-                    if not self.handler.cancelled and self.macro.profile.send_delays and not self.macro.profile.fixed_delays:
-                        time.sleep(float(val) / 1000.0 if not self.macro.profile.fixed_delays else self.macro.profile.delay_amount)
+                    if not self.handler.cancelled and profile.send_delays and not profile.fixed_delays:
+                        now = time.time()
+                        timeline = max(timeline + val, now)
+                        time.sleep(timeline - now)
                 elif op == "press":
                     if self.down > 0:
                         self.handler.release_delay(self.macro)
@@ -492,20 +494,20 @@ class MacroScriptExecution(object):
                     self.handler.send_string(val, False)
                     self.down -= 1
                 elif op == "upress":
-                    if len(split) < 3:                        
+                    if len(args) < 2:                        
                         logger.error("Invalid operation in macro script. '%s'", macro_text)
                     else:
                         if self.down > 0:
                             self.handler.release_delay(self.macro)
                         self.down += 1
-                        self._send_uinput(split[2], val, 1)
+                        self._send_uinput(args[1], val, 1)
                         self.handler.press_delay(self.macro)
                 elif op == "urelease":
-                    if len(split) < 3:                        
+                    if len(args) < 2:                        
                         logger.error("Invalid operation in macro script. '%s'", macro_text)
                     else:
                         self.down -= 1
-                        self._send_uinput(split[2], val, 0)
+                        self._send_uinput(args[1], val, 0)
                 elif op == "wait":
                     if self.all_keys_up:
                         logger.warn("All keys for the macro %s are already up, " \
@@ -536,8 +538,7 @@ class MacroScriptExecution(object):
                     logger.error("Invalid operation in macro script. '%s'", macro_text)
                 
             else:
-                if len(split) > 0:
-                    logger.error("Insufficient arguments in macro script. '%s'", macro_text)
+                logger.error("Insufficient arguments in macro script. '%s'", macro_text)
                     
         
     def _send_uinput(self, target, val, state):
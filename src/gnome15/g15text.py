@@ -18,16 +18,88 @@ import pango
 import pangocairo
 import cairo
 import gobject
+import collections
+from threading import Lock
 import logging
 logger = logging.getLogger(__name__)
 
 # Shared pango context
 pango_context = pangocairo.cairo_font_map_get_default().create_context()
+
+# Maximum number of laid out texts kept
+LAYOUT_CACHE_SIZE = 512
+
+# Offsets at which shadow text is drawn
+SHADOW_OFFSETS = [ ( x, y ) for x in range(-1, 2) for y in range(-1, 2) if x != 0 or y != 0 ]
+
+# How far from a whole device pixel text may be and still use the shadow mask
+SHADOW_PIXEL_TOLERANCE = 1.0 / 64
  
 """
 Handles drawing and measuring of text on a screen. 
+
+Font descriptions (with their metrics) and laid out text are cached, so text
+that does not change between frames is not parsed or laid out again. Cached
+layouts are shared by all text handlers and must never be altered.
 """
 
+class G15TextLayout():
+    """
+    A cached layout, along with its extents and (once it has been needed) the
+    mask used to draw its shadow
+    """
+    def __init__(self, layout, metrics):
+        self.layout = layout
+        self.metrics = metrics
+        self.ink_extents, self.logical_extents = layout.get_extents()
+        self.shadow_mask = None
+        self.shadow_offset = None
+
+_cache_lock = Lock()
+_font_cache = {}
+_layout_cache = collections.OrderedDict()
+_stats = { "font_hits" : 0, "font_misses" : 0, "layout_hits" : 0, "layout_misses" : 0, "shadow_hits" : 0, "shadow_misses" : 0 }
+
+def get_cache_stats():
+    """
+    Get a copy of the cache counters, along with the hit rates (0.0 - 1.0)
+    """
+    _cache_lock.acquire()
+    try:
+        stats = dict(_stats)
+    finally:
+        _cache_lock.release()
+    for name in [ "font", "layout", "shadow" ]:
+        total = stats["%s_hits" % name] + stats["%s_misses" % name]
+        stats["%s_hit_rate" % name] = float(stats["%s_hits" % name]) / total if total > 0 else 0.0
+    return stats
+
+def clear_cache():
+    """
+    Clear all cached fonts and layouts, and reset the counters
+    """
+    _cache_lock.acquire()
+    try:
+        _font_cache.clear()
+        _layout_cache.clear()
+        for k in _stats:
+            _stats[k] = 0
+    finally:
+        _cache_lock.release()
+
+def _get_font(font_desc_name, font_absolute_size):
+    key = ( font_desc_name, font_absolute_size )
+    font = _font_cache.get(key)
+    if font is None:
+        _stats["font_misses"] += 1
+        font_desc = pango.FontDescription(font_desc_name)
+        if font_absolute_size is not None:
+            font_desc.set_absolute_size(font_absolute_size)
+        font = ( font_desc, pango_context.get_metrics(font_desc) )
+        _font_cache[key] = font
+    else:
+        _stats["font_hits"] += 1
+    return font
 
 def new_text(screen = None):
     """
@@ -75,7 +147,7 @@ class G15PangoText(G15Text):
         self.__pango_cairo_context = None
         self.__layout = None
         self.valign = pango.ALIGN_CENTER
-        self.__layout = pango.Layout(pango_context)
+        self.metrics = None
         
     def set_canvas(self, canvas):           
         G15Text.set_canvas(self, canvas)
@@ -86,20 +158,21 @@ class G15PangoText(G15Text):
             weight = None, style = None, font_pt_size = None,
             valign = None, pxwidth = None):
         
-        logger.debug("Text: %s, bounds = %s, wrap = %s, align = %s, width = %s, " \
-                     "attributes = %s, spacing = %s, font_desc = %s, weight = %s, " \
-                     "style = %s, font_pt_size = %s",
-                     str(text),
-                     str(bounds),
-                     str(wrap),
-                     str(align),
-                     str(width),
-                     str(attributes),
-                     str(spacing),
-                     str(font_desc),
-                     str(weight),
-                     str(style),
-                     str(font_pt_size))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Text: %s, bounds = %s, wrap = %s, align = %s, width = %s, " \
+                         "attributes = %s, spacing = %s, font_desc = %s, weight = %s, " \
+                         "style = %s, font_pt_size = %s",
+                         str(text),
+                         str(bounds),
+                         str(wrap),
+                         str(align),
+                         str(width),
+                         str(attributes),
+                         str(spacing),
+                         str(font_desc),
+                         str(weight),
+                         str(style),
+                         str(font_pt_size))
         
         G15Text.set_attributes(self, text, bounds)
         self.valign = valign
@@ -111,34 +184,95 @@ class G15PangoText(G15Text):
             font_desc_name += " %s" % style
         if font_pt_size:
             font_desc_name += " " + str(font_pt_size)
-        font_desc = pango.FontDescription(font_desc_name)
-        if font_absolute_size is not None:
-            font_desc.set_absolute_size(font_absolute_size)
-        self.__layout.set_font_description(font_desc)        
-        
-        if align != None:
-            self.__layout.set_alignment(align)
-        if spacing != None:
-            self.__layout.set_spacing(spacing)
-        if width != None:
-            self.__layout.set_width(width)
         if pxwidth != None:
-            self.__layout.set_width(int(pango.SCALE * pxwidth))
-        if wrap:
-            self.__layout.set_wrap(wrap)
-        if attributes:
-            self.__layout.set_attributes(attributes)
+            width = int(pango.SCALE * pxwidth)
+            
+        _cache_lock.acquire()
+        try:
+            font_desc, self.metrics = _get_font(font_desc_name, font_absolute_size)
             
-        self.__layout.set_text(text)
-        self.metrics = pango_context.get_metrics(self.__layout.get_font_description())
+            # Attribute lists cannot be compared, so such text is never cached
+            key = None if attributes else ( font_desc_name, font_absolute_size, align, spacing, width, wrap, text )
+            cached = _layout_cache.pop(key, None) if key is not None else None
+            if cached is None:
+                _stats["layout_misses"] += 1
+                cached = G15TextLayout(self._create_layout(text, font_desc, align, spacing, width, wrap, attributes), self.metrics)
+                if key is not None and len(_layout_cache) >= LAYOUT_CACHE_SIZE:
+                    _layout_cache.popitem(last = False)
+            else:
+                _stats["layout_hits"] += 1
+            if key is not None:
+                _layout_cache[key] = cached
+        finally:
+            _cache_lock.release()
+        self.__layout = cached
         
     def measure(self):
-        text_extents = self.__layout.get_extents()[1]
+        text_extents = self.__layout.logical_extents
         return text_extents[0] / pango.SCALE, text_extents[1] / pango.SCALE, text_extents[2] / pango.SCALE, text_extents[3] / pango.SCALE
     
     def draw(self, x = None, y = None):
         self.__pango_cairo_context.save()
+        x, y = self._prepare(x, y)
+        if x is not None and y is not None:                
+            self.__pango_cairo_context.move_to(x, y)
+            
+        self.__pango_cairo_context.show_layout(self.__layout.layout)
+        self.__pango_cairo_context.restore()
+        
+    def draw_shadow(self, x = None, y = None):
+        """
+        Draw the text at each of the 8 positions surrounding the given one, using
+        the current source. When the canvas is not scaled or rotated and the
+        text falls on whole pixels, this is done using a mask that is only
+        rasterised once for each layout.
         
+        Keyword arguments:
+        x            -- x position of text
+        y            -- y position of text
+        """
+        xx, yx, xy, yy, x0, y0 = self.canvas.get_matrix()
+        if xx == 1 and yy == 1 and xy == 0 and yx == 0:
+            mask, offset = self._get_shadow_mask()
+            self.__pango_cairo_context.save()
+            try:
+                px, py = self._prepare(x, y)
+                if px is None or py is None:
+                    px, py = self.__pango_cairo_context.get_current_point()
+                
+                # The mask must land on whole device pixels, otherwise it is
+                # resampled and comes out blurred and shifted
+                dx = px + offset[0] + x0
+                dy = py + offset[1] + y0
+                if abs(dx - round(dx)) < SHADOW_PIXEL_TOLERANCE and abs(dy - round(dy)) < SHADOW_PIXEL_TOLERANCE:
+                    self.__pango_cairo_context.mask_surface(mask, round(dx) - x0, round(dy) - y0)
+                    return
+            finally:
+                self.__pango_cairo_context.restore()
+                
+        for ox, oy in SHADOW_OFFSETS:
+            self.draw(x + ox, y + oy)
+    
+    """
+    Private
+    """
+    def _create_layout(self, text, font_desc, align, spacing, width, wrap, attributes):
+        layout = pango.Layout(pango_context)
+        layout.set_font_description(font_desc)
+        if align != None:
+            layout.set_alignment(align)
+        if spacing != None:
+            layout.set_spacing(spacing)
+        if width != None:
+            layout.set_width(width)
+        if wrap:
+            layout.set_wrap(wrap)
+        if attributes:
+            layout.set_attributes(attributes)
+        layout.set_text(text)
+        return layout
+    
+    def _prepare(self, x, y):
         if self.bounds is not None:
             if x == None:
                 x = self.bounds[0]
@@ -152,10 +286,27 @@ class G15PangoText(G15Text):
                 y += self.bounds[3] - ( self.metrics.get_ascent()  / 1000.0 )
             elif self.valign == pango.ALIGN_CENTER:
                 y += ( self.bounds[3] - ( self.metrics.get_ascent()  / 1000.0 ) ) / 2
-                
-        if x is not None and y is not None:                
-            self.__pango_cairo_context.move_to(x, y)
-            
-        self.__pango_cairo_context.show_layout(self.__layout)
-        self.__pango_cairo_context.restore()
+        return x, y
+    
+    def _get_shadow_mask(self):
+        cached = self.__layout
+        if cached.shadow_mask is not None:
+            _stats["shadow_hits"] += 1
+            return cached.shadow_mask, cached.shadow_offset
+        _stats["shadow_misses"] += 1
+        
+        # Cover both the ink and logical rectangles, plus a pixel all round
+        ink, logical = cached.layout.get_pixel_extents()
+        left = min(ink[0], logical[0]) - 1
+        top = min(ink[1], logical[1]) - 1
+        right = max(ink[0] + ink[2], logical[0] + logical[2]) + 1
+        bottom = max(ink[1] + ink[3], logical[1] + logical[3]) + 1
+        mask = cairo.ImageSurface(cairo.FORMAT_A8, max(1, right - left), max(1, bottom - top))
+        context = pangocairo.CairoContext(cairo.Context(mask))
+        for ox, oy in SHADOW_OFFSETS:
+            context.move_to(ox - left, oy - top)
+            context.show_layout(cached.layout)
+        cached.shadow_mask = mask
+        cached.shadow_offset = ( left, top )
+        return mask, cached.shadow_offset
         
@@ -928,6 +928,7 @@ class Menu(Component):
         self.do_clip = True
         self.layout_manager = GridLayoutManager(1)
         self.scroll_timer = None
+        self._bulk_update = False
         
     def set_scrollbar(self, scrollbar):
         scrollbar.values_callback = self.get_scroll_values
@@ -970,21 +971,37 @@ class Menu(Component):
     
     def add_child(self, child, index = -1):
         Component.add_child(self, child, index)
-        self.select_first()
-        self._recalc_scroll_values()
-        self.centre_on_selected()
+        if not self._bulk_update:
+            self.select_first()
+            self._recalc_scroll_values()
+            self.centre_on_selected()
     
     def remove_child(self, child):
         Component.remove_child(self, child)
-        self.select_first()
-        self._recalc_scroll_values()
-        self.centre_on_selected()
+        if not self._bulk_update:
+            self.select_first()
+            self._recalc_scroll_values()
+            self.centre_on_selected()
     
-    def set_children(self, children):
-        was_selected = self.selected
-        Component.set_children(self, children)
+    def set_children(self, children, selected = None):
+        """
+        Replace all of the children in one go. Selection, scrolling and the
+        redraw are only dealt with once, rather than for every added or 
+        removed child.
+        
+        Keyword arguments:
+        children        -- new list of children
+        selected        -- child to select (defaults to the current selection)
+        """
+        was_selected = self.selected if selected is None else selected
+        self._bulk_update = True
+        try:
+            Component.set_children(self, children)
+        finally:
+            self._bulk_update = False
         if was_selected in self.get_children():
             self.selected = was_selected
+            self.i = self.index_of_child(was_selected)
         else:
             self.select_first()
         self.centre_on_selected()
@@ -2112,10 +2129,7 @@ class G15Theme(object):
                 canvas.set_source_rgb(bg_rgb[0], bg_rgb[1], bg_rgb[2])
             else:
                 canvas.set_source_rgb(rgb[0], rgb[1], rgb[2])
-            for x in range(-1, 2):
-                for y in range(-1, 2):
-                    if x != 0 or y != 0:
-                        self.text.draw(text_box.bounds[0] + x, text_box.bounds[1] + y - text_box.base)
+            self.text.draw_shadow(text_box.bounds[0], text_box.bounds[1] - text_box.base)
         
         # Draw primary text to canvas                
         canvas.set_source_rgb(rgb[0], rgb[1], rgb[2])
@@ -19,24 +19,47 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 """
-GdkPixbuf thumbnail sink
+Cairo surface sink. The caps offered upstream are limited to the native pixel
+format of the LCD (cairo's own RGB24 layout, i.e. BGRx on little endian
+machines, or 8 bit grey for monochrome devices) and to no more than its native
+size, so converting and scaling are done by the pipeline while the frame is
+still small. Each buffer is then wrapped in a cairo surface without copying it.
 """
 
 import gobject
 import gst
+import cairo
 import struct
-import time
 
 big_to_cairo_alpha_mask = struct.unpack('=i', '\xFF\x00\x00\x00')[0]
 big_to_cairo_red_mask = struct.unpack('=i', '\x00\xFF\x00\x00')[0]
 big_to_cairo_green_mask = struct.unpack('=i', '\x00\x00\xFF\x00')[0]
 big_to_cairo_blue_mask = struct.unpack('=i', '\x00\x00\x00\xFF')[0]
 
+# Maximum frame rate requested from upstream
+MAX_FRAMERATE = 25
+
+RGB_CAPS = "video/x-raw-rgb, " \
+           "bpp = (int) 32, depth = (int) 24, " \
+           "endianness = (int) BIG_ENDIAN, " \
+           "red_mask = (int)   %i, " \
+           "green_mask = (int) %i, " \
+           "blue_mask = (int)  %i" % (big_to_cairo_red_mask,
+                                      big_to_cairo_green_mask,
+                                      big_to_cairo_blue_mask)
+GRAY_CAPS = "video/x-raw-gray, bpp = (int) 8, depth = (int) 8"
+SIZE_CAPS = "width = (int) [ 1, %s ], " \
+            "height = (int) [ 1, %s ], " \
+            "framerate = (fraction) [ 0, %d ]"
+
 class CairoSurfaceThumbnailSink(gst.BaseSink):
     """
-    GStreamer thumbnailing sink element.
+    GStreamer sink element that turns each frame into a cairo.ImageSurface.
 
-    Can be used in pipelines to generates gtk.gdk.Pixbuf automatically.
+    The surface for the most recent frame is available in the surface
+    attribute when the 'thumbnail' signal is emitted. The surface shares its
+    memory with the GStreamer buffer (which it keeps a reference to), so
+    it must not be drawn on.
     """
 
     __gsignals__ = {
@@ -49,44 +72,72 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
         gst.PadTemplate("sink",
                          gst.PAD_SINK,
                          gst.PAD_ALWAYS,
-                         gst.Caps("video/x-raw-rgb,"
-                                  "bpp = (int) 32, depth = (int) 32,"
-                                  "endianness = (int) BIG_ENDIAN,"
-                                  "alpha_mask = (int) %i, "
-                                  "red_mask = (int)   %i, "
-                                  "green_mask = (int) %i, "
-                                  "blue_mask = (int)  %i, "
-                                  "width = (int) [ 1, max ], "
-                                  "height = (int) [ 1, max ], "
-                                  "framerate = (fraction) [ 0, 25 ]"
-                                  % (big_to_cairo_alpha_mask,
-                                     big_to_cairo_red_mask,
-                                     big_to_cairo_green_mask,
-                                     big_to_cairo_blue_mask)))
+                         gst.Caps("%s, %s; %s, %s" % (RGB_CAPS, SIZE_CAPS % ("max", "max", MAX_FRAMERATE),
+                                                      GRAY_CAPS, SIZE_CAPS % ("max", "max", MAX_FRAMERATE))))
         )
 
-    def __init__(self):
+    def __init__(self, size = None, mono = False):
+        """
+        Keyword arguments:
+        size        -- maximum frame size to accept (normally the LCD size)
+        mono        -- accept 8 bit grey frames instead of RGB
+        """
         gst.BaseSink.__init__(self)
+        self.max_size = size
+        self.mono = mono
         self.width = 1
         self.height = 1
+        self.format = cairo.FORMAT_A8 if mono else cairo.FORMAT_RGB24
+        self.stride = 4
+        self.surface = None
         self.set_sync(True)
-        self.data = None
+
+    def do_get_caps(self):
+        max_width, max_height = self.max_size if self.max_size else ( "max", "max" )
+        return gst.Caps("%s, %s" % (GRAY_CAPS if self.mono else RGB_CAPS,
+                                    SIZE_CAPS % (max_width, max_height, MAX_FRAMERATE)))
 
     def do_set_caps(self, caps):
         self.log("caps %s" % caps.to_string())
-        self.log("padcaps %s" % self.get_pad("sink").get_caps().to_string())
+        name = caps[0].get_name()
+        if name == "video/x-raw-gray":
+            self.format = cairo.FORMAT_A8
+        elif name == "video/x-raw-rgb":
+            self.format = cairo.FORMAT_RGB24
+        else:
+            return False
         self.width = caps[0]["width"]
         self.height = caps[0]["height"]
-        if not caps[0].get_name() == "video/x-raw-rgb":
-            return False
+
+        # GStreamer pads grey rows to 4 bytes, just as cairo does
+        if self.format == cairo.FORMAT_A8:
+            self.stride = ( self.width + 3 ) & ~3
+        else:
+            self.stride = self.width * 4
         return True
 
     def do_render(self, buf):
-        self.data = str(buf.data)
+        if buf.size < self.stride * self.height:
+            self.warning("short buffer of %d bytes" % buf.size)
+            return gst.FLOW_OK
+        self.surface = self._wrap_buffer(buf)
         self.emit('thumbnail', buf.timestamp)
         return gst.FLOW_OK
- 
+
     def do_preroll(self, buf):
         return self.do_render(buf)
 
+    """
+    Private
+    """
+    def _wrap_buffer(self, buf):
+        try:
+            return cairo.ImageSurface.create_for_data(buf, self.format, self.width,
+                                                      self.height, self.stride)
+        except TypeError:
+            # The buffer is shared with another element so is not writable,
+            # which cairo insists on. Fall back to a single copy.
+            return cairo.ImageSurface.create_for_data(buf.copy_on_write(), self.format,
+                                                      self.width, self.height, self.stride)
+
 gobject.type_register(CairoSurfaceThumbnailSink)
@@ -25,12 +25,16 @@ import os, os.path
 import cairo
 import math
 import rsvg
-import urllib
+import urllib2
 import base64
+import time
+import collections
+from threading import RLock
 import xdg.Mime as mime
 import g15convert
 import g15os
-import gnome15.g15globals
+import jobqueue
+from gnome15 import g15globals
 
 # Logging
 import logging
@@ -57,15 +61,83 @@ def flip_hv_centered_on(context, fx, fy, cx, cy):
     mtrx = cairo.Matrix(fx,0,0,fy,cx*(1-fx),cy*(fy-1))
     context.transform(mtrx)
     
+'''
+Images fetched over HTTP are kept in a disk cache, along with a metadata file
+(suffixed with 'm') holding the content type. Cached images expire after
+IMAGE_CACHE_MAX_AGE seconds, and the oldest are removed whenever the cache grows
+beyond IMAGE_CACHE_MAX_SIZE bytes
+'''
+IMAGE_CACHE_DIR = os.path.join(g15globals.user_cache_dir, "images")
+IMAGE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+IMAGE_CACHE_MAX_SIZE = 32 * 1024 * 1024
+
 def get_cache_filename(filename, size = None):    
     cache_file = base64.urlsafe_b64encode("%s-%s" % ( filename, str(size if size is not None else "0,0") ) )
-    g15os.mkdir_p(g15globals.user_cache_dir)
-    return os.path.join(g15globals.user_cache_dir, "%s.img" % cache_file)
+    g15os.mkdir_p(IMAGE_CACHE_DIR)
+    return os.path.join(IMAGE_CACHE_DIR, "%s.img" % cache_file)
     
 def get_image_cache_file(filename, size = None):
     full_cache_path = get_cache_filename(filename, size)
-    if os.path.exists(full_cache_path):
-        return full_cache_path
+    try:
+        if time.time() - os.path.getmtime(full_cache_path) < IMAGE_CACHE_MAX_AGE and \
+                os.path.exists(full_cache_path + "m"):
+            return full_cache_path
+        _remove_cache_file(full_cache_path)
+    except OSError:
+        pass
+    
+def _remove_cache_file(full_cache_path):
+    for path in [ full_cache_path, full_cache_path + "m" ]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        
+def _write_cache_file(full_cache_path, data, type):
+    # The metadata is written first, and the image is renamed into place, so
+    # an image in the cache is always complete and always has its metadata
+    meta_fileobj = open(full_cache_path + "m", "w")
+    try:
+        meta_fileobj.write(type + "\n")
+    finally:
+        meta_fileobj.close()
+    tmp_path = full_cache_path + ".tmp"
+    cache_fileobj = open(tmp_path, "w")
+    try:
+        cache_fileobj.write(data)
+    finally:
+        cache_fileobj.close()
+    os.rename(tmp_path, full_cache_path)
+    _prune_cache()
+    
+def _prune_cache():
+    files = []
+    total = 0
+    for name in os.listdir(IMAGE_CACHE_DIR):
+        if name.endswith(".img"):
+            path = os.path.join(IMAGE_CACHE_DIR, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append(( st.st_mtime, st.st_size, path ))
+            total += st.st_size
+    files.sort()
+    while files and total > IMAGE_CACHE_MAX_SIZE:
+        mtime, size, path = files.pop(0)
+        _remove_cache_file(path)
+        total -= size
+    
+def _load_cached_image(filename, full_cache_path, size):
+    meta_fileobj = open(full_cache_path + "m", "r")
+    try:
+        type = meta_fileobj.readline().strip()
+    finally:
+        meta_fileobj.close()
+    if type == "image/svg+xml" or filename.lower().endswith(".svg"):
+        return load_svg_as_surface(full_cache_path, size)
+    else:
+        return pixbuf_to_surface(gtk.gdk.pixbuf_new_from_file(full_cache_path), size)
     
 def is_url(path):
     # TODO try harder
@@ -80,32 +152,28 @@ def load_surface_from_file(filename, size = None):
     if filename.startswith("http:") or filename.startswith("https:"):
         full_cache_path = get_image_cache_file(filename, size)
         if full_cache_path:
-            meta_fileobj = open(full_cache_path + "m", "r")
-            type = meta_fileobj.readline()
-            meta_fileobj.close()
-            if type == "image/svg+xml" or filename.lower().endswith(".svg"):
-                return load_svg_as_surface(filename, size)
-            else:
-                return pixbuf_to_surface(gtk.gdk.pixbuf_new_from_file(full_cache_path), size)
+            try:
+                return _load_cached_image(filename, full_cache_path, size)
+            except Exception as e:
+                # Fetch it again
+                logger.debug("Discarding unreadable cached image for %s", filename, exc_info = e)
+                _remove_cache_file(full_cache_path)
                 
     if is_url(filename):
         type = None
         try:
-            file = urllib.urlopen(filename)
-            data = file.read()
-            type = file.info().gettype()
+            data, type = _read_url(filename)
             
             if filename.startswith("file://"):
                 type = str(mime.get_type(filename))
             
             if filename.startswith("http:") or filename.startswith("https:"):
-                full_cache_path = get_cache_filename(filename, size)
-                cache_fileobj = open(full_cache_path, "w")
-                cache_fileobj.write(data)
-                cache_fileobj.close()
-                meta_fileobj = open(full_cache_path + "m", "w")
-                meta_fileobj.write(type + "\n")
-                meta_fileobj.close()
+                # Only images are cached
+                if type.startswith("image/"):
+                    try:
+                        _write_cache_file(get_cache_filename(filename, size), data, type)
+                    except (IOError, OSError) as e:
+                        logger.debug("Could not cache image %s", filename, exc_info = e)
             
             if type == "image/svg+xml" or filename.lower().endswith(".svg"):
                 svg = rsvg.Handle()
@@ -155,6 +223,137 @@ def load_surface_from_file(filename, size = None):
                 logger.warning("Failed to get image %s (%s).", filename, type, exc_info = e)
                 return None
             
+'''
+Asynchronous loading. Remote (and large) images are loaded on a small pool of
+worker threads, so a slow network or a huge image never holds up painting. 
+Until an image is ready, the caller gets a placeholder, and is called back
+when the image has loaded so it can redraw.
+'''
+
+# Number of threads loading images
+ASSET_WORKERS = 2
+
+# Images fetched from URLs larger than this are refused
+MAX_ASSET_SIZE = 4 * 1024 * 1024
+
+# Maximum time to wait for a URL to respond
+ASSET_TIMEOUT = 10.0
+
+# Number of loaded images kept
+ASSET_CACHE_SIZE = 64
+
+# How long before trying to load an image that previously failed again
+ASSET_RETRY_INTERVAL = 60.0
+
+class G15AssetLoader():
+    
+    def __init__(self, workers = ASSET_WORKERS):
+        self._workers = workers
+        self._queue = None
+        self._lock = RLock()
+        self._assets = collections.OrderedDict()
+        self._pending = {}
+        
+    def load(self, filename, size = None, callback = None, placeholder = None):
+        """
+        Get an image as a surface if it has already been loaded, otherwise start
+        loading it and return the placeholder. Any number of callers may ask for 
+        the same image while it is loading, it will only be loaded once.
+        
+        Keyword arguments:
+        filename        -- path or URL of image
+        size            -- size to load image at (or None for natural size)
+        callback        -- function called with the surface (or None if it failed to load) when loaded.
+                           If the image recently failed to load, this is called before returning
+        placeholder     -- returned if the image is not yet available
+        """
+        if filename == None:
+            return placeholder
+        key = ( filename, tuple(size) if isinstance(size, list) else size )
+        failed = False
+        self._lock.acquire()
+        try:
+            if key in self._assets:
+                surface, loaded = self._assets.pop(key)
+                if surface is not None:
+                    self._assets[key] = ( surface, loaded )
+                    return surface
+                if time.time() < loaded + ASSET_RETRY_INTERVAL:
+                    # Failed recently, so tell the caller straight away
+                    self._assets[key] = ( surface, loaded )
+                    failed = True
+            if not failed:
+                if key in self._pending:
+                    if callback is not None:
+                        self._pending[key].append(callback)
+                    return placeholder
+                self._pending[key] = [ callback ] if callback is not None else []
+                if self._queue is None:
+                    self._queue = jobqueue.JobQueue(number_of_workers = self._workers, name = "AssetLoader")
+        finally:
+            self._lock.release()
+        if failed:
+            if callback is not None:
+                callback(None)
+            return placeholder
+        self._queue.run("Load %s" % filename, self._load, key, filename, size)
+        return placeholder
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._assets.clear()
+        finally:
+            self._lock.release()
+    
+    """
+    Private
+    """
+    def _load(self, key, filename, size):
+        surface = None
+        try:
+            surface = load_surface_from_file(filename, size)
+        finally:
+            self._lock.acquire()
+            try:
+                self._assets[key] = ( surface, time.time() )
+                while len(self._assets) > ASSET_CACHE_SIZE:
+                    self._assets.popitem(last = False)
+                callbacks = self._pending.pop(key, [])
+            finally:
+                self._lock.release()
+            for callback in callbacks:
+                try:
+                    callback(surface)
+                except Exception as e:
+                    logger.error("Error in image loaded callback for %s", filename, exc_info = e)
+            
+_asset_loader = G15AssetLoader()
+
+def load_surface_async(filename, size = None, callback = None, placeholder = None):
+    """
+    Load an image on the shared asset loader. See G15AssetLoader.load()
+    """
+    return _asset_loader.load(filename, size, callback, placeholder)
+
+def _read_url(url):
+    """
+    Read the content and content type of a URL, giving up if it takes too
+    long to respond or is too big
+    """
+    handle = urllib2.urlopen(url, timeout = ASSET_TIMEOUT)
+    try:
+        type = handle.info().gettype()
+        length = handle.info().getheader("Content-Length")
+        if length is not None and length.isdigit() and int(length) > MAX_ASSET_SIZE:
+            raise IOError("Image %s is too big (%s bytes)" % ( url, length ))
+        data = handle.read(MAX_ASSET_SIZE + 1)
+        if len(data) > MAX_ASSET_SIZE:
+            raise IOError("Image %s is too big" % url)
+        return data, type
+    finally:
+        handle.close()
+            
 def load_svg_as_surface(filename, size):
     svg = rsvg.Handle(filename)
     try:
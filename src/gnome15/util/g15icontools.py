@@ -27,6 +27,9 @@ import cairo
 from PIL import Image
 import urllib
 import base64
+import time
+import collections
+from threading import RLock
 
 # Logging
 import logging
@@ -41,6 +44,46 @@ gtk_icon_theme = gtk.icon_theme_get_default()
 if g15globals.dev:
     gtk_icon_theme.prepend_search_path(g15globals.icons_dir)
 
+'''
+Resolved icon paths (including icons that could not be found), keyed by the
+icon name (or tuple of names), size and options. Lookups that involve file
+paths are not indexed, as the file may come or go at any time. The index holds
+at most MAX_ICON_INDEX entries, the least recently used being dropped, and is
+cleared whenever the icon theme changes. Icon theme access is not thread safe,
+so all lookups are serialised with a lock
+'''
+MAX_ICON_INDEX = 1024
+_icon_index = collections.OrderedDict()
+_icon_lock = RLock()
+_icon_stats = { "lookups" : 0, "hits" : 0, "misses" : 0, "resolve_time" : 0.0 }
+
+def _icon_theme_changed(theme):
+    logger.info("Icon theme changed, clearing icon index")
+    clear_icon_index()
+    
+gtk_icon_theme.connect("changed", _icon_theme_changed)
+
+def clear_icon_index():
+    """
+    Forget all resolved icon paths
+    """
+    _icon_lock.acquire()
+    try:
+        _icon_index.clear()
+    finally:
+        _icon_lock.release()
+        
+def get_icon_stats():
+    """
+    Get a copy of the icon lookup counters. 'resolve_time' is the total time
+    (in seconds) spent resolving icons that were not in the index
+    """
+    _icon_lock.acquire()
+    try:
+        return dict(_icon_stats)
+    finally:
+        _icon_lock.release()
+
 def local_icon_or_default(icon_name, size = 128):
     return get_icon_path(icon_name, size)
 
@@ -81,6 +124,35 @@ def get_embedded_image_url(path):
         file_str.close()
 
 def get_icon_path(icon = None, size = 128, warning = True, include_missing = True):
+    key = ( tuple(icon) if isinstance(icon, list) else icon, size, include_missing )
+    _icon_lock.acquire()
+    try:
+        _icon_stats["lookups"] += 1
+        if key in _icon_index:
+            _icon_stats["hits"] += 1
+            path = _icon_index.pop(key)
+            _icon_index[key] = path
+            return path
+        _icon_stats["misses"] += 1
+        started = time.time()
+        path = _resolve_icon_path(icon, size, warning, include_missing)
+        _icon_stats["resolve_time"] += time.time() - started
+        if not _is_file_lookup(icon):
+            _icon_index[key] = path
+            if len(_icon_index) > MAX_ICON_INDEX:
+                _icon_index.popitem(last = False)
+        return path
+    finally:
+        _icon_lock.release()
+
+def _is_file_lookup(icon):
+    names = icon if isinstance(icon, list) else [ icon ]
+    for name in names:
+        if isinstance(name, basestring) and os.sep in name:
+            return True
+    return False
+
+def _resolve_icon_path(icon, size, warning, include_missing):
     o_icon = icon
     if isinstance(icon, list):
         for i in icon:
@@ -40,10 +40,32 @@ def rotate_element(element, degrees):
     ts = "m" + str(t)[7:]
     element.set("transform", ts)
     
-def get_transforms(element, position_only = False):
-    transform_val = element.get("transform")
-    list = []
-    if transform_val != None:
+# Parsed transforms and composed matrices. These are keyed by the attribute
+# values themselves, so they stay valid however many times a document is 
+# copied, and changing an attribute simply results in a different key
+MAX_CACHE_SIZE = 4096
+_transform_cache = {}
+_offset_cache = {}
+_chain_cache = {}
+
+def _cache_put(cache, key, value):
+    if len(cache) >= MAX_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
+def clear_cache():
+    """
+    Clear all cached transforms
+    """
+    _transform_cache.clear()
+    _offset_cache.clear()
+    _chain_cache.clear()
+
+def _parse_transforms(transform_val, position_only):
+    key = ( transform_val, position_only )
+    parsed = _transform_cache.get(key)
+    if parsed is None:
+        parsed = []
         start = 0
         while True:
             start_args = transform_val.find("(", start)
@@ -55,78 +77,112 @@ def get_transforms(element, position_only = False):
                 break
             args = transform_val[start_args + 1:end_args].split(",")
             if name == "translate":
-                list.append(cairo.Matrix(1.0, 0.0, 0.0, 1.0, float(args[0]), float(args[1])))
+                parsed.append((1.0, 0.0, 0.0, 1.0, float(args[0]), float(args[1])))
             elif name == "matrix":
                 if position_only:
-                    list.append(cairo.Matrix(float(args[0]), float(args[1]), float(args[2]), float(args[3]),float(args[4]),float(args[5])))
+                    parsed.append((float(args[0]), float(args[1]), float(args[2]), float(args[3]),float(args[4]),float(args[5])))
                 else:
-                    list.append(cairo.Matrix(1, 0, 0, 1, float(args[4]),float(args[5])))
+                    parsed.append((1, 0, 0, 1, float(args[4]),float(args[5])))
             elif name == "scale":
-                list.append(cairo.Matrix(float(args[0]), 0.0, 0.0, float(args[1]), 0.0, 0.0))
+                parsed.append((float(args[0]), 0.0, 0.0, float(args[1]), 0.0, 0.0))
             else:
                 logger.warning("Unsupported transform %s", name)
             start = end_args + 1
+        parsed = tuple(parsed)
+        _cache_put(_transform_cache, key, parsed)
+    return parsed
+    
+def get_transforms(element, position_only = False):
+    transform_val = element.get("transform")
+    if transform_val == None:
+        return []
+    return [ cairo.Matrix(*m) for m in _parse_transforms(transform_val, position_only) ]
 
-    return list
+def _get_transform_offset(transform_val):
+    offset = _offset_cache.get(transform_val)
+    if offset is None:
+        x = 0.0
+        y = 0.0
+        start = 0
+        while True:
+            start_args = transform_val.find("(", start)
+            if start_args == -1:
+                break
+            name = transform_val[:start_args].lstrip()
+            end_args = transform_val.find(")", start_args)
+            if end_args == -1:
+                logger.warning("Unexpected end of transform arguments")
+                break
+            args = g15pythonlang.split_args(transform_val[start_args + 1:end_args])
+            if name == "translate":
+                x += float(args[0])
+                y += float(args[1])
+            elif name == "matrix":
+                x += float(args[4])
+                y += float(args[5])
+            else:
+                logger.warning("WARNING: Unsupported transform %s", name)
+            start = end_args + 1
+        offset = ( x, y )
+        _cache_put(_offset_cache, transform_val, offset)
+    return offset
 
 def get_location(element):
-    list = []
+    x = 0
+    y = 0
     while element != None:
-        x = element.get("x")
-        y = element.get("y")
-        if x != None and y != None:
-            list.append((float(x), float(y)))
+        ex = element.get("x")
+        ey = element.get("y")
+        if ex != None and ey != None:
+            x += float(ex)
+            y += float(ey)
         transform_val = element.get("transform")
         if transform_val != None:
-            start = 0
-            while True:
-                start_args = transform_val.find("(", start)
-                if start_args == -1:
-                    break
-                name = transform_val[:start_args].lstrip()
-                end_args = transform_val.find(")", start_args)
-                if end_args == -1:
-                    logger.warning("Unexpected end of transform arguments")
-                    break
-                args = g15pythonlang.split_args(transform_val[start_args + 1:end_args])
-                if name == "translate":
-                    list.append((float(args[0]), float(args[1])))
-                elif name == "matrix":
-                    list.append((float(args[4]),float(args[5])))
-                else:
-                    logger.warning("WARNING: Unsupported transform %s", name)
-                start = end_args + 1
+            tx, ty = _get_transform_offset(transform_val)
+            x += tx
+            y += ty
         element = element.getparent()
-    list.reverse()
-    x = 0
-    y = 0
-    for i in list:
-        x += i[0]
-        y += i[1]
     return (x, y)
 
-def get_actual_bounds(element, relative_to = None):
-    id = element.get("id")
+def _get_chain_matrix(element):
+    """
+    Get the matrix composed from the transforms of an element and all of its
+    ancestors (or None if there are none)
+    """
+    chain = []
+    while element != None:
+        chain.append(element.get("transform"))
+        element = element.getparent()
+    chain = tuple(chain)
+    if chain in _chain_cache:
+        return _chain_cache[chain]
+    
+    transforms = []
+    for transform_val in chain:
+        if transform_val != None:
+            transforms += [ cairo.Matrix(*m) for m in _parse_transforms(transform_val, True) ]
+    transforms.reverse()
+    t = None
+    if len(transforms) > 0:
+        t = transforms[0]
+        for i in range(1, len(transforms)):
+            t = t.multiply(transforms[i])
+    _cache_put(_chain_cache, chain, t)
+    return t
 
+def get_actual_bounds(element, relative_to = None):
     bounds = get_bounds(element)
-    transforms = []
     t = cairo.Matrix()
     t.translate(bounds[0],bounds[1])
-    transforms.append(t)
 
     # If the element is a clip path and the associated clipped_node is provided, the work out the transforms from
     # the parent of the clipped_node, not the clip itself
     if relative_to is not None:
         element = relative_to.getparent()
 
-    while element != None:
-        transforms += get_transforms(element, position_only=True)
-        element = element.getparent()
-    transforms.reverse()
-    if len(transforms) > 0:
-        t = transforms[0]
-        for i in range(1, len(transforms)):
-            t = t.multiply(transforms[i])
+    chain_matrix = _get_chain_matrix(element)
+    if chain_matrix is not None:
+        t = chain_matrix.multiply(t)
 
     xx, yx, xy, yy, x0, y0 = t
     return x0, y0, bounds[2], bounds[3]
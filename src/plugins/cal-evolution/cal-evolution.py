@@ -48,6 +48,9 @@ global_plugin=True
 passive=True
 unsupported_models=cal.unsupported_models
 
+# The calendars are local files, so they may be read more often than the default
+REFRESH_INTERVAL = 5 * 60
+
 """
 Calendar Back-end module functions
 """
@@ -29,11 +29,16 @@ import gnome15.g15screen as g15screen
 import gnome15.g15accounts as g15accounts
 import gnome15.g15plugin as g15plugin
 import gnome15.g15globals as g15globals
+import gnome15.util.g15os as g15os
+import gnome15.util.jobqueue as jobqueue
 import datetime
 import time
 import os, os.path
 import gtk
 import calendar
+import json
+import subprocess
+from threading import RLock
 
 # Logging
 import logging
@@ -76,6 +81,18 @@ REFRESH_INTERVAL = 15 * 60
 CONFIG_PATH = os.path.join(g15globals.user_config_dir, "plugin-data", "cal", "calendars.xml")
 CONFIG_ITEM_NAME = "calendar"
 
+# Fetched events are kept here between runs
+CACHE_PATH = os.path.join(g15globals.user_cache_dir, "cal", "events.json")
+
+# Months further back than this are dropped from the cache
+CACHE_MONTHS = 12
+
+# Maximum number of backends that are asked for events at the same time
+FETCH_WORKERS = 3
+
+# Longest an event may be for it to be shown on every day it covers
+MAX_EVENT_DAYS = 366
+
 """
 Functions
 """
@@ -130,9 +147,13 @@ class CalendarBackend():
     def check_and_add(self, ve, now, event_days):
         if ve.start_date.month == now.month and ve.start_date.year == now.year:
             day = ve.start_date.day
-            while day <= ve.end_date.day:
+            if ve.end_date.month == now.month and ve.end_date.year == now.year:
+                last = ve.end_date.day
+            else:
+                last = calendar.monthrange(now.year, now.month)[1]
+            while day <= last:
                 key = str(day)
-                day_event_list = event_days[key] if key is event_days else None
+                day_event_list = event_days[key] if key in event_days else None
                 if day_event_list is None:
                     day_event_list = list()
                     event_days[key] = day_event_list
@@ -142,18 +163,328 @@ class CalendarBackend():
     def get_events(self, now):
         raise Exception("Not implemented")
     
+def get_day(date):
+    """
+    Get the day (a datetime.date) of an event date, which may be either a
+    date or a datetime
+    
+    Keyword arguments:
+    date          -- date or datetime
+    """
+    return date.date() if isinstance(date, datetime.datetime) else date
+
+def get_month(date, offset = 0):
+    """
+    Get a ( year, month ) tuple for the month of a date, optionally moved
+    forwards or backwards a number of months.
+    
+    Keyword arguments:
+    date          -- date or datetime
+    offset        -- number of months to move
+    """
+    m = date.year * 12 + date.month - 1 + offset
+    return ( m // 12, m % 12 + 1 )
+
+def _format_date(date):
+    if isinstance(date, datetime.datetime):
+        return "%04d-%02d-%02d %02d:%02d:%02d" % ( date.year, date.month, date.day, date.hour, date.minute, date.second )
+    return "%04d-%02d-%02d" % ( date.year, date.month, date.day )
+
+def _parse_date(text):
+    return datetime.datetime(*[ int(v) for v in text.replace(" ", "-").replace(":", "-").split("-") ]) \
+        if " " in text else datetime.date(*[ int(v) for v in text.split("-") ])
+    
+class CachedCalendarEvent(CalendarEvent):
+    """
+    An event loaded from the event cache. Displayed until the backend that
+    originally provided it has been asked again
+    """
+    
+    def __init__(self, data):
+        CalendarEvent.__init__(self)
+        self.start_date = _parse_date(data["start"])
+        self.end_date = _parse_date(data["end"])
+        self.summary = data["summary"]
+        self.color = data.get("color")
+        self.alarm = data.get("alarm", False)
+        self.alt_icon = data.get("alt_icon")
+        self.link = data.get("link")
+        
+    def activate(self):
+        if self.link:
+            subprocess.Popen(['xdg-open', self.link])
+        else:
+            CalendarEvent.activate(self)
+    
+class EventStore():
+    """
+    Holds the events fetched from all of the calendar backends. Events are
+    fetched a month at a time for each account, several accounts at once, and
+    each account/month range is remembered along with when it was fetched, so
+    it is only asked again once it is older than the lifetime of its backend.
+    An index of events by day is rebuilt whenever a range changes, and the
+    ranges are saved so there is something to show straight away at start-up.
+    """
+    
+    def __init__(self, cache_file = None, workers = FETCH_WORKERS):
+        self.cache_file = cache_file
+        self._lock = RLock()
+        self._ranges = {}
+        self._fetching = set()
+        self._index = {}
+        self._range_days = {}
+        self._save_lock = RLock()
+        self._revision = 0
+        self._queue = jobqueue.JobQueue(number_of_workers = workers, name = "CalendarFetch")
+        self._load()
+        
+    def stop(self):
+        self._queue.stop()
+        
+    def get_revision(self):
+        """
+        Get a number that changes whenever the indexed events change
+        """
+        return self._revision
+        
+    def get_events(self, day):
+        """
+        Get the events that cover a day, ordered by start time.
+        
+        Keyword arguments:
+        day          -- date or datetime
+        """
+        self._lock.acquire()
+        try :
+            return list(self._index.get(get_day(day), []))
+        finally :
+            self._lock.release()
+            
+    def is_fresh(self, account_name, month, lifetime):
+        """
+        Get if an account's events for a month were fetched less than lifetime
+        seconds ago
+        
+        Keyword arguments:
+        account_name    -- account name
+        month           -- ( year, month ) tuple
+        lifetime        -- how long fetched events stay fresh (seconds)
+        """
+        r = self._ranges.get(( account_name, month ))
+        return r is not None and r[0] is not None and time.time() - r[0] < lifetime
+        
+    def request(self, account_name, month, loader, lifetime, callback = None, force = False):
+        """
+        Fetch an account's events for a month in the background, unless they
+        are still fresh or already being fetched. The loader is called with a
+        datetime in the month, and should return a dictionary of event lists
+        (as CalendarBackend.get_events does) or None. When the new events have
+        been indexed, callback is called with the month.
+        
+        Keyword arguments:
+        account_name    -- account name
+        month           -- ( year, month ) tuple
+        loader          -- function to fetch the events
+        lifetime        -- how long fetched events stay fresh (seconds)
+        callback        -- function to call when the events change
+        force           -- fetch even if the events are fresh
+        """
+        key = ( account_name, month )
+        self._lock.acquire()
+        try :
+            if key in self._fetching or ( not force and self.is_fresh(account_name, month, lifetime) ):
+                return False
+            self._fetching.add(key)
+        finally :
+            self._lock.release()
+        self._queue.run(None, self._fetch, key, loader, callback)
+        return True
+    
+    def retain_accounts(self, account_names):
+        """
+        Forget the events of any accounts not in the list
+        
+        Keyword arguments:
+        account_names    -- names of the current accounts
+        """
+        self._lock.acquire()
+        try :
+            removed = [ k for k in self._ranges if not k[0] in account_names ]
+            for k in removed:
+                self._unindex_range(k, self._ranges.pop(k)[1])
+            if len(removed) > 0:
+                self._revision += 1
+        finally :
+            self._lock.release()
+        
+    def update(self, account_name, month, events, fetched = None):
+        """
+        Replace an account's events for a month and re-index.
+        
+        Keyword arguments:
+        account_name    -- account name
+        month           -- ( year, month ) tuple
+        events          -- list of CalendarEvent
+        fetched         -- time the events were fetched (defaults to now)
+        """
+        self._lock.acquire()
+        try :
+            key = ( account_name, month )
+            if key in self._ranges:
+                self._unindex_range(key, self._ranges[key][1])
+            self._ranges[key] = ( time.time() if fetched is None else fetched, events )
+            self._index_range(key)
+            self._revision += 1
+        finally :
+            self._lock.release()
+        
+    def save(self):
+        if self.cache_file is None:
+            return
+        oldest = get_month(datetime.date.today(), -CACHE_MONTHS)
+        self._lock.acquire()
+        try :
+            data = {}
+            for ( account_name, month ), ( fetched, events ) in self._ranges.items():
+                if month >= oldest:
+                    data["%s|%04d-%02d" % ( account_name, month[0], month[1] )] = { "fetched" : fetched, \
+                        "events" : [ self._event_to_dict(e) for e in events ] }
+        finally :
+            self._lock.release()
+        self._save_lock.acquire()
+        try :
+            g15os.mkdir_p(os.path.dirname(self.cache_file))
+            tmp = "%s.tmp" % self.cache_file
+            f = open(tmp, "w")
+            try :
+                json.dump(data, f, separators = (",", ":"))
+            finally :
+                f.close()
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save calendar cache %s", self.cache_file, exc_info = e)
+        finally :
+            self._save_lock.release()
+        
+    """
+    Private
+    """
+    def _fetch(self, key, loader, callback):
+        account_name, month = key
+        try :
+            started = time.time()
+            event_days = loader(datetime.datetime(month[0], month[1], 1))
+            if event_days is None:
+                logger.warning("Calendar returned no events, skipping")
+                return
+            events = []
+            seen = set()
+            for day_events in event_days.values():
+                for e in day_events:
+                    if not id(e) in seen:
+                        seen.add(id(e))
+                        events.append(e)
+            self.update(account_name, month, events)
+            logger.debug("Fetched %d events for %s %04d-%02d in %.3f seconds", len(events), \
+                         account_name, month[0], month[1], time.time() - started)
+        except Exception as e:
+            logger.warn("Failed to load events for account %s.", account_name, exc_info = e)
+            return
+        finally :
+            self._lock.acquire()
+            try :
+                self._fetching.discard(key)
+                idle = len(self._fetching) == 0
+            finally :
+                self._lock.release()
+        
+        # Save once the last of a batch of fetches has finished
+        if idle:
+            self.save()
+        if callback is not None:
+            callback(month)
+        
+    def _rebuild_index(self):
+        self._index = {}
+        for key in self._ranges:
+            self._index_range(key)
+        self._revision += 1
+        
+    def _unindex_range(self, key, events):
+        old = set([ id(e) for e in events ])
+        for day in self._range_days.pop(key, []):
+            remaining = [ e for e in self._index.get(day, []) if not id(e) in old ]
+            if len(remaining) > 0:
+                self._index[day] = remaining
+            else:
+                self._index.pop(day, None)
+            
+    def _index_range(self, key):
+        days = set()
+        for e in self._ranges[key][1]:
+            day = get_day(e.start_date)
+            last = get_day(e.end_date) if e.end_date is not None else day
+            # Guard against events with bad dates filling the index
+            last = min(last, day + datetime.timedelta(MAX_EVENT_DAYS))
+            while day <= last:
+                self._index.setdefault(day, []).append(e)
+                days.add(day)
+                day += datetime.timedelta(1)
+        for day in days:
+            self._index[day].sort(key = lambda e: e.start_date.timetuple()[:6])
+        self._range_days[key] = days
+        
+    def _event_to_dict(self, event):
+        return { "start" : _format_date(event.start_date), \
+                 "end" : _format_date(event.end_date if event.end_date is not None else event.start_date), \
+                 "summary" : event.summary, \
+                 "color" : event.color, \
+                 "alarm" : event.alarm, \
+                 "alt_icon" : event.alt_icon, \
+                 "link" : getattr(event, "link", None) }
+    
+    def _load(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try :
+            f = open(self.cache_file, "r")
+            try :
+                data = json.load(f)
+            finally :
+                f.close()
+            for key, r in data.items():
+                account_name, sep, month = key.rpartition("|")
+                year, month = month.split("-")
+                self._ranges[( account_name, ( int(year), int(month) ) )] = \
+                    ( r["fetched"], [ CachedCalendarEvent(e) for e in r["events"] ] )
+            self._rebuild_index()
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Could not load calendar cache %s", self.cache_file, exc_info = e)
+    
 class EventMenuItem(g15theme.MenuItem):
     
     def __init__(self, plugin, event, component_id):
         g15theme.MenuItem.__init__(self, component_id)
         self.event = event
         self.plugin = plugin
+        self._event_properties = None
     
     def get_default_theme_dir(self):
         return os.path.join(os.path.dirname(__file__), "default")
     
     def get_theme_properties(self):        
         item_properties = g15theme.MenuItem.get_theme_properties(self)
+        if self._event_properties is None:
+            self._event_properties = self._get_event_properties()
+        item_properties.update(self._event_properties)
+        return item_properties
+    
+    def _get_event_properties(self):
+        """
+        The event does not change while this item exists, so its properties
+        are only worked out once
+        """
+        item_properties = {}
         item_properties["item_name"] = self.event.summary
         
         start_str = self.event.start_date.strftime("%H:%M")
@@ -196,15 +527,18 @@ class Cell(g15theme.Component):
         self.now = now
         self.event = event
         
+        # Cells are created again whenever the events change, so everything
+        # but today's highlight can be worked out now
+        self._properties = {}
+        self._properties["weekday"] = day.weekday()
+        self._properties["day"] = day.day
+        self._properties["event"] = event.summary if event else ""
+        
     def on_configure(self):  
         self.set_theme(g15theme.G15Theme(os.path.join(os.path.dirname(__file__), "default"), "cell"))
         
     def get_theme_properties(self):
-        weekday = self.day.weekday()        
-        properties = {}
-        properties["weekday"] = weekday
-        properties["day"] = self.day.day
-        properties["event"] = self.event.summary if self.event else ""    
+        properties = dict(self._properties)
         if self.now.day == self.day.day and self.now.month == self.day.month:
             properties["today"] = True
         return properties
@@ -262,7 +596,8 @@ class G15Cal(g15plugin.G15Plugin):
         g15plugin.G15Plugin.activate(self)
         
         self._active = True
-        self._event_days = None
+        self._store = EventStore(CACHE_PATH)
+        self._date_properties = {}
         self._calendar_date = None
         self._page = None
         self._theme = g15theme.G15Theme(os.path.join(os.path.dirname(__file__), "default"), auto_dirty = False)
@@ -313,6 +648,8 @@ class G15Cal(g15plugin.G15Plugin):
         self.screen.key_handler.action_listeners.remove(self)
         if self._timer != None:
             self._timer.cancel()
+        self._active = False
+        self._store.stop()
         if self._page != None:
             g15screen.run_on_redraw(self.screen.del_page, self._page)
         
@@ -351,7 +688,7 @@ class G15Cal(g15plugin.G15Plugin):
     """
     
     def _config_changed(self, client, connection_id, entry, args):
-        self._loaded = 0
+        self._date_properties = {}
         self._redraw()
         
     def _network_state_changed(self, state):
@@ -366,13 +703,39 @@ class G15Cal(g15plugin.G15Plugin):
         o_date = self._get_calendar_date()
         self._calendar_date = o_date + datetime.timedelta(amount)
         if amount == 0 or o_date.month != self._calendar_date.month or o_date.year != self._calendar_date.year:
-            self._load_month_events(self._calendar_date)
-        else:            
-            g15screen.run_on_redraw(self._rebuild_components, self._calendar_date)
+            self._request_events(self._calendar_date)
+        g15screen.run_on_redraw(self._rebuild_components, self._calendar_date)
         
     def _get_calendar_date(self):
         now = datetime.datetime.now()
         return self._calendar_date if self._calendar_date is not None else now
+    
+    def _get_date_properties(self, date):
+        """
+        Get the properties that only change once a day. These are cached, as
+        they would otherwise be formatted again every time the page is painted
+        """
+        day = get_day(date)
+        properties = self._date_properties.get(day)
+        if properties is None:
+            if len(self._date_properties) > 8:
+                self._date_properties = {}
+            properties = {}
+            properties["short_date"] = date.strftime("%a %d %b")
+            properties["full_date"] = date.strftime("%A %d %B")
+            properties["date"] = g15locale.format_date(date, self.gconf_client)
+            properties["locale_date"] = date.strftime("%x")
+            properties["year"] = date.strftime("%Y")
+            properties["short_year"] = date.strftime("%y")
+            properties["week"] = date.strftime("%W")
+            properties["month"] = date.strftime("%m")
+            properties["month_name"] = date.strftime("%B")
+            properties["short_month_name"] = date.strftime("%b")
+            properties["day_name"] = date.strftime("%A")
+            properties["short_day_name"] = date.strftime("%a")
+            properties["day_of_year"] = date.strftime("%d")
+            self._date_properties[day] = properties
+        return properties
         
     def _get_properties(self):
         now = datetime.datetime.now()
@@ -390,28 +753,16 @@ class G15Cal(g15plugin.G15Plugin):
         properties["full_time_24"] = now.strftime("%H:%M:%S") 
         properties["time_12"] = now.strftime("%I:%M %p") 
         properties["full_time_12"] = now.strftime("%I:%M:%S %p")
-        properties["short_date"] = now.strftime("%a %d %b")
-        properties["full_date"] = now.strftime("%A %d %B")
-        properties["date"] = g15locale.format_date(now, self.gconf_client)
-        properties["locale_date"] = now.strftime("%x")
         properties["locale_time"] = now.strftime("%X")
-        properties["year"] = now.strftime("%Y")
-        properties["short_year"] = now.strftime("%y")
-        properties["week"] = now.strftime("%W")
-        properties["month"] = now.strftime("%m")
-        properties["month_name"] = now.strftime("%B")
-        properties["short_month_name"] = now.strftime("%b")
-        properties["day_name"] = now.strftime("%A")
-        properties["short_day_name"] = now.strftime("%a")
-        properties["day_of_year"] = now.strftime("%d")
-        properties["cal_year"] = calendar_date.strftime("%Y")
-        properties["cal_month"] = calendar_date.strftime("%m")
-        properties["cal_month_name"] = calendar_date.strftime("%B")
-        properties["cal_short_month_name"] = calendar_date.strftime("%b")
-        properties["cal_year"] = calendar_date.strftime("%Y")
-        properties["cal_short_year"] = calendar_date.strftime("%y")
-        properties["cal_locale_date"] = calendar_date.strftime("%x")
-        if self._event_days is None or not str(calendar_date.day) in self._event_days:
+        properties.update(self._get_date_properties(now))
+        cal_properties = self._get_date_properties(calendar_date)
+        properties["cal_year"] = cal_properties["year"]
+        properties["cal_month"] = cal_properties["month"]
+        properties["cal_month_name"] = cal_properties["month_name"]
+        properties["cal_short_month_name"] = cal_properties["short_month_name"]
+        properties["cal_short_year"] = cal_properties["short_year"]
+        properties["cal_locale_date"] = cal_properties["locale_date"]
+        if len(self._store.get_events(calendar_date)) == 0:
             properties["message"] = "No events"
             properties["events"] = False
         else:
@@ -419,56 +770,62 @@ class G15Cal(g15plugin.G15Plugin):
             properties["message"] = ""
         return properties
     
-    def _load_month_events(self, now):
-        self._event_days = {}
-        
-        for c in self._page.get_children():
-            if isinstance(c, Cell):
-                pass
-            
-        # Get all the events for this month
-        for acc in self._account_manager.accounts:
-            try:
+    def _request_events(self, now, force = False):
+        """
+        Ask each backend for the events of the month containing the given date
+        and the months either side of it. Only ranges that are no longer fresh
+        (or all of them, if forced) are actually fetched, in the background.
+        Returns True if anything is being fetched.
+        """
+        import gnome15.g15pluginmanager as g15pluginmanager
+        accounts = list(self._account_manager.accounts)
+        self._store.retain_accounts([ acc.name for acc in accounts ])
+        requested = False
+        
+        # The month being shown first, then the months either side
+        for month in [ get_month(now), get_month(now, -1), get_month(now, 1) ]:
+            for acc in accounts:
                 backend = get_backend(acc.type)
                 if backend is None:
                     logger.warn("Could not find a calendar backend for %s", acc.name)
-                else:
-                    # Backends may specify if they need a network or not, so check the state
-                    import gnome15.g15pluginmanager as g15pluginmanager
-                    needs_net = g15pluginmanager.is_needs_network(backend)
-                    if not needs_net or ( needs_net and self.screen.service.network_manager.is_network_available() ):
-                        backend_events = backend.create_backend(acc, self._account_manager).get_events(now)
-                        if backend_events is None:
-                            logger.warning("Calendar returned no events, skipping")
-                        else:
-                            self._event_days = dict(self._event_days.items() + \
-                                                    backend_events.items())
-                    else:
-                        logger.warn("Skipping backend %s because it requires the network, " \
-                                    "and the network is not availabe", acc.type)
-            except Exception as e:
-                logger.warn("Failed to load events for account %s.", acc.name, exc_info = e)
-                    
-        g15screen.run_on_redraw(self._rebuild_components, now)
-        self._page.mark_dirty()
+                    continue
+                
+                # Backends may specify if they need a network or not, so check the state
+                needs_net = g15pluginmanager.is_needs_network(backend)
+                if needs_net and not self.screen.service.network_manager.is_network_available():
+                    logger.debug("Skipping backend %s because it requires the network, " \
+                                 "and the network is not availabe", acc.type)
+                    continue
+                
+                lifetime = getattr(backend, "REFRESH_INTERVAL", REFRESH_INTERVAL)
+                loader = self._get_loader(backend, acc)
+                if self._store.request(acc.name, month, loader, lifetime, self._events_changed, force):
+                    requested = True
+        return requested
+    
+    def _get_loader(self, backend, account):
+        def loader(date):
+            return backend.create_backend(account, self._account_manager).get_events(date)
+        return loader
+    
+    def _events_changed(self, month):
+        if self._active and month == get_month(self._get_calendar_date()):
+            g15screen.run_on_redraw(self._rebuild_components, self._get_calendar_date())
         
     def _rebuild_components(self, now):
         self._menu.remove_all_children()
-        if str(now.day) in self._event_days:
-            events = self._event_days[str(now.day)]
-            i = 0
-            for event in events:
-                self._menu.add_child(EventMenuItem(self, event, "menuItem-%d" % i))
-                i += 1
+        i = 0
+        for event in self._store.get_events(now):
+            self._menu.add_child(EventMenuItem(self, event, "menuItem-%d" % i))
+            i += 1
             
         # Add the date cell components
         self._calendar.remove_all_children()
         cal = calendar.Calendar()
         i = 0
         for day in cal.itermonthdates(now.year, now.month):
-            event = None
-            if str(day.day) in self._event_days:
-                event = self._event_days[str(day.day)][0]            
+            events = self._store.get_events(day)
+            event = events[0] if len(events) > 0 else None
             self._calendar.add_child(Cell(day, now, event, "cell-%d" % i))
             i += 1
             
@@ -495,17 +852,15 @@ class G15Cal(g15plugin.G15Plugin):
             self._timer.cancel()
         
     def _redraw(self):
-        t = time.time()
-        if t > self._loaded + REFRESH_INTERVAL:
-            self._loaded = t    
-            self._reload_events_now()
+        if self._loaded == 0:
+            # First load, or something changed that means everything must be fetched again
+            self._loaded = time.time()
+            self._request_events(self._get_calendar_date(), True)
+            g15screen.run_on_redraw(self._rebuild_components, self._get_calendar_date())
         else:
-            self._page.mark_dirty()
-            self.screen.redraw(self._page)
-            self._schedule_redraw()
-            
-    def _reload_events_now(self):
-        self._load_month_events(self._get_calendar_date())
+            # Anything that has gone stale is fetched in the background
+            self._request_events(self._get_calendar_date())
+        self._page.mark_dirty()
         self.screen.redraw(self._page)
         self._schedule_redraw()
     
@@ -30,7 +30,10 @@ import gnome15.util.g15icontools as g15icontools
 import gnome15.g15theme as g15theme
 import gnome15.g15driver as g15driver
 import gnome15.g15plugin as g15plugin
+import gnome15.g15screen as g15screen
+import bisect
 import dbus
+from threading import RLock
 import telepathy
 from telepathy.interfaces import (
         CHANNEL,
@@ -76,6 +79,10 @@ actions={
 POSSIBLE_ICON_NAMES = [ "im-user", "empathy", "pidgin", "emesene", "system-config-users", "im-message-new" ]
 CONNECTION_PRESENCE_TYPE_OFFLINE = 1
 
+# Contact additions and presence changes arriving within this many seconds
+# of each other are applied to the menu together
+UPDATE_TICK = 0.25
+
 IMAGE_DIR = 'images'
 STATUS_MAP = {
         ( CONNECTION_PRESENCE_TYPE_OFFLINE, None ): [ [ "offline", "user-offline-panel" ] , _("Offline")],
@@ -218,6 +225,7 @@ class ContactMenuItem(g15theme.MenuItem):
         self.contact=  contact
         self.presence = presence
         self.alias = alias  
+        self.sort_key = None
         
     def get_theme_properties(self):
         """
@@ -267,21 +275,11 @@ class ContactMenuItem(g15theme.MenuItem):
         return "dialog-warning"   
         
 """
-Compare a single contact based on it's alias and presence
+Sort key for a single contact based on it's presence and alias. The item ID
+is included so every contact has a unique key
 """
-def compare_contacts(a, b):
-    if ( a is None and b is not None ):
-        val = 1
-    elif ( b is None and a is not None ):
-        val = -1
-    elif ( b is None and a is  None ):
-        val = 0
-    else:
-        val = cmp(a.presence[0], b.presence[0])
-        if val == 0:
-            val = cmp(a.alias, b.alias)
-        
-    return val
+def contact_sort_key(item):
+    return ( item.presence[0], item.alias, item.id )
     
 """
 Theme menu for displaying all contacts across all monitored
@@ -303,7 +301,12 @@ class ContactMenu(g15theme.Menu):
         self.on_update = None
         if not self.mode:
             self.mode = MODE_ONLINE
-        self._contacts = []
+        self._lock = RLock()
+        self._contacts = {}
+        self._visible = []
+        self._visible_keys = []
+        self._update_timer = None
+        self._update_selected = None
         self._contact_lists = {}
         self._connections = []
         for connection in telepathy.client.Connection.get_connections():
@@ -318,7 +321,16 @@ class ContactMenu(g15theme.Menu):
                 c._status_changed_connection = None
         self._connections = []
         self._contact_lists = {}
-        self._contacts = []
+        self._lock.acquire()
+        try:
+            if self._update_timer is not None:
+                self._update_timer.cancel()
+                self._update_timer = None
+            self._contacts = {}
+            self._visible = []
+            self._visible_keys = []
+        finally:
+            self._lock.release()
             
     def new_connection(self, bus_name, bus):
         """
@@ -344,12 +356,15 @@ class ContactMenu(g15theme.Menu):
             if connection.service_name == bus_name:
                 del self._contact_lists[connection]
                 self._connections.remove(connection)
-                for item in list(self._contacts):
-                    if item.conn == connection:
-                        self._contacts.remove(item)
-                self.reload()
-                if self.on_update:
-                    self.on_update()
+                self._lock.acquire()
+                try:
+                    for key, item in self._contacts.items():
+                        if item.conn == connection:
+                            self._hide(item)
+                            del self._contacts[key]
+                finally:
+                    self._lock.release()
+                self._queue_update()
                 return
             
     def is_connected(self, bus_name):
@@ -371,11 +386,20 @@ class ContactMenu(g15theme.Menu):
         contacts that are appropriate for the current mode will be added
         """
         logger.debug("Reloading contacts")
-        c = []
-        for item in self._contacts:
-            if self._is_presence_included(item.presence):
-                c.append(item)
-        self.sort_items(c)
+        self._lock.acquire()
+        try:
+            c = []
+            for item in self._contacts.values():
+                if self._is_presence_included(item.presence):
+                    item.sort_key = contact_sort_key(item)
+                    c.append(item)
+            c.sort(key = lambda item: item.sort_key)
+            self._visible = c
+            self._visible_keys = [ item.sort_key for item in c ]
+            children = list(c)
+        finally:
+            self._lock.release()
+        self.set_children(children)
         self.select_first()
         self.mark_dirty()
         
@@ -383,11 +407,12 @@ class ContactMenu(g15theme.Menu):
         """
         Sort items based on their alias and presence
         """
-        self.set_children(sorted(children, cmp=compare_contacts))
+        self.set_children(sorted(children, key = contact_sort_key))
 
     def add_contact(self, conn, handle, contact, presence, alias):
         """
-        Add a new contact to the menu
+        Add a new contact to the menu. The menu itself is updated a short time
+        later, along with any other contacts added or changed in the meantime.
         
         Keyword arguments:
         conn -- connection
@@ -396,31 +421,42 @@ class ContactMenu(g15theme.Menu):
         alias - alias or real name 
         """
         item = ContactMenuItem(conn, handle, contact, presence, alias)
-        self._contacts.append(item)
-        self.reload()
-        if self.on_update:
-            self.on_update()
+        self._lock.acquire()
+        try:
+            existing = self._contacts.get(( conn, handle ))
+            if existing is not None:
+                self._hide(existing)
+            self._contacts[( conn, handle )] = item
+            self._show(item)
+        finally:
+            self._lock.release()
+        self._queue_update()
 
     def update_contact_presence(self, conn, handle, presence):
         """
-        Update a contact's presence in the list and reload
+        Update a contact's presence in the list. The menu itself is updated a 
+        short time later, along with any other contacts added or changed in the 
+        meantime.
         
         Keyword arguments:
         conn -- connection
         handle -- contact handle
         prescence -- presence object
         """
-        for row in self._contacts:
-            if row.handle == handle and row.conn == conn:
-                logger.debug("Updating presence of %s to %s", str(row.contact), str(presence))
-                row.set_presence(presence)
-                self.selected = row
-                self.reload()
-                if self.on_update:
-                    self.on_update()
+        self._lock.acquire()
+        try:
+            row = self._contacts.get(( conn, handle ))
+            if row is None:
+                logger.warning("Got presence update for unknown contact %s", str(presence))
                 return
-        logger.warning("Got presence update for unknown contact %s", str(presence))
-    
+            logger.debug("Updating presence of %s to %s", str(row.contact), str(presence))
+            self._hide(row)
+            row.set_presence(presence)
+            self._show(row)
+            self._update_selected = row
+        finally:
+            self._lock.release()
+        self._queue_update()
         
     '''
     Private
@@ -437,6 +473,55 @@ class ContactMenu(g15theme.Menu):
         self._contact_lists[connection] = ContactList(self, connection, self.screen)
         self._connections.append(connection)
             
+    def _show(self, item):
+        """
+        Insert a contact into the sorted list of visible contacts if its
+        presence is appropriate for the current mode. Must be called with the
+        lock held.
+        """
+        if self._is_presence_included(item.presence):
+            item.sort_key = contact_sort_key(item)
+            i = bisect.bisect_left(self._visible_keys, item.sort_key)
+            self._visible_keys.insert(i, item.sort_key)
+            self._visible.insert(i, item)
+            
+    def _hide(self, item):
+        """
+        Remove a contact from the sorted list of visible contacts (if it is 
+        there). Must be called with the lock held.
+        """
+        if item.sort_key is not None:
+            i = bisect.bisect_left(self._visible_keys, item.sort_key)
+            if i < len(self._visible) and self._visible[i] is item:
+                del self._visible_keys[i]
+                del self._visible[i]
+            
+    def _queue_update(self):
+        self._lock.acquire()
+        try:
+            if self._update_timer is None:
+                self._update_timer = g15scheduler.schedule("ContactMenuUpdate", UPDATE_TICK, g15screen.run_on_redraw, self._do_update)
+        finally:
+            self._lock.release()
+            
+    def _do_update(self):
+        """
+        Apply all of the contact changes made since the last update to the menu
+        in one go
+        """
+        self._lock.acquire()
+        try:
+            self._update_timer = None
+            children = list(self._visible)
+            selected = self._update_selected
+            self._update_selected = None
+        finally:
+            self._lock.release()
+        self.set_children(children, selected = selected)
+        self.mark_dirty()
+        if self.on_update:
+            self.on_update()
+            
     def _is_presence_included(self, presence):
         """
         Determine if presence is appropriate for the current mode
@@ -21,6 +21,7 @@ import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15os as g15os
 import gnome15.g15driver as g15driver
 import gnome15.g15theme as g15theme
+import impulseanalyser
 import gobject
 import gtk
 import os
@@ -115,16 +116,28 @@ class G15ImpulsePainter(g15screen.Painter):
         self.plugin = plugin
         self.last_sound = datetime.datetime.now()
         
-    def do_lights(self, audio_sample_array = None):     
-        if not audio_sample_array:
-            audio_sample_array = self._get_sample()
+    def sample(self):
+        """
+        Take a snapshot from libimpulse, analyse it and update the lights. 
+        Returns False if the snapshot has not changed since the last sample,
+        meaning there is nothing new to paint.
+        """
+        fft = self.theme_module is not None and getattr(self.theme_module, "fft", False)
+        analyser = self.plugin.analyser
+        if not analyser.update(impulse.getSnapshot( fft )):
+            return False
+        self.do_lights()
+        if analyser.level > 0:
+            self.last_sound = datetime.datetime.now()
+        return True
         
+    def do_lights(self):
+        analyser = self.plugin.analyser
         if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        tot_avg = self._tot_avg(audio_sample_array)
+            self.backlight_acquisition.set_value(analyser.colour)
         if self.mkey_acquisition is not None:
-            self._set_mkey_lights(tot_avg)
-        return tot_avg
+            self._set_mkey_lights(analyser.level)
+        return analyser.level
     
     def is_idle(self):
         return datetime.datetime.now() > ( self.last_sound + datetime.timedelta(0, 5.0) )
@@ -132,53 +145,13 @@ class G15ImpulsePainter(g15screen.Painter):
     def paint(self, canvas):
         if not self.theme_module: 
             return
-        audio_sample_array = self._get_sample()
-        tot_avg = self.do_lights(audio_sample_array)
-        if tot_avg > 0:
-            self.last_sound = datetime.datetime.now()
-        
         canvas.save()
-        self.theme_module.on_draw( audio_sample_array, canvas, self.plugin )
+        self.theme_module.on_draw( self.plugin.analyser.samples, canvas, self.plugin )
         canvas.restore()
         
     """
     Private
     """
-    
-    def _get_sample(self):
-        fft = False
-        if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
-            fft = True
-
-        audio_sample_array = impulse.getSnapshot( fft )
-        if self.plugin.gain != 1:
-            arr = []
-            for a in audio_sample_array:
-                arr.append(a * self.plugin.gain)
-            audio_sample_array = arr
-        
-        return audio_sample_array
-    
-    def _col_avg(self, list):
-        cols = []
-        each = len(list) / 3
-        z = 0
-        for j in range(0, 3):
-            t = 0
-            for x in range(0, each):
-                t += min(255, list[z] * 340)
-                z += 1
-            cols.append(int(t / each))
-        return ( cols[0], cols[1], cols[2] )
-    
-    def _tot_avg(self, list):
-        sz = len(list)
-        z = 0
-        t = 0
-        for x in range(0, sz):
-            t += min(255, list[z] * 340)
-            z += 1
-        return t / sz
                   
     def _set_mkey_lights(self, val):
         if val > 200:
@@ -212,6 +185,7 @@ class G15Impulse():
         self.last_paint = None
         self.audio_source_index = 0
         self.config_change_timer = None
+        self.analyser = impulseanalyser.G15ImpulseAnalyser()
 
         import impulse
         sys.modules[ __name__ ].impulse = impulse
@@ -264,30 +238,8 @@ class G15Impulse():
     def destroy(self):
         pass
     
-    def paint(self, canvas):
-        if not self.theme_module: 
-            return
-
-        fft = False
-        if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
-            fft = True
-
-        audio_sample_array = impulse.getSnapshot( fft )
-        
-        if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        
-        if self.mkey_acquisition is not None:
-            self._set_mkey_lights(self._tot_avg(audio_sample_array))
-        
-        canvas.save()
-        self.theme_module.on_draw( audio_sample_array, canvas, self )
-        canvas.restore()
-    
-    def redraw(self):        
-        if self.screen.driver.get_bpp() == 0:
-            self.painter.do_lights()
-        else:
+    def redraw(self):
+        if self.painter.sample() and self.screen.driver.get_bpp() != 0:
             if self.paint_mode == "screen" and self.visible:
                 self.screen.redraw(self.page, queue = False)
             elif self.paint_mode != "screen": 
@@ -337,6 +289,8 @@ class G15Impulse():
         self.disco = g15gconf.get_bool_or_default(self.gconf_client, self.gconf_key + "/disco", False)
         self.refresh_interval = 1.0 / g15gconf.get_float_or_default(self.gconf_client, self.gconf_key + "/frame_rate", 25.0)
         self.gain = g15gconf.get_float_or_default(self.gconf_client, self.gconf_key + "/gain", 1.0)
+        self.analyser.gain = self.gain
+        self.analyser.reset()
         logger.info("Refresh interval is %f", self.refresh_interval)
         self.animate_mkeys = g15gconf.get_bool_or_default(self.gconf_client, self.gconf_key + "/animate_mkeys", False)
         if self.mode == None or self.mode == "" or self.mode == "spectrum" or self.mode == "scope":
@@ -361,8 +315,6 @@ class G15Impulse():
         self.spacing = self.gconf_client.get_int(self.gconf_key + "/spacing")
         self.col1 = g15gconf.get_cairo_rgba_or_default(self.gconf_client, self.gconf_key + "/col1", ( 255, 0, 0, 255 ))
         self.col2 = g15gconf.get_cairo_rgba_or_default(self.gconf_client, self.gconf_key + "/col2", ( 0, 0, 255, 255 ))
-            
-        self.peak_heights = [ 0 for i in range( self.bars ) ]
 
         paint = self.gconf_client.get_string(self.gconf_key + "/paint")
         if paint != self.last_paint and self.screen.driver.get_bpp() != 0: 
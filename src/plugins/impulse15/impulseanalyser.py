@@ -0,0 +1,122 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Array based analysis of the audio snapshots returned by libimpulse. A single
+G15ImpulseAnalyser is shared by the painter and all of the themes, so each
+snapshot is scaled, binned and averaged once, no matter how many times it is
+drawn.
+"""
+
+import numpy
+
+# Multiplier used to turn a normalised sample into a 0-255 light level
+LEVEL_SCALE = 340.0
+
+class G15ImpulseAnalyser():
+
+    def __init__(self):
+        self.gain = 1.0
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the last snapshot, so the next call to update() always
+        produces new results (used when the configuration changes)
+        """
+        self.revision = 0
+        self.samples = numpy.zeros(256)
+        self.level = 0.0
+        self.colour = ( 0, 0, 0 )
+        self._snapshot = None
+        self._bands = {}
+
+    def update(self, snapshot):
+        """
+        Analyse a new snapshot. Returns False if the snapshot is identical to the
+        previous one, in which case nothing is recalculated.
+
+        Keyword arguments:
+        snapshot        -- sequence of samples as returned by impulse.getSnapshot()
+        """
+        if snapshot == self._snapshot:
+            return False
+        self._snapshot = snapshot
+
+        samples = numpy.array(snapshot, dtype = numpy.float64)
+        if self.gain != 1:
+            samples *= self.gain
+        self.samples = samples
+        self._bands = {}
+
+        levels = numpy.minimum(samples * LEVEL_SCALE, 255.0)
+        self.level = float(levels.mean()) if len(levels) > 0 else 0.0
+        each = len(levels) // 3
+        if each > 0:
+            self.colour = tuple(int(c) for c in levels[:each * 3].reshape(3, each).mean(axis = 1))
+        else:
+            self.colour = ( 0, 0, 0 )
+
+        self.revision += 1
+        return True
+
+    def bands(self, count):
+        """
+        Get the samples reduced to (at most) the given number of bands. The band
+        values are the first sample in each bin, which is what the themes have
+        always drawn. Results are cached until the next snapshot.
+
+        Keyword arguments:
+        count           -- number of bands required
+        """
+        bands = self._bands.get(count)
+        if bands is None:
+            step = max(1, len(self.samples) // max(1, count))
+            bands = self.samples[::step]
+            self._bands[count] = bands
+        return bands
+
+class G15PeakHold():
+    """
+    Falling peak markers for a set of bands. The peaks only move once per
+    analysed snapshot, however many times the owning theme is painted.
+    """
+
+    def __init__(self, decay = 0.1):
+        self.decay = decay
+        self.heights = numpy.zeros(0)
+        self._acceleration = numpy.zeros(0)
+        self._revision = -1
+
+    def update(self, values, revision):
+        """
+        Update the peaks with the current band values, returning the peak heights.
+
+        Keyword arguments:
+        values          -- numpy array of the current band values
+        revision        -- revision of the analyser the values were taken from
+        """
+        if revision == self._revision and len(values) == len(self.heights):
+            return self.heights
+        self._revision = revision
+        if len(values) != len(self.heights):
+            self.heights = numpy.zeros(len(values))
+            self._acceleration = numpy.zeros(len(values))
+
+        rising = values > self.heights
+        self._acceleration = numpy.where(rising, 0.0, self._acceleration + self.decay)
+        self.heights = numpy.maximum(numpy.where(rising, values, self.heights - self._acceleration), 0.0)
+        return self.heights
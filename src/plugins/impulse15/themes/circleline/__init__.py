@@ -1,4 +1,5 @@
 import math
+import numpy
 
 fft=True
 
@@ -18,8 +19,6 @@ def on_after_set_attribute ( self, name, value, screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
-
 	width, height = ( screenlet.width, screenlet.height )
 
 	co = screenlet.col1
@@ -31,26 +30,21 @@ def on_draw( audio_sample_array, cr, screenlet ):
 
 	h = screenlet.bar_height
 
-	fx = 0
-	fy = 0
-
-	for i in range( 0, l, l / n_bars ):
-
-		bar_amp_norm = audio_sample_array[ i ]
-
-		bar_height = bar_amp_norm * 100
-
-
-		a = ( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) )
+	# Work out all of the points at once, then just trace them
+	bands = screenlet.analyser.bands( n_bars )
+	a = ( math.pi*2 / n_bars ) * numpy.arange( len( bands ) )
+	r = h + bands * 100
+	xs = ( numpy.sin( a ) * r + width / 2 ).tolist()
+	ys = ( numpy.cos( a ) * r + height / 2 ).tolist()
 
-		x = ( math.sin( a ) * ( h + bar_height ) + width / 2 ) 
-		y = ( math.cos( a ) * ( h + bar_height ) + height / 2 )
+	if not xs:
+		return
 
-		if not i:
-			fx = x
-			fy = y
-			cr.move_to( x, y )
+	fx = xs[ 0 ]
+	fy = ys[ 0 ]
+	cr.move_to( fx, fy )
 
+	for x, y in zip( xs, ys ):
 		cr.curve_to(
 			x, y,
 			x, y,
@@ -5,8 +5,6 @@ def load_theme( screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
-
 	width, height = ( screenlet.width, screenlet.height )
 
 	# start drawing spectrum
@@ -17,28 +15,26 @@ def on_draw( audio_sample_array, cr, screenlet ):
 	bar_spacing = screenlet.spacing
 	
 	
-	freq = len( audio_sample_array ) / n_bars
+	freq = max( 1, len( audio_sample_array ) / n_bars )
 	actual_cols = ( len( audio_sample_array ) / freq ) + 1
 	total_width = ( actual_cols * ( bar_width + bar_spacing ) ) - bar_spacing
 	cr.translate( ( screenlet.width - total_width ) / 2, 0)
 
-	for i in range( 0, l, l / n_bars ):
-
-		bar_amp_norm = audio_sample_array[ i ]
+	bands = screenlet.analyser.bands( n_bars )
+	bar_heights = ( bands * height + 2 ) * ( screenlet.bar_height / 10.0 )
+	fill_color = screenlet.col1
+	stroke_color = screenlet.col2
 
-		bar_height = ( bar_amp_norm * height + 2 ) * ( screenlet.bar_height / 10.0 )
+	for i, bar_height in enumerate( bar_heights.tolist() ):
 
 		cr.rectangle(
-			( bar_width + bar_spacing ) * ( i / ( l / n_bars ) ),
+			( bar_width + bar_spacing ) * i,
 			height / 2 - bar_height / 2,
 			bar_width,
 			bar_height
 		)
 		
-		co = screenlet.col1
-		cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
+		cr.set_source_rgba( fill_color[ 0 ], fill_color[ 1 ], fill_color[ 2 ], fill_color[ 3 ] )
 		cr.fill_preserve()
-		co = screenlet.col2
-		cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
+		cr.set_source_rgba( stroke_color[ 0 ], stroke_color[ 1 ], stroke_color[ 2 ], stroke_color[ 3 ] )
 		cr.stroke()
-
@@ -21,6 +21,7 @@ import gnome15.util.g15convert as g15convert
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15cairo as g15cairo
 import gnome15.util.g15icontools as g15icontools
+import gnome15.util.jobqueue as jobqueue
 import gnome15.g15theme as g15theme
 import gnome15.g15driver as g15driver
 import gnome15.g15plugin as g15plugin
@@ -30,6 +31,11 @@ import os, os.path
 import pwd
 import gtk
 import re
+import time
+import socket
+from ssl import wrap_socket
+from threading import RLock
+from threading import Event
 from poplib import POP3_SSL
 from poplib import POP3
 from imaplib import IMAP4
@@ -69,6 +75,17 @@ TYPES = [ PROTO_POP3, PROTO_IMAP ]
 CONFIG_PATH = os.path.join(g15globals.user_config_dir, "plugin-data" , "lcdbiff", "mailboxes.xml")
 CONFIG_ITEM_NAME = "mailbox"
 
+# Maximum number of accounts checked at the same time
+CHECK_WORKERS = 4
+
+# Time allowed for an account to be checked (seconds)
+CHECK_TIMEOUT = 30.0
+
+# Accounts that fail are not checked again for a while, starting at
+# BACKOFF_MIN seconds and doubling on each failure up to BACKOFF_MAX
+BACKOFF_MIN = 60.0
+BACKOFF_MAX = 3600.0
+
 def create(gconf_key, gconf_client, screen):
     return G15Biff(gconf_client, gconf_key, screen)
 
@@ -84,14 +101,49 @@ def get_update_time(gconf_client, gconf_key):
         val = 10
     return val
 
+'''
+IMAP connections that give up if the server stops responding, rather than
+holding up the checker thread forever. Connections may be kept open for a
+long time, so this matters for reads as well as connecting
+'''
+class TimeoutIMAP4(IMAP4):
+    
+    def __init__(self, host, port, timeout):
+        self.timeout = timeout
+        IMAP4.__init__(self, host, port)
+        
+    def open(self, host = "", port = 143):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), self.timeout)
+        self.file = self.sock.makefile("rb")
+        
+class TimeoutIMAP4_SSL(IMAP4_SSL):
+    
+    def __init__(self, host, port, timeout):
+        self.timeout = timeout
+        IMAP4_SSL.__init__(self, host, port)
+        
+    def open(self, host = "", port = 993):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), self.timeout)
+        self.sslobj = wrap_socket(self.sock, self.keyfile, self.certfile)
+        self.file = self.sslobj.makefile("rb")
+
 '''
 Abstract mail checker. Subclasses are responsible for connecting
-to mail stores and retrieving the number of unread messages.
+to mail stores and retrieving the number of unread messages. Passwords
+that have worked are remembered for the rest of the session, so the
+keyring is only consulted again if one stops working.
 '''
 class Checker():
     
-    def __init__(self, account_manager):
+    def __init__(self, account_manager, timeout = CHECK_TIMEOUT):
         self.account_manager = account_manager
+        self.timeout = timeout
+        self._passwords = {}
+        self._lock = RLock()
     
     def get_username(self, account):
         username = account.get_property("username", "")
@@ -112,16 +164,40 @@ class Checker():
     def save_password(self, account, password, default_port):    
         hostname = self.get_hostname(account)
         port = self.get_port_or_default(account, default_port)
-        self.account_manager.store_password(account, password, hostname, port)
+        key = self._get_password_key(account, default_port)
+        if self._passwords.get(key) != password:
+            self.account_manager.store_password(account, password, hostname, port)
+            self._passwords[key] = password
     
     def get_password(self, account, default_port, force_dialog = False):        
+        key = self._get_password_key(account, default_port)
+        if force_dialog:
+            self._passwords.pop(key, None)
+        elif key in self._passwords:
+            return self._passwords[key]
         hostname = self.get_hostname(account)
         port = self.get_port_or_default(account, default_port)
         return self.account_manager.retrieve_password(account, hostname, port, force_dialog)
     
+    def close(self):
+        '''
+        Close any connections that are being kept open
+        '''
+        pass
+    
+    def _get_password_key(self, account, default_port):
+        return ( account.name, self.get_username(account), self.get_hostname(account), \
+                 self.get_port_or_default(account, default_port) )
+    
+    def _set_timeout(self, client):
+        for sock in [ getattr(client, "sock", None), getattr(client, "sslobj", None) ]:
+            if sock is not None and hasattr(sock, "settimeout"):
+                sock.settimeout(self.timeout)
+    
 '''
 POP3 checker. Does the actual work of checking for emails using
-the POP3 protocol.
+the POP3 protocol. POP3 servers lock the mailbox and only report the
+messages present at login, so a new connection is made for each check.
 '''
 class POP3Checker(Checker):    
     
@@ -135,8 +211,9 @@ class POP3Checker(Checker):
         port = self.get_port_or_default(account, default_port)
         if ssl:
             pop = POP3_SSL(self.get_hostname(account), port)
+            self._set_timeout(pop)
         else:
-            pop = POP3(self.get_hostname(account), port, 7.0)
+            pop = POP3(self.get_hostname(account), port, self.timeout)
         try :
             username = self.get_username(account)
             for i in range(0, 3):
@@ -162,28 +239,42 @@ class POP3Checker(Checker):
     
 '''
 IMAP checker. Does the actual work of checking for emails using
-the IMAP protocol.
+the IMAP protocol. Once logged in, the connection is kept open and
+each check is just a NOOP and a STATUS request. If anything goes wrong
+with a kept connection, it is dropped and a new one made.
 '''
 class IMAPChecker(Checker):   
      
     def __init__(self, account_manager):
         Checker.__init__(self, account_manager)
+        self._connections = {}
     
     def check(self, account):
         ssl = account.get_property("ssl", "false")
         folder = account.get_property("folder", "INBOX")
         default_port = 993 if ssl else 143
         port = self.get_port_or_default(account, default_port)
-        count = ( 0, 0 )
         username = self.get_username(account)
+        key = ( self.get_hostname(account), port, ssl, username )
+        
+        imap = self._get_connection(account, key)
+        if imap is not None:
+            try :
+                imap.noop()
+                return ( self._get_unseen(imap, folder), 0 )
+            except Exception as e:
+                logger.debug("Kept connection for %s failed, reconnecting", account.name, exc_info = e)
+                self._close_connection(account.name)
+        
         for i in range(0, 3):
             
             for j in range(0, 2):
                 if ssl:
-                    imap = IMAP4_SSL(self.get_hostname(account), port)
+                    imap = TimeoutIMAP4_SSL(self.get_hostname(account), port, self.timeout)
                 else:
-                    imap = IMAP4(self.get_hostname(account), port)
+                    imap = TimeoutIMAP4(self.get_hostname(account), port, self.timeout)
                 
+                keep = False
                 try :
                     password = self.get_password(account, default_port, i > 0)
                     if password == None or password == "":
@@ -195,17 +286,69 @@ class IMAPChecker(Checker):
                         else:
                             imap.login_cram_md5(username, password)                         
                         self.save_password(account, password, default_port) 
-                        status = imap.status(folder, "(UNSEEN)")
-                        unread  = int(re.search("UNSEEN (\d+)", status[1][0]).group(1))      
-                        count = ( unread, count )
-                        return count 
+                        unread = self._get_unseen(imap, folder)
+                        self._keep_connection(account.name, key, imap)
+                        keep = True
+                        return ( unread, 0 )
                     except Exception as e:
                         logger.debug("Error while checking", exc_info = e)
                           
                 finally:
-                    imap.logout()   
+                    if not keep:
+                        self._logout(imap)
             
-        return count
+        return ( 0, 0 )
+    
+    def close(self):
+        self._lock.acquire()
+        try :
+            connections = self._connections
+            self._connections = {}
+        finally :
+            self._lock.release()
+        for key, imap in connections.values():
+            self._logout(imap)
+    
+    def _get_unseen(self, imap, folder):
+        status = imap.status(folder, "(UNSEEN)")
+        return int(re.search("UNSEEN (\d+)", status[1][0]).group(1))
+    
+    def _get_connection(self, account, key):
+        self._lock.acquire()
+        try :
+            connection = self._connections.get(account.name)
+        finally :
+            self._lock.release()
+        if connection is not None and connection[0] != key:
+            # Account settings changed
+            self._close_connection(account.name)
+            return None
+        return connection[1] if connection is not None else None
+    
+    def _keep_connection(self, name, key, imap):
+        self._lock.acquire()
+        try :
+            old = self._connections.get(name)
+            self._connections[name] = ( key, imap )
+        finally :
+            self._lock.release()
+        if old is not None and old[1] is not imap:
+            self._logout(old[1])
+    
+    def _close_connection(self, name):
+        self._lock.acquire()
+        try :
+            connection = self._connections.pop(name, None)
+        finally :
+            self._lock.release()
+        if connection is not None:
+            self._logout(connection[1])
+    
+    def _logout(self, imap):
+        try :
+            imap.logout()
+        except Exception as e:
+            logger.debug("Error logging out", exc_info = e)
 
     
 '''
@@ -312,6 +455,11 @@ class MailItem(g15theme.MenuItem):
         self.error = None
         self.plugin = plugin
         self.refreshing = False
+        self.checking = False
+        self.checked = Event()
+        self.failures = 0
+        self.next_check = 0
+        self.latency = None
         
     def get_theme_properties(self):        
         item_properties = g15theme.MenuItem.get_theme_properties(self)       
@@ -324,6 +472,7 @@ class MailItem(g15theme.MenuItem):
             else:
                 item_properties["item_alt"] = _("None")
         item_properties["item_type"] = ""
+        item_properties["item_latency"] = "%dms" % ( self.latency * 1000 ) if self.latency is not None else ""
         
         if self.refreshing:
             if self.plugin.screen.driver.get_bpp() == 1:
@@ -376,6 +525,7 @@ class G15Biff(g15plugin.G15MenuPlugin):
         self.account_manager = g15accounts.G15AccountManager(CONFIG_PATH, CONFIG_ITEM_NAME)
         self.account_manager.add_change_listener(self)
         self.checkers = { PROTO_POP3 : POP3Checker(self.account_manager), PROTO_IMAP: IMAPChecker(self.account_manager) }
+        self.check_queue = jobqueue.JobQueue(number_of_workers = CHECK_WORKERS, name = "lcdbiff-check-%s" % self.screen.device.uid)
         if self.screen.driver.get_bpp() > 0:
             g15plugin.G15MenuPlugin.activate(self)
         self.update_time_changed_handle = self.gconf_client.notify_add(self.gconf_key + "/update_time", self._update_time_changed)
@@ -389,13 +539,19 @@ class G15Biff(g15plugin.G15MenuPlugin):
         if self.refresh_timer:
             self.refresh_timer.cancel()
             self.refresh_timer.task_queue.stop()
+        self.check_queue.stop()
+        for checker in self.checkers.values():
+            checker.close()
         self.gconf_client.notify_remove(self.update_time_changed_handle)
         
     def action_performed(self, binding):
         if binding.action == g15driver.VIEW:
             if self.refresh_timer:
                 self.refresh_timer.cancel()
-            self.refresh()
+            # Asked for explicitly, so check failed accounts too
+            for item in self.items:
+                item.next_check = 0
+            self.schedule_refresh(0.0)
         
     def load_menu_items(self):
         items = []
@@ -422,23 +578,42 @@ class G15Biff(g15plugin.G15MenuPlugin):
         self.refresh_timer = g15scheduler.queue("lcdbiff-%s" % self.screen.device.uid, "MailRefreshTimer", time, self.refresh)
         
     def refresh(self):
+        '''
+        Check all accounts at the same time, waiting at most CHECK_TIMEOUT
+        seconds. Accounts that are backing off after failures, or are still
+        busy with a previous check, are skipped and keep their last status
+        '''
+        now = time.time()
+        pending = []
+        for item in self.items:
+            if item.checking or now < item.next_check:
+                continue
+            item.checking = True
+            item.refreshing = True
+            item.checked.clear()
+            pending.append(item)
+            
+        if len(pending) > 0:
+            if self.page is not None:
+                self.page.redraw()
+            for item in pending:
+                self.check_queue.run(None, self._check_item, item)
+            deadline = now + CHECK_TIMEOUT
+            for item in pending:
+                if not item.checked.wait(max(0, deadline - time.time())):
+                    logger.warning("Timed out checking %s", item.account.name)
+                    item.refreshing = False
+                    item.error = Exception(_("Timed out"))
+                    item.count = 0
+                    # The check carries on until its socket times out, it will back off then
+                    
         t_count = 0
         t_errors = 0
         for item in self.items:
-            try :
-                item.refreshing = True
-                self.page.redraw()
-                status = self._check_account(item.account)
-                item.count  = status[0]
-                t_count += item.count
-                item.error = None
-                item.refreshing = False
-            except Exception as e:
-                item.refreshing = False
+            if item.error is not None:
                 t_errors += 1
-                item.error = e
-                item.count = 0
-                logger.debug("Error while refreshing item %s", str(item), exc_info = e)
+            else:
+                t_count += item.count
                 
         self.total_count = t_count
         self.total_errors = t_errors
@@ -471,15 +646,50 @@ class G15Biff(g15plugin.G15MenuPlugin):
             
         self.schedule_refresh()
     
+    def get_check_latencies(self):
+        '''
+        Get how long the last check of each account took (in seconds), keyed
+        by account name. Accounts not yet checked are not included
+        '''
+        return dict([ ( item.account.name, item.latency ) for item in self.items if item.latency is not None ])
+    
     '''
     Private
     '''
     def _accounts_changed(self, account_manager):
+        for checker in self.checkers.values():
+            checker.close()
         self._reload_menu()
         self.schedule_refresh()
         
     def _check_account(self, account):
         return self.checkers[account.type].check(account)
+    
+    def _check_item(self, item):
+        started = time.time()
+        try :
+            status = self._check_account(item.account)
+            item.count = status[0]
+            item.error = None
+            item.failures = 0
+            item.next_check = 0
+        except Exception as e:
+            item.error = e
+            item.count = 0
+            self._backoff(item)
+            logger.debug("Error while refreshing item %s", str(item), exc_info = e)
+        finally:
+            item.latency = time.time() - started
+            item.refreshing = False
+            item.checking = False
+            item.checked.set()
+        logger.debug("Checked %s in %.3f seconds", item.account.name, item.latency)
+        
+    def _backoff(self, item):
+        item.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** ( item.failures - 1 ))
+        item.next_check = time.time() + delay
+        logger.info("Not checking %s again for %d seconds", item.account.name, delay)
         
     def _start_blink(self):
         if not self.light_control:
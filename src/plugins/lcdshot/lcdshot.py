@@ -25,15 +25,15 @@ import gnome15.g15globals as g15globals
 import gnome15.g15actions as g15actions
 import os.path
 import gtk
-import gobject
 import gnome15.util.g15convert as g15convert
 import gnome15.g15notify as g15notify
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15os as g15os
-import gnome15.util.g15cairo as g15cairo
 import subprocess
-import shutil
+import sys
+import time
+import Queue
 from threading import Thread
  
 # Logging
@@ -61,6 +61,9 @@ actions={
          SCREENSHOT : "Take LCD screenshot"
          }
 
+# Maximum time to wait for the video writer to finish when recording stops
+STOP_TIMEOUT = 10.0
+
 
 ''' 
 This simple plugin takes a screenshot of the LCD
@@ -130,6 +133,134 @@ class LCDShotPreferences():
         self.gconf_client.set_string(self.gconf_key + "/folder", widget.get_filename())
         
             
+class G15LCDRecorder():
+    """
+    Streams LCD frames straight into an mencoder process as raw video. Frames
+    are taken from the screen's paint path as they are drawn, so there is no 
+    polling and no contention for the draw lock. Frames identical to the 
+    previous one are discarded immediately, and the queue between the paint 
+    thread and the writer thread is bounded (frames are dropped rather than
+    letting the paint thread block or memory grow). The writer thread repeats 
+    the last frame as required to keep the output at a constant frame rate.
+    """
+    
+    def __init__(self, screen, path, fps, max_frames = 16):
+        self._screen = screen
+        self._path = path
+        self._fps = fps
+        self._width = screen.width
+        self._height = screen.height
+        self._queue = Queue.Queue(max_frames)
+        self._last_frame = None
+        self._failed = False
+        self._stopping = False
+        self._process = None
+        self._thread = None
+        self.frames = 0
+        self.duplicates = 0
+        self.dropped = 0
+        
+    def start(self):
+        pixel_format = "bgra" if sys.byteorder == "little" else "argb"
+        cmd = ["mencoder", "-really-quiet", "-demuxer", "rawvideo", "-rawvideo", \
+               "w=%d:h=%d:fps=%d:format=%s" % (self._width, self._height, self._fps, pixel_format), \
+               "-ovc", "lavc", "-lavcopts", "vcodec=mpeg4", "-o", self._path, "-"]
+        self._process = subprocess.Popen(cmd, stdin = subprocess.PIPE)
+        self._thread = Thread(target = self._write)
+        self._thread.setName("LCDScreenshotRecord")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._screen.frame_listeners.append(self.frame_painted)
+        
+        # Start with whatever is on the LCD now, it may not change for a while
+        if self._screen.old_surface is not None:
+            self._screen.draw_lock.acquire()
+            try:
+                self.frame_painted(self._screen.old_surface)
+            finally:
+                self._screen.draw_lock.release()
+        
+    def stop(self):
+        """
+        Stop recording and wait for the encoder to finish. Returns the encoder's
+        exit status.
+        """
+        if self.frame_painted in self._screen.frame_listeners:
+            self._screen.frame_listeners.remove(self.frame_painted)
+        
+        # The writer also notices the stop flag once the queue is drained, so
+        # don't block if the queue is full (or the writer has already died)
+        self._stopping = True
+        try:
+            self._queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        self._thread.join(STOP_TIMEOUT)
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        ret = self._process.wait()
+        logger.info("Recorded %d frames to %s (%d identical frames skipped, %d dropped)", 
+                    self.frames, self._path, self.duplicates, self.dropped)
+        return ret
+        
+    def frame_painted(self, surface):
+        """
+        Called on the paint thread (with the draw lock held) for every frame
+        sent to the LCD
+        """
+        if self._failed or surface.get_width() != self._width or surface.get_height() != self._height:
+            return
+        surface.flush()
+        data = str(surface.get_data())
+        if data == self._last_frame:
+            self.duplicates += 1
+            return
+        try:
+            self._queue.put_nowait((time.time(), data))
+            self._last_frame = data
+        except Queue.Full:
+            self.dropped += 1
+            
+    def _write(self):
+        interval = 1.0 / self._fps
+        start = None
+        frame = None
+        written = 0
+        try:
+            while True:
+                try:
+                    item = self._queue.get(True, interval)
+                except Queue.Empty:
+                    item = None if self._stopping else False
+                    
+                if item is None:
+                    # Finished, make sure the last frame makes it out
+                    if frame is not None:
+                        self._process.stdin.write(frame)
+                        self.frames += 1
+                    break
+                    
+                now = item[0] if item else time.time()
+                if start is None:
+                    if not item:
+                        continue
+                    start = now
+                
+                # Repeat the current frame up to the time slot of this one
+                due = int((now - start) * self._fps)
+                while frame is not None and written < due:
+                    self._process.stdin.write(frame)
+                    written += 1
+                    self.frames += 1
+                
+                if item:
+                    frame = item[1]
+        except IOError as e:
+            logger.error("Failed to write to video encoder.", exc_info = e)
+            self._failed = True
+            
 class G15LCDShot():
     
     def __init__(self, screen, gconf_client, gconf_key):
@@ -137,12 +268,15 @@ class G15LCDShot():
         self._gconf_client = gconf_client
         self._gconf_key = gconf_key
         self._recording = False
+        self._recorder = None
 
     def activate(self):
         self._screen.key_handler.action_listeners.append(self) 
     
     def deactivate(self):
         self._screen.key_handler.action_listeners.remove(self)
+        if self._recording:
+            self._stop_recording()
         
     def destroy(self):
         pass
@@ -159,15 +293,11 @@ class G15LCDShot():
                 else:
                     self._start_recording()
                     
-    def _encode(self):
-        cmd = ["mencoder", "-really-quiet", "mf://%s.tmp/*.jpeg" % self._record_to, "-mf", \
-                         "w=%d:h=%d:fps=%d:type=jpg" % (self._screen.device.lcd_size[0],self._screen.device.lcd_size[1],self._record_fps), "-ovc", "lavc", \
-                         "-lavcopts", "vcodec=mpeg4", "-oac", "copy", "-o", self._record_to]
+    def _encode(self, recorder):
         try:
-            ret = subprocess.call(cmd)
+            ret = recorder.stop()
             if ret == 0:
-                g15notify.notify(_("LCD Screenshot"), _("Video encoding complete. Result at %s" % self._record_to), "dialog-info", timeout = 0)
-                shutil.rmtree("%s.tmp" % self._record_to, True)
+                g15notify.notify(_("LCD Screenshot"), _("Video encoding complete. Result at %s" % recorder._path), "dialog-info", timeout = 0)
             else:
                 logger.error("Video encoding failed with status %d", ret)
                 g15notify.notify(_("LCD Screenshot"), _("Video encoding failed."), "dialog-error", timeout = 0)
@@ -177,39 +307,26 @@ class G15LCDShot():
                     
     def _stop_recording(self):
         self._recording = False
+        recorder = self._recorder
+        self._recorder = None
         g15notify.notify(_("LCD Screenshot"), _("Video recording stopped. Now encoding"), "dialog-info", timeout = 0)
-        t = Thread(target = self._encode);
+        t = Thread(target = self._encode, args = (recorder,));
         t.setName("LCDScreenshotEncode")
         t.start()
                     
     def _start_recording(self):
-        self._record_fps = g15gconf.get_int_or_default(self._gconf_client, "%s/fps" % self._gconf_key, 10)
+        record_fps = g15gconf.get_int_or_default(self._gconf_client, "%s/fps" % self._gconf_key, 10)
         path = self._find_next_free_filename("avi", _("Gnome15_Video"))
+        try:
+            self._recorder = G15LCDRecorder(self._screen, path, record_fps)
+            self._recorder.start()
+        except Exception as e:
+            logger.error("Failed to start video recording.", exc_info = e)
+            self._screen.error_on_keyboard_display(_("Failed to start video recording. %s") % str(e))
+            self._recorder = None
+            return
         g15notify.notify(_("LCD Screenshot"), _("Started recording video"), "dialog-info")
-        g15os.mkdir_p("%s.tmp" % path)
-        self._frame_no = 1
         self._recording = True
-        self._record_to = path
-        self._frame()
-        
-    def _frame(self):
-        if self._recording:
-            try:
-                self._screen.draw_lock.acquire()
-                try:
-                    path = os.path.join("%s.tmp" % self._record_to, "%012d.jpeg" % self._frame_no)
-                    pixbuf = g15cairo.surface_to_pixbuf(self._screen.old_surface)
-                finally:
-                    self._screen.draw_lock.release()
-                    
-                pixbuf.save(path, "jpeg", {"quality":"100"})
-                self._frame_no += 1
-            except Exception as e:
-                logger.error("Failed to save screenshot.", exc_info = e)
-                self._screen.error_on_keyboard_display(_("Failed to save screenshot to %s. %s") % (dir, str(e)))
-                self._recording = False
-            
-            self._recording_timer = gobject.timeout_add(1000 / self._record_fps, self._frame)
             
     def _find_next_free_filename(self, ext, title):
         dir_path = g15gconf.get_string_or_default(self._gconf_client, "%s/folder" % \
@@ -29,7 +29,6 @@ from threading import Timer
 import gtk
 import os
 import sys
-import time
 import logging
 logger = logging.getLogger(__name__)
  
@@ -119,7 +118,7 @@ class G15MacroRecorder():
         self._record_thread = None
         self._last_keys = None
         self._page = None
-        self._key_down = None
+        self._recording = g15profile.G15RecordedScript()
         self._message = None
         self._lights_control = None
     
@@ -208,25 +207,18 @@ class G15MacroRecorder():
                 self._redraw()
                 
     def _record_key_callback(self, event, keyname):
-        if self._key_down == None:
-            self._key_down = time.time()
-        else:
-            now = time.time()
-            delay = time.time() - self._key_down
-            self._script_model.append(["Delay", str(int(delay * 1000))])
-            self._key_down = now
         pr = event.type == X.KeyPress and "Press" or "Release"
         keydown = self._key_state[keyname] if keyname in self._key_state else None
         if keydown is None:
             if event.type == X.KeyPress:
                 self._key_state[keyname] = True
-                self._script_model.append([pr, keyname])
+                self._recording.add(event.time, pr, keyname)
             else:
                 # Got a release without getting a press - ignore
                 pass
         else:
             if event.type == X.KeyRelease:
-                self._script_model.append([pr, keyname])
+                self._recording.add(event.time, pr, keyname)
                 del self._key_state[keyname]
             
     def _done_recording(self, state):
@@ -236,17 +228,13 @@ class G15MacroRecorder():
               
             active_profile = g15profile.get_active_profile(self._screen.device)
             key_name = ", ".join(g15driver.get_key_names(record_keys))
-            if len(self._script_model) == 0:  
+            if len(self._recording) == 0:  
                 self.icon = "edit-delete"
                 self._message = key_name + " deleted"
                 active_profile.delete_macro(state, self._screen.get_memory_bank(), record_keys)  
                 self._screen.redraw(self._page)   
             else:
-                macro_script = ""
-                for row in self._script_model:
-                    if len(macro_script) != 0:                    
-                        macro_script += "\n"
-                    macro_script += row[0] + " " + row[1]       
+                macro_script = self._recording.to_script()
                 self.icon = "tag-new"   
                 self._message = key_name + " created"
                 memory = self._screen.get_memory_bank()
@@ -277,7 +265,6 @@ class G15MacroRecorder():
     def _halt_recorder(self):        
         if self._record_thread != None:
             self._record_thread.disable_record_context()
-        self._key_down = None
         self._record_key = None
         self._record_thread = None
         
@@ -290,9 +277,8 @@ class G15MacroRecorder():
             self._screen.redraw(self._page)     
         
     def _start_recording(self):      
-        self._script_model = []
+        self._recording = g15profile.G15RecordedScript()
         self._key_state = {}
-        self._key_down = None
         if self._screen.driver.get_bpp() > 0:
             if self._page == None:
                 self._page = g15theme.G15Page(id, self._screen, priority=g15screen.PRI_EXCLUSIVE,\
@@ -35,7 +35,6 @@ import gtk
 import os
 import gst
 import cairo
-import array
 import gobject
 import gio
 import mimetypes
@@ -217,8 +216,10 @@ class G15VisualisationMenuItem(g15theme.MenuItem):
         
 class G15VideoPainter(g15screen.Painter):
     """
-    Painter used to paint video or visualisation on the background of other
-    pages.
+    Painter used to paint video or visualisation beneath the video page, or on
+    the background of other pages. Because the video is a separate layer, a
+    new frame only needs the screen to be composited again, the page content
+    (and its theme) is not rendered.
     """
     
     def __init__(self, video_page):
@@ -226,10 +227,9 @@ class G15VideoPainter(g15screen.Painter):
         self._video_page = video_page
         
     def paint(self, canvas):
-        if not self._video_page.is_visible():
-            canvas.save()
-            self._video_page._paint_video_image(canvas)
-            canvas.restore()
+        canvas.save()
+        self._video_page._paint_video_image(canvas)
+        canvas.restore()
         
 class G15MediaPlayerPage(g15theme.G15Page):
     """
@@ -254,6 +254,7 @@ class G15MediaPlayerPage(g15theme.G15Page):
         self._active = True
         self._frame_index = 1
         self._last_seconds = -1
+        self._frame_pending = False
         self._thumb_icon = g15cairo.load_surface_from_file(icon_path)
         self._setup_gstreamer()
         self.screen.key_handler.action_listeners.append(self) 
@@ -273,9 +274,11 @@ class G15MediaPlayerPage(g15theme.G15Page):
         logger.info("Creating audio/visual source")
         self._video_src = self._source.create_source()
 
-        # Create our custom sink that is connected to the LCD
+        # Create our custom sink that is connected to the LCD. It only accepts
+        # frames in the native format and up to the native size of the LCD
         logger.info("Creating videosink that is connected to the LCD")
-        self._video_sink = lcdsink.CairoSurfaceThumbnailSink()
+        self._video_sink = lcdsink.CairoSurfaceThumbnailSink(self._screen.driver.get_size(),
+                                                             self._screen.driver.get_bpp() == 1)
         logger.info("Connecting to video sink")
         self._video_sink.connect('thumbnail', self._redraw_cb)
         
@@ -354,7 +357,7 @@ class G15MediaPlayerPage(g15theme.G15Page):
         g15theme.G15Page.paint_theme(self, canvas, properties, attributes)
     
     def paint(self, canvas):
-        self._paint_video_image(canvas)
+        # The video itself is painted by the background painter
         canvas.save()        
         if self._sidebar_offset < 0 and self._sidebar_offset > -(self.theme.bounds[2]):
             self._sidebar_offset -= 5
@@ -391,25 +394,13 @@ class G15MediaPlayerPage(g15theme.G15Page):
     def _redraw_cb(self, unused_thsink, timestamp):
         if not self._plugin.active:
             return
-        buf = self._video_sink.data
-        width = self._video_sink.width
-        height = self._video_sink.height
-        b = array.array("b")
-        b.fromstring(buf)
-        self._surface = cairo.ImageSurface.create_for_data(b,
-            # We don't use FORMAT_ARGB32 because Cairo uses premultiplied
-            # alpha, and gstreamer does not.  Discarding the alpha channel
-            # is not ideal, but the alternative would be to compute the
-            # conversion in python (slow!).
-            cairo.FORMAT_RGB24,
-            width,
-            height,
-            width * 4)
+        self._surface = self._video_sink.surface
         
-        if self.is_visible():
-            self.redraw()
-        else:
-            self.get_screen().redraw(redraw_content = False, queue = False)
+        # If the screen has not yet drawn the last frame, it will pick up
+        # this one instead when it does
+        if not self._frame_pending:
+            self._frame_pending = True
+            g15scheduler.execute(g15screen.REDRAW_QUEUE, "videoFrame", self._draw_frame)
             
         
     '''
@@ -447,17 +438,40 @@ class G15MediaPlayerPage(g15theme.G15Page):
         secs = int(secs)
         return hours,mins,secs
         
+    def _draw_frame(self):
+        self._frame_pending = False
+        
+        # Only render the page content again when the progress shown on it
+        # has changed, otherwise just composite the new frame
+        redraw_content = False
+        if self.is_visible():
+            try:
+                redraw_content = self._get_track_progress()[1][2] != self._last_seconds
+            except Exception as e:
+                logger.debug("Could not read track progress", exc_info = e)
+        self.get_screen().redraw(transitions = False, redraw_content = redraw_content, queue = False)
+        
     def _paint_video_image(self, canvas):
         size = self._screen.driver.get_size()
-        if self._surface != None:
+        surface = self._surface
+        if surface != None:
             target_size = ( float(size[0]), float(size[0]) * (float(self._aspect[1]) ) / float(self._aspect[0]) )
-            sx = float(target_size[0]) / float(self._surface.get_width())
-            sy = float(target_size[1]) / float(self._surface.get_height())
+            sx = float(target_size[0]) / float(surface.get_width())
+            sy = float(target_size[1]) / float(surface.get_height())
             canvas.save()
             canvas.translate((size[0] - target_size[0]) / 2.0,(size[1] - target_size[1]) / 2.0)
-            canvas.scale(sx, sy)
-            canvas.set_source_surface(self._surface)
-            canvas.paint()
+            if sx != 1.0 or sy != 1.0:
+                canvas.scale(sx, sy)
+            if surface.get_format() == cairo.FORMAT_A8:
+                # Grey frames are used as a mask over a black background
+                canvas.set_source_rgb(0, 0, 0)
+                canvas.rectangle(0, 0, surface.get_width(), surface.get_height())
+                canvas.fill()
+                canvas.set_source_rgb(1, 1, 1)
+                canvas.mask_surface(surface)
+            else:
+                canvas.set_source_surface(surface)
+                canvas.paint()
             canvas.restore()
     
     def _hide_sidebar(self, after = 0.0):
@@ -587,6 +601,9 @@ class G15VideoFileSource(G15MediaSource):
         self._filter = gst.element_factory_make("capsfilter")
         self._filter.set_property("caps", videocap)
         
+        # Scales the video down to the LCD size before converting it
+        self._scale = gst.element_factory_make("videoscale")
+        
         # Converts the video from one colorspace to another
         self._color_space = gst.element_factory_make("ffmpegcolorspace")
 
@@ -604,6 +621,7 @@ class G15VideoFileSource(G15MediaSource):
                      self._queue1,
                      self._queue2,
                      self._filter,
+                     self._scale,
                      self._color_space,
                      self._audiosink,
                      video_sink)
@@ -611,8 +629,8 @@ class G15VideoFileSource(G15MediaSource):
         # Link everything we can link now
         gst.element_link_many(video_src, self._decodebin)
         gst.element_link_many(self._queue1, self._autoconvert,
-                              self._filter, self._color_space,
-                              video_sink)
+                              self._filter, self._scale,
+                              self._color_space, video_sink)
         gst.element_link_many(self._queue2, self._audioconvert,
                               self._audiosink)
         
@@ -653,6 +671,7 @@ class G15AudioFileSource(G15MediaSource):
     def build_pipeline(self, video_src, video_sink, pipeline):
         self._decodebin = gst.element_factory_make("decodebin2")
         self._visualiser = gst.element_factory_make(self._visualisation)
+        self._scale = gst.element_factory_make("videoscale")
         self._color_space = gst.element_factory_make("ffmpegcolorspace")
         self._audioconvert = gst.element_factory_make("audioconvert")
         self._audiosink = gst.element_factory_make("autoaudiosink")
@@ -667,6 +686,7 @@ class G15AudioFileSource(G15MediaSource):
                      self._audiosink,
                      self._queue2,
                      self._visualiser,
+                     self._scale,
                      self._color_space,
                      video_sink)
         gst.element_link_many(video_src, self._decodebin)
@@ -674,7 +694,7 @@ class G15AudioFileSource(G15MediaSource):
         self._tee.link(self._queue1)
         self._queue1.link(self._audiosink)
         self._tee.link(self._queue2)
-        gst.element_link_many(self._queue2, self._visualiser,self._color_space, video_sink)
+        gst.element_link_many(self._queue2, self._visualiser, self._scale, self._color_space, video_sink)
         
     def connect_signals(self):
         if not self._decodebin is None:
@@ -702,14 +722,16 @@ class G15PulseSource(G15MediaSource):
     
     def build_pipeline(self, video_src, video_sink, pipeline):
         self._visualiser = gst.element_factory_make(self._visualisation)
+        self._scale = gst.element_factory_make("videoscale")
         self._color_space = gst.element_factory_make("ffmpegcolorspace")
         self._audioconvert = gst.element_factory_make("audioconvert")
         pipeline.add(video_src,
                      self._audioconvert,
                      self._visualiser,
+                     self._scale,
                      self._color_space,
                      video_sink)
-        gst.element_link_many(video_src, self._audioconvert, self._visualiser,self._color_space, video_sink)
+        gst.element_link_many(video_src, self._audioconvert, self._visualiser, self._scale, self._color_space, video_sink)
     
 class G15RemovableSource(G15VideoFileSource):
     
@@ -750,6 +772,9 @@ class G15WebCamSource(G15MediaSource):
         self._filter = gst.element_factory_make("capsfilter")
         self._filter.set_property("caps", videocap)
         
+        # Scales the video down to the LCD size before converting it
+        self._scale = gst.element_factory_make("videoscale")
+        
         # Converts the video from one colorspace to another
         self._color_space = gst.element_factory_make("ffmpegcolorspace")
         
@@ -760,14 +785,15 @@ class G15WebCamSource(G15MediaSource):
                      self._autoconvert,
                      self._queue1,
                      self._filter,
+                     self._scale,
                      self._color_space,
                      video_sink)
         
         # Link everything we can link now
         gst.element_link_many(video_src, self._decodebin)
         gst.element_link_many(self._queue1, self._autoconvert,
-                              self._filter, self._color_space,
-                              video_sink)
+                              self._filter, self._scale,
+                              self._color_space, video_sink)
         
     def connect_signals(self):
         if not self._decodebin is None:
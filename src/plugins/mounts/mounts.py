@@ -27,8 +27,12 @@ import gnome15.g15driver as g15driver
 import gnome15.g15screen as g15screen
 import gio
 import gtk
+import os
 import os.path
 import gobject
+import select
+import re
+from threading import Thread
 
 # Logging
 import logging
@@ -69,9 +73,91 @@ def create(gconf_key, gconf_client, screen):
 
 POSSIBLE_ICON_NAMES = [ "folder" ]
 
+# Mount table, which becomes readable with POLLPRI / POLLERR when mounts change
+MOUNT_INFO = "/proc/self/mountinfo"
+
+# Mount points beneath these directories are shown even if the volume monitor
+# does not report them (bind mounts, mounts made with the mount command etc)
+USER_MOUNT_DIRS = [ "/media", "/run/media", "/mnt", os.path.expanduser("~") ]
+
+# File system types of network mounts, other mounts must be of a device or path
+NETWORK_FS_TYPES = [ "nfs", "nfs4", "cifs", "smbfs", "fuse.sshfs", "davfs" ]
+
+# Disk usage is sampled more often while it is changing, and less often when stable
+MIN_REFRESH_INTERVAL = 5.0
+MAX_REFRESH_INTERVAL = 300.0
+
 MODES = { "free" : _("Free"), "used" : _("Used"), "size" : _("Size") }
 MODE_LIST = list(MODES.keys())
 
+def read_mount_table():
+    """
+    Get the mounts in the kernel mount table that are of interest to the user,
+    i.e. device, bind or network mounts beneath one of USER_MOUNT_DIRS
+    """
+    entries = []
+    try:
+        f = open(MOUNT_INFO)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except (IOError, OSError) as e:
+        logger.debug("Could not read mount table", exc_info = e)
+        return entries
+    
+    for line in lines:
+        # Optional fields end with a lone '-', followed by type and source
+        fields = line.split()
+        if not "-" in fields:
+            continue
+        sep = fields.index("-")
+        if len(fields) < sep + 3:
+            continue
+        mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+        fs_type = fields[sep + 1]
+        source = fields[sep + 2]
+        if not source.startswith("/") and not fs_type in NETWORK_FS_TYPES:
+            continue
+        for d in USER_MOUNT_DIRS:
+            if mount_point.startswith(d.rstrip("/") + "/"):
+                entries.append(MountTableEntry(mount_point, fs_type in NETWORK_FS_TYPES))
+                break
+    return entries
+
+"""
+Stands in for a gio.Mount for mounts that are only in the kernel mount table.
+These cannot be unmounted or ejected from here
+"""
+class MountTableEntry():
+    def __init__(self, mount_point, network):
+        self.mount_point = mount_point
+        self.network = network
+        
+    def get_root(self):
+        return gio.File(self.mount_point)
+    
+    def get_name(self):
+        return os.path.basename(self.mount_point)
+    
+    def get_uuid(self):
+        return self.mount_point
+    
+    def get_icon(self):
+        return gio.ThemedIcon("folder-remote" if self.network else "drive-harddisk")
+    
+    def can_eject(self):
+        return False
+    
+    def can_unmount(self):
+        return False
+    
+    def is_shadowed(self):
+        return False
+    
+    def __str__(self):
+        return self.mount_point
+
 """
 Represents a mount as a single item in a menu
 """
@@ -83,6 +169,10 @@ class MountMenuItem(g15theme.MenuItem):
         self._refresh()
         
     def _refresh(self):
+        """
+        Sample disk usage, returning True if it has changed since the last time
+        """
+        old = ( self.disk_size, self.disk_free )
         self.disk_size = 0
         self.disk_free = 0
         self.disk_used = 0
@@ -96,7 +186,7 @@ class MountMenuItem(g15theme.MenuItem):
             self.disk_used_pc = int ( ( self.disk_used / self.disk_size ) * 100.0 )
         except Exception as e:
             logger.debug("Error refreshing", exc_info = e)
-            pass
+        return old != ( self.disk_size, self.disk_free )
         
     def get_theme_properties(self):       
         item_properties = g15theme.MenuItem.get_theme_properties(self)
@@ -173,6 +263,47 @@ class VolumeMenuItem(g15theme.MenuItem):
         logger.info("Mounted %s %s %s", self.volume.get_name(), str(arg1), str(arg2))
 
 
+"""
+Watches the kernel mount table, invoking a callback whenever it changes. This
+catches mounts the volume monitor does not know about (bind mounts, mounts made
+with the mount command etc), which are read using read_mount_table()
+"""
+class MountTableThread(Thread):
+    def __init__(self, callback):
+        Thread.__init__(self)
+        self.name = "MountTableThread"
+        self.setDaemon(True)
+        self._callback = callback
+        self._stop = False
+        self._file = open(MOUNT_INFO)
+        self._file.read()
+        self._wake_read, self._wake_write = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self._file, select.POLLPRI | select.POLLERR)
+        self._poll.register(self._wake_read, select.POLLIN)
+        
+    def stop_monitoring(self):
+        self._stop = True
+        os.write(self._wake_write, "x")
+        
+    def run(self):
+        try :
+            while not self._stop:
+                events = self._poll.poll()
+                if self._stop:
+                    break
+                if [ fd for fd, mask in events if fd == self._file.fileno() ]:
+                    # The table must be re-read to clear the event
+                    self._file.seek(0)
+                    self._file.read()
+                    self._callback()
+        except Exception as e:
+            logger.error("Error watching mount table", exc_info = e)
+        finally:
+            self._file.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
 """
 Places plugin class
 """
@@ -182,6 +313,8 @@ class G15Places(g15plugin.G15MenuPlugin):
         g15plugin.G15MenuPlugin.__init__(self, gconf_client, gconf_key, screen, POSSIBLE_ICON_NAMES, id, name)
         self._signal_handles = []
         self._handle = None
+        self._mount_table_thread = None
+        self._refresh_interval = MIN_REFRESH_INTERVAL
         self._modes = [ "free", "used", "size" ]
         self._mode = "free"
         
@@ -204,17 +337,33 @@ class G15Places(g15plugin.G15MenuPlugin):
                 self._add_volume(volume)
                 
         # Watch for changes
-        self.volume_monitor.connect("mount_added", self._on_mount_added)
-        self.volume_monitor.connect("mount_removed", self._on_mount_removed)
+        self._signal_handles.append(self.volume_monitor.connect("mount_added", self._on_mount_added))
+        self._signal_handles.append(self.volume_monitor.connect("mount_removed", self._on_mount_removed))
+        self._signal_handles.append(self.volume_monitor.connect("mount_changed", self._on_mount_changed))
+        self._signal_handles.append(self.volume_monitor.connect("volume_added", self._on_volumes_changed))
+        self._signal_handles.append(self.volume_monitor.connect("volume_removed", self._on_volumes_changed))
+        try :
+            self._mount_table_thread = MountTableThread(self._on_mount_table_changed)
+            self._mount_table_thread.start()
+        except (IOError, OSError) as e:
+            logger.warning("Could not watch mount table, changes will only be seen through the volume monitor", exc_info = e)
+            
+        # Add any mounts only found in the mount table
+        self._sync_mounts(False)
         
-        # Refresh disk etc space every minute
-        self._handle = g15scheduler.schedule("DiskRefresh", 60.0, self._refresh)
+        # Sample disk usage, adjusting how often depending on how much it changes
+        self._refresh_interval = MIN_REFRESH_INTERVAL
+        self._schedule_refresh()
         
     def deactivate(self):
         g15plugin.G15MenuPlugin.deactivate(self)
         self.screen.key_handler.action_listeners.remove(self)
         for handle in self._signal_handles:
-            self.session_bus.remove_signal_receiver(handle)
+            self.volume_monitor.disconnect(handle)
+        self._signal_handles = []
+        if self._mount_table_thread:
+            self._mount_table_thread.stop_monitoring()
+            self._mount_table_thread = None
         if self._handle:
             self._handle.cancel()
             self._handle = None
@@ -243,14 +392,91 @@ class G15Places(g15plugin.G15MenuPlugin):
     Private functions
     """
 
+    def _schedule_refresh(self):
+        self._handle = g15scheduler.schedule("DiskRefresh", self._refresh_interval, self._refresh)
+
     def _refresh(self):
         """
-        Refresh the free space etc for all items
+        Refresh the free space etc for all items. If anything changed, the
+        next refresh happens sooner, otherwise it backs off
         """
+        changed = False
+        for item in self.menu.get_children():
+            if isinstance(item, MountMenuItem) and item._refresh():
+                changed = True
+        if changed:
+            self._refresh_interval = MIN_REFRESH_INTERVAL
+            self.screen.redraw(self.page)
+        else:
+            self._refresh_interval = min(MAX_REFRESH_INTERVAL, self._refresh_interval * 2)
+        if self._handle:
+            self._schedule_refresh()
+            
+    def _on_mount_table_changed(self):
+        """
+        Invoked (on the mount table thread) when the kernel mount table changes
+        """
+        gobject.idle_add(self._sync_mounts)
+        
+    def _on_mount_changed(self, monitor, mount, *args):
+        item = self._get_item_for_mount(mount)
+        if item:
+            item._refresh()
+            self.screen.redraw(self.page)
+        
+    def _on_volumes_changed(self, monitor, volume, *args):
+        self._sync_mounts()
+        
+    def _sync_mounts(self, popup = True):
+        """
+        Bring the menu up to date with the current mounts and volumes. Only
+        items for mounts or volumes that have come or gone are added or removed,
+        existing items are left alone. Mounts in the kernel mount table that
+        the volume monitor does not report are included.
+        
+        Keyword arguments:
+        popup        -- raise the page if anything changed
+        """
+        if not self._signal_handles:
+            # Deactivated
+            return
+        mounts = {}
+        mount_points = set()
+        for mount in self.volume_monitor.get_mounts():
+            if not mount.is_shadowed():
+                mounts[self._get_key(mount)] = mount
+            root = mount.get_root()
+            if root:
+                mount_points.add(root.get_path())
+        for entry in read_mount_table():
+            if not entry.mount_point in mount_points:
+                mounts[self._get_key(entry)] = entry
+        volumes = {}
+        for volume in self.volume_monitor.get_volumes():
+            if volume.get_mount() == None:
+                volumes[self._get_key(volume)] = volume
+                
+        changed = False
         for item in self.menu.get_children():
             if isinstance(item, MountMenuItem):
-                item._refresh()
-        self.screen.redraw(self.page)
+                if mounts.pop(self._get_key(item.mount), None) is None:
+                    self._remove_mount(item.mount)
+                    changed = True
+            elif isinstance(item, VolumeMenuItem):
+                if volumes.pop(self._get_key(item.volume), None) is None:
+                    self._remove_volume(item.volume)
+                    changed = True
+        for mount in mounts.values():
+            self._add_mount(mount)
+            changed = True
+        for volume in volumes.values():
+            self._add_volume(volume)
+            changed = True
+            
+        if changed:
+            self._refresh_interval = MIN_REFRESH_INTERVAL
+            if popup:
+                self._popup()
         
     def _on_mount_added(self, monitor, mount, *args):
         
@@ -266,6 +492,10 @@ class G15Places(g15plugin.G15MenuPlugin):
         self._remove_mount(mount)
         self._add_mount(mount)
         
+        # The mount table may have been read before the volume monitor knew 
+        # about this mount, so it may also have been added from there
+        self._sync_mounts(False)
+        
         self._popup()
         
     def _on_mount_removed(self, monitor, mount, *args):
@@ -279,6 +509,9 @@ class G15Places(g15plugin.G15MenuPlugin):
             if not self._get_item_for_volume(volume) and volume.get_mount() == None:
                 self._add_volume(volume)
                 
+        # If the mount point is still mounted, it now only comes from the mount table
+        self._sync_mounts(False)
+                
         self._popup()
                  
     def _popup(self): 
@@ -107,6 +107,7 @@ class AbstractMPRISPlayer():
         self.cover_image = None
         self.thumb_image = None
         self.cover_uri = None
+        self.cover_icon = None
         self.song_properties = {}
         self.status = "Stopped"      
         self.redraw_timer = None  
@@ -269,20 +270,17 @@ class AbstractMPRISPlayer():
             self.cover_image = None
             self.thumb_image = None
             if self.cover_uri != None:
-                cover_image = g15cairo.load_surface_from_file(self.cover_uri, self.screen.driver.get_size()[0])
-                if cover_image:
-                    self.cover_image = cover_image
-                    
-                    # If the cover URI was from HTTP, then we cached it. Use that as the URI
-                    if self.cover_uri.startswith("http:") or self.cover_uri.startswith("http:"):
-                        self.cover_uri = g15cairo.get_image_cache_file(self.cover_uri, self.screen.driver.get_size()[0])
-                else:
-                    cover_image = self.get_default_cover()
-                    logger.warning("Failed to loaded preferred cover art, " \
-                                   "falling back to default of %s", cover_image)
+                if self.cover_uri.startswith("http:") or self.cover_uri.startswith("https:"):
+                    # Remote cover art is loaded in the background, the page is redrawn when it arrives.
+                    # Until then the theme shows the default cover rather than fetching the URL itself
+                    cover_uri = self.cover_uri
+                    self.cover_icon = self.get_default_cover()
+                    cover_image = g15cairo.load_surface_async(cover_uri, self.screen.driver.get_size()[0],
+                                                              callback = lambda surface: self._cover_loaded(cover_uri, surface))
                     if cover_image:
-                        self.cover_uri = cover_image
-                        self.cover_image = g15cairo.load_surface_from_file(self.cover_uri, self.screen.driver.get_size()[0])
+                        self._set_cover(cover_uri, cover_image)
+                else:
+                    self._set_cover(self.cover_uri, g15cairo.load_surface_from_file(self.cover_uri, self.screen.driver.get_size()[0]))
                   
         # Track status
         if self.status == "Stopped":
@@ -303,8 +301,40 @@ class AbstractMPRISPlayer():
                 else:
                     self.thumb_image = self.cover_image                
                 self.song_properties["paused"] = True
-            self.song_properties["icon"] = self.cover_uri
+            self.song_properties["icon"] = self.cover_icon
+            
+    def _cover_loaded(self, cover_uri, cover_image):
+        if cover_uri == self.cover_uri:
+            self._set_cover(cover_uri, cover_image)
+            if self.status != "Stopped":
+                if self.screen.driver.get_bpp() != 1:
+                    self.thumb_image = self.cover_image
+                self.song_properties["icon"] = self.cover_icon
+            self.screen.redraw(self.page)
+            
+    def _set_cover(self, cover_uri, cover_image):
+        if cover_image:
+            self.cover_image = cover_image
+            self.cover_icon = cover_uri
             
+            # If the cover URI was from HTTP, then we cached it. Use that as the URI
+            if cover_uri.startswith("http:") or cover_uri.startswith("https:"):
+                cached_uri = g15cairo.get_image_cache_file(cover_uri, self.screen.driver.get_size()[0])
+                if cached_uri:
+                    self.cover_uri = cached_uri
+                    self.cover_icon = cached_uri
+                else:
+                    # Not on disk, so the theme would have to fetch it again itself
+                    self.cover_icon = self.get_default_cover()
+        else:
+            cover_image = self.get_default_cover()
+            logger.warning("Failed to loaded preferred cover art, " \
+                           "falling back to default of %s", cover_image)
+            self.cover_icon = cover_image
+            if cover_image:
+                self.cover_uri = cover_image
+                self.cover_image = g15cairo.load_surface_from_file(self.cover_uri, self.screen.driver.get_size()[0])
+        
     def get_default_cover(self):
         mime_type = mime.get_type(self.playing_uri)
         new_cover_uri = None
@@ -41,6 +41,7 @@ import tempfile
 import lxml.html
 import Queue
 import gobject
+import heapq
 
 from threading import Timer
 from threading import Thread
@@ -87,6 +88,22 @@ NOTIFICATION_DISMISSED = 2
 NOTIFICATION_CLOSED = 3
 NOTIFICATION_UNDEFINED = 4
 
+# Urgency levels (from the 'urgency' hint)
+URGENCY_LOW = 0
+URGENCY_NORMAL = 1
+URGENCY_CRITICAL = 2
+
+# Maximum number of messages held (including the visible one). When full, the
+# least urgent, oldest message is discarded
+MAX_QUEUED = 50
+
+# Per application rate limit. Each application may send BURST notifications in
+# quick succession, after which they are accepted at RATE per second. Anything
+# over the limit is counted against the application's last queued message (or 
+# discarded if there is none). Critical notifications are never limited.
+RATE = 0.5
+BURST = 5
+
 def create(gconf_key, gconf_client, screen):
     return G15NotifyLCD(gconf_client, gconf_key, screen)
 
@@ -124,8 +141,11 @@ Queued notification message
 '''     
 class G15Message():
     
-    def __init__(self, id, icon, summary, body, timeout, actions, hints):
+    def __init__(self, id, icon, summary, body, timeout, actions, hints, app_name = None):
         self.id  = id
+        self.app_name = app_name
+        self.count = 1
+        self.seq = 0
         self.set_details(icon, summary, body, timeout, actions, hints)
         self.original_body = body
         self.original_summary = summary
@@ -151,6 +171,10 @@ class G15Message():
             for j in range(0, len(actions), 2):
                 self.actions.append((actions[j], actions[j + 1]))
         self.hints = hints
+        try:
+            self.urgency = int(hints.get("urgency", URGENCY_NORMAL))
+        except (TypeError, ValueError):
+            self.urgency = URGENCY_NORMAL
         self.embedded_image = None
         
         if "image_path" in self.hints:
@@ -186,6 +210,151 @@ class G15Message():
         if self.embedded_image != None:
             os.remove(self.embedded_image)
    
+'''
+Limits the rate of notifications from a single application
+'''
+class G15TokenBucket():
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        
+    def take(self):
+        """
+        Take a token if one is available, returning False if the rate limit has
+        been reached
+        """
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + ( now - self._stamp ) * self.rate)
+        self._stamp = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+    
+'''
+Bounded queue of notification messages. Messages are shown most urgent first,
+then in the order they arrived. The message currently being shown is held as
+'current' (and still counts as being in the queue). Messages may be looked up 
+by ID, or by application and summary so repeats can be coalesced.
+'''
+class G15MessageQueue():
+    
+    def __init__(self, max_size = MAX_QUEUED):
+        self.max_size = max_size
+        self.current = None
+        self._messages = {}
+        self._heap = []
+        self._seq = 0
+        self._by_summary = {}
+        self._by_app = {}
+        
+    def __len__(self):
+        return len(self._messages)
+    
+    def __contains__(self, id):
+        return id in self._messages
+    
+    def get(self, id):
+        return self._messages.get(id)
+    
+    def get_similar(self, app_name, summary):
+        """
+        Get the queued message from the same application with the same summary
+        """
+        return self._by_summary.get(( app_name, summary ))
+    
+    def get_latest(self, app_name):
+        """
+        Get the most recently queued message for an application
+        """
+        return self._by_app.get(app_name)
+        
+    def add(self, message):
+        """
+        Add a new message, returning a list of the messages that had to be 
+        discarded to make room for it
+        """
+        message.seq = self._seq
+        self._seq += 1
+        self._messages[message.id] = message
+        self._by_summary[( message.app_name, message.summary )] = message
+        self._by_app[message.app_name] = message
+        heapq.heappush(self._heap, ( -message.urgency, message.seq, message.id ))
+        
+        discarded = []
+        while len(self._messages) > self.max_size:
+            victim = None
+            for m in self._messages.values():
+                if m != self.current and ( victim is None or ( m.urgency, m.seq ) < ( victim.urgency, victim.seq ) ):
+                    victim = m
+            if victim is None:
+                break
+            self.remove(victim.id)
+            discarded.append(victim)
+        return discarded
+    
+    def update_summary(self, message, old_summary):
+        """
+        Re-index a message after its summary has changed
+        """
+        if self._by_summary.get(( message.app_name, old_summary )) == message:
+            del self._by_summary[( message.app_name, old_summary )]
+        self._by_summary[( message.app_name, message.summary )] = message
+    
+    def remove(self, id):
+        """
+        Remove a message. If it is the current message, there will be no current
+        message until next() is called. 
+        """
+        message = self._messages.pop(id, None)
+        if message is None:
+            return None
+        if message == self.current:
+            self.current = None
+        key = ( message.app_name, message.summary )
+        if self._by_summary.get(key) == message:
+            del self._by_summary[key]
+        if self._by_app.get(message.app_name) == message:
+            del self._by_app[message.app_name]
+            latest = None
+            for m in self._messages.values():
+                if m.app_name == message.app_name and ( latest is None or m.seq > latest.seq ):
+                    latest = m
+            if latest is not None:
+                self._by_app[message.app_name] = latest
+            
+        # Entries are left in the heap and skipped when they reach the top, but 
+        # don't let the heap grow without limit 
+        if len(self._heap) > self.max_size * 4:
+            self._heap = [ e for e in self._heap if e[2] in self._messages and self._messages[e[2]] != self.current ]
+            heapq.heapify(self._heap)
+        return message
+    
+    def next(self):
+        """
+        Make the most urgent, oldest waiting message the current one and return
+        it (or None if there are no more)
+        """
+        self.current = None
+        while self._heap:
+            urgency, seq, id = heapq.heappop(self._heap)
+            message = self._messages.get(id)
+            if message is not None and message.seq == seq:
+                self.current = message
+                break
+        return self.current
+    
+    def clear(self):
+        """
+        Remove all messages, returning them
+        """
+        messages = self._messages.values()
+        self.__init__(self.max_size)
+        return messages
+   
 '''
 DBus service implementing the freedesktop notification specification
 '''     
@@ -268,8 +437,8 @@ class G15NotifyLCD():
         self._redraw_timer = None
         self._blink_thread = None
         self._control_values = []
-        self._message_queue = []
-        self._message_map = {}
+        self._message_queue = G15MessageQueue()
+        self._rate_limits = {}
         self._current_message = None
         self._service = None
         self._load_configuration()
@@ -379,49 +548,11 @@ class G15NotifyLCD():
                 if summary:
                     summary  = g15markup.strip_tags(summary)
 
-                if id != 0 and not id in self._message_map:
-                    if len(self._message_queue) > 0:
-                        new_id = self._message_queue[0].id
-                        logger.warn("Got request to replace message %d, " \
-                                    "but we do not know about it. " \
-                                    "Just replacing visible message %d", id, new_id)
-                        id = new_id
-                    else:
-                        id = 0
-                
-                # If a message with this ID is already queued, replace it's details
-                if id == 0:
-                    # Queue a new message
-                    logger.debug("Queuing new message")
-                    id = self.id
-                    message = G15Message(self.id, icon, summary, body, timeout, actions, hints)
-                    self._message_queue.append(message)
-                    self._message_map[self.id] = message                
-                    self.id += 1
-                    
-                    if len(self._message_queue) == 1:
-                        self._notify()
-                    else:    
-                        logger.debug("More than one message in queue, just redrawing")                           
-                        if self._page != None:
-                            self._screen.redraw(self._page)
-                else:
-                    if id in self._message_map:
-                        logger.debug("Message %s is already in queue, replacing its details",
-                                     str(id))
-                        message = self._message_map[id]
-                        message.set_details(icon, summary, body, timeout, actions, hints) 
-                        
-                        # If this message is the visible one, then reset the timer
-                        if message == self._message_queue[0]:
-                            logger.debug("It is the visible message")
-                            self._start_timer(message)
-                        else:            
-                            if self._page != None:
-                                self._screen.redraw(self._page)
-                            
-                logger.info("Notify message has ID of %s", str(id))
-                return id                         
+                self._lock.acquire()
+                try:
+                    return self._queue_message(app_name, id, icon, summary, body, actions, hints, timeout)
+                finally:
+                    self._lock.release()
         except Exception as blah:
             logger.warning("Could not create notification", exc_info = blah)
     
@@ -433,28 +564,24 @@ class G15NotifyLCD():
         self._lock.acquire()
         try :
             if self.allow_cancel and len(self._message_queue) > 0:
-                message = self._message_queue[0]
-                if message.id == id:
+                message = self._message_queue.current
+                if message is not None and message.id == id:
                     self._cancel_timer()
                     self._move_to_next(NOTIFICATION_CLOSED)
                 else:
-                    del self._message_map[id]
-                    for m in self._message_queue:
-                        if m.id == id:
-                            self._message_queue.remove(m)
-                            if self._service:
-                                gobject.idle_add(self._service.NotificationClosed, id, NOTIFICATION_CLOSED)
-                            break
+                    message = self._message_queue.remove(id)
+                    if message is not None:
+                        message.close()
+                        if self._service:
+                            gobject.idle_add(self._service.NotificationClosed, id, NOTIFICATION_CLOSED)
         finally :
             self._lock.release()
         
     def clear(self):
         self._lock.acquire()
         try :
-            for message in self._message_queue:
+            for message in self._message_queue.clear():
                 message.close()
-            self._message_queue = []
-            self._message_map = {}
             self._cancel_timer()
             if self._page != None:
                 self._screen.del_page(self._page)  
@@ -468,8 +595,8 @@ class G15NotifyLCD():
     
     def action(self):
         self._cancel_timer()
-        if len(self._message_queue) > 0:
-            message = self._message_queue[0]
+        message = self._message_queue.current
+        if message is not None:
             if len(message.actions) > 0:
                 action = message.actions[0]
                 if self._service:
@@ -482,11 +609,90 @@ class G15NotifyLCD():
     '''     
     def _configuration_changed(self, client, connection_id, entry, args):
         self._load_configuration()
+        
+    def _queue_message(self, app_name, id, icon, summary, body, actions, hints, timeout):
+        queue = self._message_queue
+        if id != 0 and not id in queue:
+            if queue.current is not None:
+                new_id = queue.current.id
+                logger.warn("Got request to replace message %d, " \
+                            "but we do not know about it. " \
+                            "Just replacing visible message %d", id, new_id)
+                id = new_id
+            else:
+                id = 0
+                
+        if id != 0:
+            # If a message with this ID is already queued, replace it's details
+            logger.debug("Message %s is already in queue, replacing its details",
+                         str(id))
+            message = queue.get(id)
+            old_summary = message.summary
+            message.set_details(icon, summary, body, timeout, actions, hints)
+            queue.update_summary(message, old_summary)
+            
+            # If this message is the visible one, then reset the timer
+            if message == queue.current:
+                logger.debug("It is the visible message")
+                self._start_timer(message)
+            logger.info("Notify message has ID of %s", str(id))
+            return id
+        
+        # Everything but critical messages is charged against the rate limit,
+        # including repeats that are coalesced with a queued message
+        limited = False
+        if hints.get("urgency", URGENCY_NORMAL) != URGENCY_CRITICAL:
+            bucket = self._rate_limits.get(app_name)
+            if bucket is None:
+                bucket = G15TokenBucket(RATE, BURST)
+                self._rate_limits[app_name] = bucket
+            limited = not bucket.take()
+        
+        # Repeats of a queued message are just counted
+        message = queue.get_similar(app_name, summary)
+        if message is None and limited:
+            message = queue.get_latest(app_name)
+            if message is None:
+                logger.debug("Rate limit for %s reached, discarding message", app_name)
+                id = self.id
+                self.id += 1
+                return id
+                
+        if message is not None:
+            logger.debug("Coalescing with message %d", message.id)
+            message.count += 1
+            if message.summary == summary and not limited:
+                message.set_details(icon, summary, body, timeout, actions, hints)
+                
+            # The timer of the visible message is not restarted, otherwise a
+            # flood of repeats would keep it (and the LCD) busy indefinitely
+            return message.id
+        
+        # Queue a new message
+        logger.debug("Queuing new message")
+        id = self.id
+        self.id += 1
+        message = G15Message(id, icon, summary, body, timeout, actions, hints, app_name)
+        for discarded in queue.add(message):
+            logger.debug("Queue full, discarding message %d", discarded.id)
+            discarded.close()
+            if self._service:
+                gobject.idle_add(self._service.NotificationClosed, discarded.id, NOTIFICATION_EXPIRED)
+        
+        if queue.current is None:
+            queue.next()
+            self._notify()
+            
+        # Otherwise the page is already showing, and being redrawn regularly
+        logger.info("Notify message has ID of %s", str(id))
+        return id
           
     def _get_theme_properties(self):
         width_available = self._screen.width
         properties = {}  
         properties["title"] = self._current_message.summary
+        if self._current_message.count > 1:
+            properties["title"] += " (x%d)" % self._current_message.count
         properties["message"] = self._current_message.body
         if self._current_message.icon != None and len(self._current_message.icon) > 0:
             icon_path = g15icontools.get_icon_path(self._current_message.icon)
@@ -519,9 +725,9 @@ class G15NotifyLCD():
         self._page = None
 
     def _notify(self):
-        if len(self._message_queue) != 0:            
+        if self._message_queue.current is not None:            
             logger.debug("Displaying first message in queue of %d", len(self._message_queue))
-            message = self._message_queue[0] 
+            message = self._message_queue.current
             
                 
             # Which theme variant should we use
@@ -554,6 +760,7 @@ class G15NotifyLCD():
                 self._screen.raise_page(self._page)
                 
             self._start_timer(message)         
+            self._cancel_redraw()
             self._do_redraw()
             
             # Play sound
@@ -589,14 +796,13 @@ class G15NotifyLCD():
         logger.debug("Dismissing current message. Reason code %d", reason)
         self._lock.acquire()
         try :      
-            if len(self._message_queue) > 0:
-                message = self._message_queue[0]
+            message = self._message_queue.current
+            if message is not None:
                 message.close()
-                del self._message_queue[0]
-                del self._message_map[message.id]
+                self._message_queue.remove(message.id)
                 if self._service:
                     self._service.NotificationClosed(message.id, reason)
-            if len(self._message_queue) != 0:
+            if self._message_queue.next() is not None:
                 self._notify()  
             else:
                 self._screen.del_page(self._page)
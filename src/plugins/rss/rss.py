@@ -234,12 +234,23 @@ class G15FeedPage(g15theme.G15Page):
     """
     def _on_selected(self):
         self._selected_icon_embedded = None
-        if self._menu.selected is not None and self._menu.selected.icon is not None:
-            try :
-                icon_surface = g15cairo.load_surface_from_file(self._menu.selected.icon)
-                self._selected_icon_embedded = g15icontools.get_embedded_image_url(icon_surface)
-            except Exception as e:
-                logger.warning("Failed to get icon %s", str(self._menu.selected.icon), exc_info = e)
+        selected = self._menu.selected
+        if selected is not None and selected.icon is not None:
+            # Entry images are usually remote, so are loaded in the background
+            icon_surface = g15cairo.load_surface_async(selected.icon, callback = lambda surface: self._selected_icon_loaded(selected, surface))
+            if icon_surface is not None:
+                self._set_selected_icon(selected, icon_surface)
+                
+    def _selected_icon_loaded(self, item, icon_surface):
+        if icon_surface is not None and item == self._menu.selected:
+            self._set_selected_icon(item, icon_surface)
+            self._screen.redraw(self)
+                
+    def _set_selected_icon(self, item, icon_surface):
+        try :
+            self._selected_icon_embedded = g15icontools.get_embedded_image_url(icon_surface)
+        except Exception as e:
+            logger.warning("Failed to get icon %s", str(item.icon), exc_info = e)
         
     def _reload(self):
         self.feed = feedparser.parse(self.url)
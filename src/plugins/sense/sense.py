@@ -24,7 +24,9 @@ import gnome15.g15plugin as g15plugin
 import gnome15.g15theme as g15theme
 import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15svg as g15svg
+import gnome15.util.jobqueue as jobqueue
 import os.path
+import time
 import dbus
 import sensors
 import gtk
@@ -33,6 +35,7 @@ import gobject
 
 import subprocess
 from threading import Lock
+from threading import Event
 
 # Logging
 import logging
@@ -63,6 +66,21 @@ UDISKS_DEVICE_NAME = "org.freedesktop.UDisks.Device"
 UDISKS_BUS_NAME= "org.freedesktop.UDisks"
 UDISKS2_BUS_NAME= "org.freedesktop.UDisks2"
 
+# Time a source is given to return its sensors before it is counted as failed (seconds)
+SOURCE_TIMEOUT = 10.0
+
+# While a source keeps failing the time between samples doubles, at most this many times
+MAX_BACKOFF = 5
+
+# A source becomes due again this fraction of its interval early, so a refresh
+# that fires a little before the interval is up still samples it
+DUE_SLACK = 0.1
+
+# Sources whose last sample took less than this are waited for (for at most
+# FRESH_WAIT) on each refresh, so the page shows the new values (seconds)
+CHEAP_LATENCY = 0.1
+FRESH_WAIT = 0.25
+
 '''
 Sensor types
 '''
@@ -190,6 +208,9 @@ class Sensor():
         
 class UDisksSource():
     
+    # Runs skdump for every drive, and the SMART data is only collected every few minutes anyway
+    sample_interval = 60.0
+    
     def __init__(self):
         self.name = "UDisks"
         self.udisks = None
@@ -257,6 +278,9 @@ class UDisksSource():
 
 class UDisks2Source():
 
+    # The SMART data is only collected every few minutes
+    sample_interval = 60.0
+
     def __init__(self):
         self.name = "UDisks2"
 
@@ -325,6 +349,10 @@ class UDisks2Source():
         pass
 
 class LibsensorsSource():
+    
+    # Cheap, so sampled as often as the page asks
+    sample_interval = 0
+    
     def __init__(self):
         self.name = "Libsensors"
         self.started = False
@@ -371,6 +399,10 @@ class LibsensorsSource():
             sensors.cleanup()
 
 class NvidiaSource():
+    
+    # Starts nvidia-settings each time
+    sample_interval = 30.0
+    
     def __init__(self):
         self.name = "NVidia"
         
@@ -397,6 +429,144 @@ class NvidiaSource():
     def stop(self):
         pass
 
+class G15SourceStatistics():
+    """
+    How a sensor source has been behaving
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.next_due = 0
+        self.started = None
+        self.timed_out = False
+        self.done = Event()
+        
+class G15SensorSampler():
+    """
+    Samples the sensor sources on a pool of worker threads, so one slow source
+    does not hold up the others (or the thread asking for the values). Each
+    source is sampled on its own cadence, no more often than its
+    sample_interval, and sources that fail (or take longer than the timeout)
+    are sampled less often until they recover. The sensors from the last
+    successful sample of every source are merged into a single snapshot.
+    """
+    
+    def __init__(self, sources, timeout = SOURCE_TIMEOUT):
+        self.sources = sources
+        self.timeout = timeout
+        self._lock = Lock()
+        self._sensors = {}
+        self._statistics = dict([ ( source, G15SourceStatistics(source.name) ) for source in sources ])
+        self._queue = jobqueue.JobQueue(number_of_workers = max(1, len(sources)), name = "SensorSampler")
+        
+    def stop(self):
+        self._queue.stop()
+        
+    def sample(self, interval, wait = False, fresh_wait = 0):
+        """
+        Start sampling every source that is due. Returns immediately unless
+        wait is True, in which case it waits (for at most the timeout) for the
+        samples to complete, or fresh_wait is given, in which case it waits for
+        that long for just the sources that are cheap to sample.
+        
+        Keyword arguments:
+        interval        -- how often the caller wants values (seconds)
+        wait            -- wait for the samples
+        fresh_wait      -- time to wait for cheap sources (seconds)
+        """
+        now = time.time()
+        started = []
+        self._lock.acquire()
+        try :
+            for source in self.sources:
+                statistics = self._statistics[source]
+                if statistics.started is not None:
+                    if not statistics.timed_out and now - statistics.started > self.timeout:
+                        logger.warning("Sensor source '%s' has taken more than %d seconds", source.name, self.timeout)
+                        statistics.timed_out = True
+                        statistics.failures += 1
+                        statistics.consecutive_failures += 1
+                elif now >= statistics.next_due:
+                    statistics.started = now
+                    statistics.done.clear()
+                    started.append(( source, statistics ))
+        finally :
+            self._lock.release()
+            
+        for source, statistics in started:
+            self._queue.run(None, self._sample, source, statistics, interval)
+            
+        if wait:
+            deadline = now + self.timeout
+            for source, statistics in started:
+                statistics.done.wait(max(0, deadline - time.time()))
+        elif fresh_wait > 0:
+            deadline = now + fresh_wait
+            for source, statistics in started:
+                if statistics.latency is not None and statistics.latency < CHEAP_LATENCY:
+                    statistics.done.wait(max(0, deadline - time.time()))
+        
+    def get_sensors(self):
+        """
+        Get the merged snapshot of the sensors from all sources
+        """
+        self._lock.acquire()
+        try :
+            sensors = []
+            for source in self.sources:
+                sensors += self._sensors.get(source, [])
+            return sensors
+        finally :
+            self._lock.release()
+            
+    def get_statistics(self):
+        """
+        Get the G15SourceStatistics for each source
+        """
+        return [ self._statistics[source] for source in self.sources ]
+        
+    """
+    Private
+    """
+    def _sample(self, source, statistics, interval):
+        started = time.time()
+        sensors = None
+        try :
+            sensors = list(source.get_sensors())
+        except Exception as e:
+            logger.warning("Failed to sample sensor source '%s'", source.name, exc_info = e)
+        finished = time.time()
+        
+        self._lock.acquire()
+        try :
+            statistics.samples += 1
+            statistics.latency = finished - started
+            if sensors is not None:
+                self._sensors[source] = sensors
+            if sensors is None or statistics.timed_out:
+                if not statistics.timed_out:
+                    statistics.failures += 1
+                    statistics.consecutive_failures += 1
+            else:
+                statistics.consecutive_failures = 0
+                
+            # Sample again when due (timed from when this sample was asked
+            # for), backing off while the source is failing
+            delay = max(interval, getattr(source, "sample_interval", 0))
+            delay *= 2 ** min(statistics.consecutive_failures, MAX_BACKOFF)
+            statistics.next_due = statistics.started + delay * ( 1.0 - DUE_SLACK )
+            statistics.started = None
+            statistics.timed_out = False
+        finally :
+            self._lock.release()
+        statistics.done.set()
+        logger.debug("Sampled sensor source '%s' in %.3f seconds (%d samples, %d failures)", \
+                     source.name, statistics.latency, statistics.samples, statistics.failures)
+
 class SensorMenuItem(g15theme.MenuItem):
     
     def __init__(self,  item_id, sensor, sensor_label):
@@ -430,6 +600,7 @@ class G15Sensors(g15plugin.G15RefreshingPlugin):
     def _do_activate(self):  
         self._sensors_changed_handle = self.gconf_client.notify_add(self.gconf_key + "/sensors", self._sensors_changed)
         self.sensor_sources = get_sensor_sources()
+        self.sampler = G15SensorSampler(self.sensor_sources)
         self.sensor_dict = {}        
         g15plugin.G15RefreshingPlugin.activate(self)      
     
@@ -437,12 +608,13 @@ class G15Sensors(g15plugin.G15RefreshingPlugin):
         self._menu = g15theme.Menu("menu")
         g15plugin.G15RefreshingPlugin.populate_page(self)
         
+        # Wait for the first samples, so the sensors are known
+        self.sampler.sample(self.get_next_tick(), True)
         enabled_sensors = []
-        for c in self.sensor_sources:
-            for s in c.get_sensors():                
-                sense_key = "%s/sensors/%s" % (self.gconf_key, gconf.escape_key(s.name, len(s.name)))
-                if g15gconf.get_bool_or_default(self.gconf_client, "%s/enabled" % (sense_key), True):
-                    enabled_sensors.append(s)
+        for s in self.sampler.get_sensors():                
+            sense_key = "%s/sensors/%s" % (self.gconf_key, gconf.escape_key(s.name, len(s.name)))
+            if g15gconf.get_bool_or_default(self.gconf_client, "%s/enabled" % (sense_key), True):
+                enabled_sensors.append(s)
                     
               
         # If there are no sensors enabled, display the 'none' variant
@@ -475,6 +647,7 @@ class G15Sensors(g15plugin.G15RefreshingPlugin):
                     
     
     def deactivate(self):
+        self.sampler.stop()
         for c in self.sensor_sources:
             c.stop()
         g15plugin.G15RefreshingPlugin.deactivate(self)
@@ -482,6 +655,7 @@ class G15Sensors(g15plugin.G15RefreshingPlugin):
             self.gconf_client.notify_remove(self._sensors_changed_handle)
         
     def refresh(self):
+        self.sampler.sample(self.get_next_tick(), fresh_wait = FRESH_WAIT)
         self._get_stats()
     
     def get_next_tick(self):
@@ -540,18 +714,16 @@ class G15Sensors(g15plugin.G15RefreshingPlugin):
             needle.set("transform", "rotate(%f,%f,%f)" % (degr, center_bounds[0], center_bounds[1]) )
         
     def _get_stats(self):
-        for c in self.sensor_sources:
-            for s in c.get_sensors(): 
-                if s.name in self.sensor_dict:
-                    self.sensor_dict[s.name].sensor = s
-                    if s.critical is not None:
-                        logger.debug("Sensor %s on %s is %f (critical %f)",
-                                     s.name,
-                                     c.name,
-                                     s.value,
-                                     s.critical)
-                    else:
-                        logger.debug("Sensor %s on %s is %f", s.name, c.name, s.value)
+        for s in self.sampler.get_sensors(): 
+            if s.name in self.sensor_dict:
+                self.sensor_dict[s.name].sensor = s
+                if s.critical is not None:
+                    logger.debug("Sensor %s is %f (critical %f)",
+                                 s.name,
+                                 s.value,
+                                 s.critical)
+                else:
+                    logger.debug("Sensor %s is %f", s.name, s.value)
                     
     def get_theme_properties(self): 
         properties = g15plugin.G15RefreshingPlugin.get_theme_properties(self) 
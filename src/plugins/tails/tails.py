@@ -26,13 +26,14 @@ import gnome15.g15driver as g15driver
 import gnome15.g15screen as g15screen
 import subprocess
 import time
-import tailer
 import os
+import pyinotify
 import gtk
 import gconf
 import logging
 import xdg.Mime as mime
 from threading import Thread
+from threading import Lock
 logger = logging.getLogger(__name__)
 
 # Plugin details - All of these must be provided
@@ -42,9 +43,7 @@ description = _("Monitor multiple files, updating when they change. Just \
 like the <b>tail</b> command.\n\n\
 \
 Warning: When monitoring large files that grow quickly, this plugin may \
-cause massive memory usage.\n\n\
-Uses the pytailer library (http://code.google.com/p/pytailer/), licensed \
-under the LGPL. See %s and %s for more details." % ( os.path.join(__file__, "LICENSE" ), os.path.join(__file__, "README" ) ) )
+cause massive memory usage.")
 author = "Brett Smith <tanktarta@blueyonder.co.uk>"
 copyright = _("Copyright (C)2011 Brett Smith, Michael Thornton")
 site = "http://www.russo79.com/gnome15"
@@ -175,47 +174,223 @@ class G15TailMenuItem(g15theme.MenuItem):
         subprocess.Popen(['xdg-open', self.file])
         return True
         
-class G15TailThread(Thread):
+# Minimum time between deliveries of new lines to the pages
+TICK = 0.25
+
+# Size of the first block read backwards from the end of a file to find the
+# last lines. This doubles until enough lines are found.
+TAIL_BLOCK = 16384
+
+# Events on the watched directories that mean a followed file may have changed
+WATCH_MASK = pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+             pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_CLOSE_WRITE
+
+def read_tail(fd, lines):
+    """
+    Read the last complete lines of an open file, reading backwards from the 
+    end in large blocks. Returns a tuple of the list of lines, the position 
+    of the end of the file and any trailing partial line.
+    
+    Keyword arguments:
+    fd            -- open file
+    lines         -- maximum number of lines to return
+    """
+    fd.seek(0, os.SEEK_END)
+    end = fd.tell()
+    block = TAIL_BLOCK
+    while True:
+        start = max(0, end - block)
+        fd.seek(start)
+        data = fd.read(end - start)
+        if start == 0 or data.count("\n") > lines:
+            break
+        block *= 2
+    parts = data.split("\n")
+    if start > 0:
+        # The first part is probably not a whole line
+        parts = parts[1:]
+    return parts[:-1][-lines:] if lines > 0 else [], end, parts[-1] if parts else ""
+
+class G15TailFile():
+    """
+    State of a single followed file
+    """
     def __init__(self, page):
-        Thread.__init__(self)
         self.page = page
+        self.path = page.file_path
         self.fd = None
-        self.line_seq = 0
-        self.setDaemon(True)
-        self.setName("Monitor%s" % self.page.file_path)
-        self._stopped = False
+        self.inode = None
+        self.partial = ""
         
-    def stop_monitoring(self):
-        self._stopped = True
+    def open(self, lines):
+        self.close()
+        self.fd = open(self.path, "rb")
+        self.inode = os.fstat(self.fd.fileno()).st_ino
+        tail, position, self.partial = read_tail(self.fd, lines)
+        self.fd.seek(position)
+        return tail
+        
+    def close(self):
         if self.fd is not None:
             self.fd.close()
+            self.fd = None
+            
+    def read(self, lines):
+        """
+        Read everything appended since the last read, returning the new complete
+        lines (at most the given number). Rotation (the path now refers to a 
+        different file) and truncation are detected and handled by starting 
+        again from the start of the new file.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Deleted or moved away, wait for it to come back
+            self.close()
+            return []
+        
+        if self.fd is None or st.st_ino != self.inode:
+            if self.fd is not None:
+                # Rotated, pick up anything written to the old file first
+                new_lines = self._read_appended(lines)
+            else:
+                new_lines = []
+            self.close()
+            self.fd = open(self.path, "rb")
+            self.inode = st.st_ino
+            self.partial = ""
+            return (new_lines + self._read_appended(lines))[-lines:]
+        
+        if st.st_size < self.fd.tell():
+            # Truncated
+            self.fd.seek(0)
+            self.partial = ""
+            
+        return self._read_appended(lines)
+    
+    def _read_appended(self, lines):
+        data = self.fd.read()
+        if not data:
+            return []
+        parts = (self.partial + data).split("\n")
+        self.partial = parts[-1]
+        return parts[:-1][-lines:]
+    
+class G15TailFollower():
+    """
+    Follows all of the files for a set of pages from a single thread. The 
+    directories containing the files are watched with inotify, any appended 
+    data is read in bulk and the new lines for all pages are handed to the
+    redraw thread together, at most once every TICK seconds.
+    """
+    
+    def __init__(self, plugin):
+        self._plugin = plugin
+        self._files = {}
+        self._dirty = set()
+        self._lock = Lock()
+        self._watches = {}
+        self._stopped = False
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._wm, self._process_event, timeout = int(TICK * 1000))
+        self._thread = Thread(target = self._run)
+        self._thread.setDaemon(True)
+        self._thread.setName("TailFollower")
         
-    def run(self):
-        for line in tailer.tail(open(self.page.file_path), self.page.plugin.lines):
-            g15screen.run_on_redraw(self._add_line, line)
-        self.fd = open(self.page.file_path)
+    def start(self):
+        self._thread.start()
+        
+    def stop(self):
+        self._stopped = True
+        self._lock.acquire()
         try:
-            for line in tailer.follow(self.fd):
-                if self._stopped:
-                    break
-                g15screen.run_on_redraw(self._add_line, line)
-                if self._stopped:
-                    break
-        except ValueError as e:
-            logger.debug("Error while reading", exc_info = e)
-            if not self._stopped:
-                raise e
-        self.page.redraw()
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+        finally:
+            self._lock.release()
+        
+    def follow(self, page):
+        """
+        Start following the file for a page, loading its last lines
+        """
+        self.unfollow(page)
+        tail_file = G15TailFile(page)
+        tail = tail_file.open(self._plugin.lines)
+        self._lock.acquire()
+        try:
+            self._files[page.file_path] = tail_file
+            dir_path = os.path.dirname(os.path.abspath(page.file_path))
+            if not dir_path in self._watches:
+                self._watches[dir_path] = self._wm.add_watch(dir_path, WATCH_MASK)
+        finally:
+            self._lock.release()
+        g15screen.run_on_redraw(self._deliver, { page: tail })
+        
+    def unfollow(self, page):
+        self._lock.acquire()
+        try:
+            tail_file = self._files.get(page.file_path)
+            if tail_file is not None and tail_file.page == page:
+                tail_file.close()
+                del self._files[page.file_path]
+                self._dirty.discard(page.file_path)
+        finally:
+            self._lock.release()
             
-    def _add_line(self, line):
-        line = line.strip()
-        if len(line) > 0 and not self._stopped:
-            line  = g15markup.html_escape(line)
-            while self.page._menu.get_child_count() > self.page.plugin.lines:
-                self.page._menu.remove_child_at(0)
-            self.page._menu.add_child(G15TailMenuItem("Line-%d" % self.line_seq, line, self.page.file_path))
-            self.page._menu.select_last_item()
-            self.line_seq += 1
+    """
+    Private
+    """
+    
+    def _process_event(self, event):
+        # Called on the follower thread while processing events
+        if event.pathname in self._files:
+            self._dirty.add(event.pathname)
+    
+    def _run(self):
+        last_delivery = 0
+        while not self._stopped:
+            if self._notifier.check_events():
+                self._notifier.read_events()
+                self._lock.acquire()
+                try:
+                    self._notifier.process_events()
+                finally:
+                    self._lock.release()
+                    
+            now = time.time()
+            if not self._dirty or now - last_delivery < TICK:
+                continue
+            
+            batch = {}
+            self._lock.acquire()
+            try:
+                dirty = self._dirty
+                self._dirty = set()
+                for path in dirty:
+                    tail_file = self._files.get(path)
+                    if tail_file is None:
+                        continue
+                    try:
+                        lines = tail_file.read(self._plugin.lines)
+                    except (IOError, OSError) as e:
+                        logger.debug("Error while reading %s", path, exc_info = e)
+                        tail_file.close()
+                        continue
+                    if lines:
+                        batch[tail_file.page] = lines
+            finally:
+                self._lock.release()
+                
+            last_delivery = now
+            if batch:
+                g15screen.run_on_redraw(self._deliver, batch)
+        self._notifier.stop()
+                
+    def _deliver(self, batch):
+        for page, lines in batch.items():
+            if not self._stopped:
+                page._add_lines(lines)
         
 class G15TailPage(g15theme.G15Page):
     
@@ -228,8 +403,8 @@ class G15TailPage(g15theme.G15Page):
         self._icon_embedded = None
         self.plugin = plugin
         self.file_path = file_path
-        self.thread =  None
         self.index = -1
+        self.line_seq = 0
         self._menu = g15theme.Menu("menu")
         g15theme.G15Page.__init__(self, os.path.basename(file_path), self._screen,
                                      thumbnail_painter=self._paint_thumbnail,
@@ -273,16 +448,35 @@ class G15TailPage(g15theme.G15Page):
         if os.path.exists(self.file_path):
             self._subtitle =  time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(self.file_path)))
             self._message = ""
-            self.thread = G15TailThread(self)
-            self.thread.start()
+            self._menu.remove_all_children()
+            try:
+                self.plugin._follower.follow(self)
+            except (IOError, OSError) as e:
+                logger.warning("Failed to open %s", self.file_path, exc_info = e)
+                self._message = e.strerror if e.strerror else str(e)
         else:
             self._subtitle = ""
             self._message = "File does not exist"
             
     def _stop(self):
-        if self.thread is not None:
-            self.thread.stop_monitoring()
-            self.thread = None
+        self.plugin._follower.unfollow(self)
+        
+    def _add_lines(self, lines):
+        """
+        Add a batch of lines to the menu (on the redraw thread), trimming it to
+        the configured number of lines. The menu is updated, and so redrawn, 
+        once for the whole batch
+        """
+        items = []
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0:
+                items.append(G15TailMenuItem("Line-%d" % self.line_seq, g15markup.html_escape(line), self.file_path))
+                self.line_seq += 1
+        if len(items) == 0:
+            return
+        children = (self._menu.get_children() + items)[-self.plugin.lines:]
+        self._menu.set_children(children, selected = children[-1])
             
     def _get_theme_properties(self):
         properties = {}
@@ -306,6 +500,9 @@ class G15Tails():
 
     def activate(self):
         self._pages = {}       
+        self.lines = g15gconf.get_int_or_default(self._gconf_client, "%s/lines" % self._gconf_key, 10)
+        self._follower = G15TailFollower(self)
+        self._follower.start()
         self._lines_changed_handle = self._gconf_client.notify_add(self._gconf_key + "/lines", self._lines_changed)
         self._files_changed_handle = self._gconf_client.notify_add(self._gconf_key + "/files", self._files_changed)
         self._load_files()
@@ -316,6 +513,7 @@ class G15Tails():
         for page in self._pages:
             self._screen.del_page(self._pages[page])
         self._pages = {}
+        self._follower.stop()
     
     '''
     Private
@@ -41,6 +41,10 @@ except Exception as e:
 import os
 import gtk
 import locale
+import json
+from threading import Thread
+from threading import RLock
+from threading import Event
 
 # Plugin details - All of these must be provided
 id="trafficstats"
@@ -62,6 +66,342 @@ actions={
 # This plugin displays the network traffic stats
 #
 
+# File the interface counters are read from
+PROC_NET_DEV = "/proc/net/dev"
+
+# How often the counters are sampled (seconds)
+SAMPLE_INTERVAL = 2.0
+
+# How often vnstat's database is dumped for a device that is being displayed.
+# vnstat itself only updates it every few minutes
+VNSTAT_INTERVAL = 60.0
+
+# How often the daily and monthly aggregates are written to disk (seconds)
+SAVE_INTERVAL = 300.0
+
+# Number of days and months of aggregates that are kept
+KEEP_DAYS = 62
+KEEP_MONTHS = 24
+
+# Some drivers still expose 32 bit counters, which wrap regularly on busy links
+COUNTER_WRAP = 2 ** 32
+
+def parse_net_dev(text):
+    """
+    Parse the contents of /proc/net/dev, returning a dictionary of
+    ( received bytes, transmitted bytes ) tuples keyed by interface name.
+
+    Keyword arguments:
+    text        -- contents of the file
+    """
+    counters = {}
+    for line in text.split("\n")[2:]:
+        if not ":" in line:
+            continue
+        iface, fields = line.split(":", 1)
+        fields = fields.split()
+        if len(fields) < 9:
+            continue
+        try:
+            counters[iface.strip()] = ( long(fields[0]), long(fields[8]) )
+        except ValueError:
+            logger.debug("Ignoring bad line in %s: %s", PROC_NET_DEV, line)
+    return counters
+
+def parse_vnstat_dump(text):
+    """
+    Parse the output of 'vnstat --dumpdb'. Returns a dictionary of
+    ( unixtime, up bytes, down bytes ) tuples keyed by ( kind, period ),
+    e.g. ( "d", 0 ) for today, containing only the valid entries. None is
+    returned if vnstat has no database for the device.
+
+    Keyword arguments:
+    text        -- output of vnstat
+    """
+    if "Error" in text:
+        return None
+    entries = {}
+    for line in text.split("\n"):
+        line = line.strip().split(";")
+        if len(line) < 8 or not line[0] in ( "d", "m" ) or line[7] != "1":
+            continue
+        try:
+            # 2 = unixtime, 3 = dn MiB, 4 = up MiB, 5 = dn KiB, 6 = up KiB
+            up = long(line[4]) * 1000000 + long(line[6]) * 1000
+            dn = long(line[3]) * 1000000 + long(line[5]) * 1000
+            entries[( line[0], int(line[1]) )] = ( int(line[2]), up, dn )
+        except ValueError:
+            logger.debug("Ignoring bad vnstat line %s", line)
+    return entries
+
+def counter_delta(previous, current):
+    """
+    Get the number of bytes transferred between two readings of a counter,
+    allowing for counters that wrap at 32 bits and interfaces that are reset
+    (in which case the counter starts again from zero).
+
+    Keyword arguments:
+    previous    -- previous reading
+    current     -- current reading
+    """
+    if current >= previous:
+        return current - previous
+    if previous < COUNTER_WRAP and COUNTER_WRAP - previous + current < COUNTER_WRAP / 2:
+        return COUNTER_WRAP - previous + current
+    return current
+
+class G15TrafficSnapshot():
+    """
+    The statistics for one interface at the time of the last sample
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rate_in = 0.0
+        self.rate_out = 0.0
+        self.today = ( 0, 0 )
+        self.month = ( 0, 0 )
+        self.vnstat_dumped = False
+        self.vnstat_status = 0
+        self.vnstat = None
+
+class G15TrafficCollector(Thread):
+    """
+    Samples the interface counters (and, for devices that are displayed with
+    vnstat, vnstat's database) in the background, so building the theme
+    properties is only a matter of reading the last snapshot. Totals and rates
+    are kept in memory, daily and monthly aggregates are also saved to disk.
+    """
+
+    def __init__(self, proc_file = PROC_NET_DEV, store_file = None, sample_interval = SAMPLE_INTERVAL):
+        Thread.__init__(self)
+        self.name = "TrafficCollector"
+        self.setDaemon(True)
+        self.proc_file = proc_file
+        self.store_file = store_file
+        self.sample_interval = sample_interval
+        self._lock = RLock()
+        self._wake = Event()
+        self._stopped = False
+        self._counters = {}
+        self._totals = {}
+        self._rates = {}
+        self._sample_time = None
+        self._days = {}
+        self._months = {}
+        self._dirty = False
+        self._saved = time.time()
+        self._vnstat = {}
+        self._vnstat_wanted = {}
+        self._load()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def snapshot(self, device, use_vnstat = False):
+        """
+        Get a G15TrafficSnapshot for a device. If vnstat statistics are
+        requested the device is dumped on the collector thread from now on,
+        until nobody has asked for it for a while.
+
+        Keyword arguments:
+        device        -- interface name
+        use_vnstat    -- include vnstat's statistics
+        """
+        snapshot = G15TrafficSnapshot(device)
+        self._lock.acquire()
+        try:
+            snapshot.bytes_in, snapshot.bytes_out = self._totals.get(device, ( 0, 0 ))
+            snapshot.rate_in, snapshot.rate_out = self._rates.get(device, ( 0.0, 0.0 ))
+            now = time.localtime()
+            snapshot.today = tuple(self._days.get(time.strftime("%Y-%m-%d", now), {}).get(device, ( 0, 0 )))
+            snapshot.month = tuple(self._months.get(time.strftime("%Y-%m", now), {}).get(device, ( 0, 0 )))
+            if use_vnstat:
+                first = not device in self._vnstat_wanted
+                self._vnstat_wanted[device] = time.time()
+                if device in self._vnstat:
+                    snapshot.vnstat_dumped = True
+                    snapshot.vnstat_status, snapshot.vnstat = self._vnstat[device][1:]
+        finally:
+            self._lock.release()
+        if use_vnstat and first:
+            self._wake.set()
+        return snapshot
+
+    def sample(self, now = None):
+        """
+        Read the counters and update the totals, rates and aggregates.
+
+        Keyword arguments:
+        now        -- time of the sample (defaults to the current time)
+        """
+        if now is None:
+            now = time.time()
+        try:
+            f = open(self.proc_file, "r")
+            try:
+                counters = parse_net_dev(f.read())
+            finally:
+                f.close()
+        except IOError as e:
+            logger.debug("Could not read %s", self.proc_file, exc_info = e)
+            return
+
+        self._lock.acquire()
+        try:
+            elapsed = now - self._sample_time if self._sample_time is not None else 0
+            day = self._days.setdefault(time.strftime("%Y-%m-%d", time.localtime(now)), {})
+            month = self._months.setdefault(time.strftime("%Y-%m", time.localtime(now)), {})
+            rates = {}
+            for iface, ( rx, tx ) in counters.items():
+                previous = self._counters.get(iface)
+                if previous is None:
+                    # Start from the kernel's totals, i.e. since the interface came up
+                    self._totals[iface] = [ rx, tx ]
+                    continue
+                drx = counter_delta(previous[0], rx)
+                dtx = counter_delta(previous[1], tx)
+                totals = self._totals[iface]
+                totals[0] += drx
+                totals[1] += dtx
+                if drx or dtx:
+                    for aggregate in ( day, month ):
+                        a = aggregate.setdefault(iface, [ 0, 0 ])
+                        a[0] += drx
+                        a[1] += dtx
+                    self._dirty = True
+                if elapsed > 0:
+                    rates[iface] = ( drx / elapsed, dtx / elapsed )
+            for iface in self._totals.keys():
+                if not iface in counters:
+                    del self._totals[iface]
+            self._counters = counters
+            self._rates = rates
+            self._sample_time = now
+            self._prune(self._days, KEEP_DAYS)
+            self._prune(self._months, KEEP_MONTHS)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """
+        Write the daily and monthly aggregates to the store file (if any)
+        """
+        if self.store_file is None:
+            return
+        self._lock.acquire()
+        try:
+            data = json.dumps({ "days" : self._days, "months" : self._months }, separators = (",", ":"))
+            self._dirty = False
+            self._saved = time.time()
+        finally:
+            self._lock.release()
+        try:
+            g15os.mkdir_p(os.path.dirname(self.store_file))
+            tmp = "%s.tmp" % self.store_file
+            f = open(tmp, "w")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, self.store_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save traffic statistics to %s", self.store_file, exc_info = e)
+
+    def run(self):
+        while not self._stopped:
+            self._wake.clear()
+            now = time.time()
+            self.sample(now)
+            self._dump_vnstat(now)
+            if self._dirty and now - self._saved >= SAVE_INTERVAL:
+                self.save()
+            self._wake.wait(self.sample_interval)
+        if self._dirty:
+            self.save()
+
+    """
+    Private
+    """
+    def _dump_vnstat(self, now):
+        self._lock.acquire()
+        try:
+            devices = []
+            for device, wanted in self._vnstat_wanted.items():
+                if now - wanted > VNSTAT_INTERVAL * 2:
+                    del self._vnstat_wanted[device]
+                    self._vnstat.pop(device, None)
+                elif not device in self._vnstat or now - self._vnstat[device][0] >= VNSTAT_INTERVAL:
+                    devices.append(device)
+        finally:
+            self._lock.release()
+
+        for device in devices:
+            status, output = g15os.get_command_output("vnstat -i %s --dumpdb" % device)
+            entries = parse_vnstat_dump(output) if status == 0 else None
+            self._lock.acquire()
+            try:
+                self._vnstat[device] = ( now, status, entries )
+            finally:
+                self._lock.release()
+
+    def _prune(self, aggregates, keep):
+        if len(aggregates) > keep:
+            for key in sorted(aggregates.keys())[:-keep]:
+                del aggregates[key]
+
+    def _load(self):
+        if self.store_file is None or not os.path.exists(self.store_file):
+            return
+        try:
+            f = open(self.store_file, "r")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            self._days = data.get("days", {})
+            self._months = data.get("months", {})
+        except (IOError, ValueError) as e:
+            logger.warning("Could not load traffic statistics from %s", self.store_file, exc_info = e)
+
+_collector = None
+_collector_users = 0
+_collector_lock = RLock()
+
+def get_collector():
+    """
+    Get the collector shared by all screens, starting it if required. Each
+    call must be matched by a call to release_collector()
+    """
+    global _collector, _collector_users
+    _collector_lock.acquire()
+    try:
+        if _collector is None:
+            _collector = G15TrafficCollector(store_file = os.path.join(g15globals.user_cache_dir, "trafficstats", "aggregates.json"))
+            _collector.start()
+        _collector_users += 1
+        return _collector
+    finally:
+        _collector_lock.release()
+
+def release_collector():
+    """
+    Release the shared collector, stopping it when it is no longer used
+    """
+    global _collector, _collector_users
+    _collector_lock.acquire()
+    try:
+        _collector_users -= 1
+        if _collector_users <= 0 and _collector is not None:
+            _collector.stop()
+            _collector = None
+            _collector_users = 0
+    finally:
+        _collector_lock.release()
+
 '''
 This function must create your plugin instance. You are provided with
 a GConf client and a Key prefix to use if your plugin has preferences
@@ -120,6 +460,7 @@ class G15TrafficStats(g15plugin.G15RefreshingPlugin):
         you nearly always want to call the function in the supoer class as well
         '''
         self._load_configuration()
+        self.collector = get_collector()
 
         g15plugin.G15RefreshingPlugin.activate(self)
 
@@ -146,6 +487,7 @@ class G15TrafficStats(g15plugin.G15RefreshingPlugin):
     def deactivate(self):
         g15plugin.G15RefreshingPlugin.deactivate(self)
         self.screen.key_handler.action_listeners.remove(self)
+        release_collector()
 
     def action_performed(self, binding):
         if self.page and self.page.is_visible():
@@ -241,67 +583,44 @@ class G15TrafficStats(g15plugin.G15RefreshingPlugin):
                 size = '%.2fb' % bytes
             return size
 
-        # Split vnstat data into array
-        def get_traffic_data(dataType, dataValue, vn):
-            line=''
-            for item in vn.split("\n"):
-                if "%s;%d;" % (dataType, dataValue) in item:
-                    line = item.strip().split(';')
-                    break
-            return line
-
-        # convert MiB and KiB into KB
-        def cb(mib, kib):
-            return (int(mib) * 1000000) + (int(kib) * 1000)
-
         '''
         Get the details to display and place them as properties which are passed to
-        the theme
+        the theme. Everything comes from the collector's last sample, nothing is
+        read or run here
         '''
+        sd = self.collector.snapshot(self.networkdevice, self.use_vnstat)
 
         if self.use_vnstat is False:
             bootup = datetime.datetime.fromtimestamp(int(gtop.uptime().boot_time)).strftime('%d.%m.%y %H:%M')
-            sd = gtop.netload(self.networkdevice)
             properties["sdn"] = "DL: " +convert_bytes(sd.bytes_in)
             properties["sup"] = "UL: " +convert_bytes(sd.bytes_out)
+            properties["rdn"] = convert_bytes(sd.rate_in) + "/s"
+            properties["rup"] = convert_bytes(sd.rate_out) + "/s"
             properties["des1"] = "Traffic since: " +bootup
             properties["title"] = self.networkdevice + " Traffic"
 
+        elif sd.vnstat_status != 0:
+            properties["message"] = "vnstat is not installed!"
+        elif sd.vnstat is None:
+            # Either not dumped yet, or vnstat has no database for the device
+            if sd.vnstat_dumped:
+                properties["message"] = "No stats for device " + self.networkdevice
         else:
-            vnstat, vn = g15os.get_command_output('vnstat -i ' + self.networkdevice + ' --dumpdb')
-            if vnstat != 0:
-                properties["message"] = "vnstat is not installed!"
+            properties["title"] = self.networkdevice +" Traffic (U/D)"
+
+            if self.loadpage == 'vnstat_monthly':
+                k = "m"
+                fmt = '%B'
             else:
-                chErr = str(vn.find("Error"));
-                if chErr != "-1":
-                    properties["message"] = "No stats for device " + self.networkdevice
-                else:
-                    properties["title"] = self.networkdevice +" Traffic (U/D)"
-
-                    def get_data(kind, period):
-                        # get vnstat data as array, array content: 2 = unixtime, 4 = up MiB, 6 = up KiB, 3 = dn MiB, 5 = dn KiB
-                        line = get_traffic_data(kind, period, vn)
-                        if line[7] == '1':
-                            up = convert_bytes(cb(line[4], line[6]))
-                            dn = convert_bytes(cb(line[3], line[5]))
-                            des = int(line[2])
-                            return [up, dn, des]
-                        else:
-                            return None
-
-                    if self.loadpage == 'vnstat_daily':
-                        k = "d"
-                        fmt = '%A'
-                    elif self.loadpage == 'vnstat_monthly':
-                        k = "m"
-                        fmt = '%B'
-
-                    for p in range(0,3):
-                        data = get_data(k,p)
-                        if data is not None:
-                            properties["d"] = "/"
-                            properties["dup" + str(p + 1)] = data[0]
-                            properties["ddn" + str(p + 1)] = data[1]
-                            properties["des" + str(p + 1)] = datetime.datetime.fromtimestamp(data[2]).strftime(fmt)
+                k = "d"
+                fmt = '%A'
+
+            for p in range(0,3):
+                data = sd.vnstat.get((k, p))
+                if data is not None:
+                    properties["d"] = "/"
+                    properties["dup" + str(p + 1)] = convert_bytes(data[1])
+                    properties["ddn" + str(p + 1)] = convert_bytes(data[2])
+                    properties["des" + str(p + 1)] = datetime.datetime.fromtimestamp(data[0]).strftime(fmt)
 
         return properties
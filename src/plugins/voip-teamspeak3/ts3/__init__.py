@@ -14,193 +14,348 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from telnetlib import Telnet
+"""
+Client for the TeamSpeak 3 ClientQuery plugin.
+
+Everything goes over a single connection. ClientQuery answers commands
+strictly in the order they were sent, each reply being terminated by an
+'error' line, so commands may be pipelined and replies are matched to them
+first-in, first-out. Notifications may arrive between replies at any time
+and are handed to the subscriber on a separate dispatch thread, so a handler
+is free to send further commands itself.
+"""
+
 from threading import Thread
 from threading import RLock
+from threading import Event
 from message import MessageFactory
 from message import Command
+import collections
+import socket
+import select
+import errno
+import Queue
 
 # Logging
 import logging
 logger = logging.getLogger(__name__)
 
-def _receive_message(client):
-    while True:
-        incoming_message = client.read_until('\n', 10).strip()
-        if incoming_message is not None and incoming_message.strip():
-            logger.info("Received: %s", incoming_message)
-            message = MessageFactory.get_message(incoming_message)
-            if message:
-                return message
+# Maximum number of bytes read from the socket in one go
+READ_SIZE = 65536
 
 class TS3CommandException(Exception):
-    
+
     def __init__(self, code, message):
         Exception.__init__(self, message)
         self.code = code
 
+class TS3Request():
+    """
+    A command that has been sent and is awaiting its reply. Use wait() to
+    block until the reply arrives, or supply handlers when sending.
+    """
+
+    def __init__(self, command, reply_handler = None, error_handler = None):
+        self.command = command
+        self.reply = None
+        self.error = None
+        self._reply_handler = reply_handler
+        self._error_handler = error_handler
+        self._event = Event()
+
+    def wait(self, timeout = None):
+        """
+        Wait for the reply, returning it or raising the error received instead.
+
+        Keyword arguments:
+        timeout        -- maximum time to wait (in seconds)
+        """
+        if not self._event.wait(timeout):
+            raise TS3CommandException(9998, "Timeout waiting for reply to %s" % self.command.command)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def _add_reply(self, reply):
+        if self.reply is None:
+            self.reply = reply
+        elif self.error is None:
+            self.error = TS3CommandException(9999, "Multiple replies")
+
+    def _complete(self, error = None):
+        if error is not None and self.error is None:
+            self.error = error
+        self._event.set()
+        try:
+            if self.error is not None:
+                if self._error_handler:
+                    self._error_handler(self.error)
+            elif self._reply_handler:
+                self._reply_handler(self.reply)
+        except Exception as e:
+            logger.error("Error in reply handler", exc_info = e)
+
 class TS3():
-    
-    class ReceiveThread(Thread):
-        def __init__(self, client):
-            Thread.__init__(self)
-            self._client = client
-            self.setDaemon(True)
-            self.setName("TS3ReceiveThread")
-            self._reply_handler = None
-            self._error_handler = None
-            self._stop = False
-            
-        def stop(self):
-            self._stop = True
-        def run(self):
-            try:
-                while True:
-                    try:
-                        if self._stop:
-                            raise EOFError()
-                        msg = _receive_message(self._client)
-                    except TS3CommandException as e:
-                        logger.debug("Error while receving message", exc_info = e)
-                        self._error_handler(e)
-                    else:
-                         self._reply_handler(msg)
-            except Exception as e:
-                logger.debug("Error in main loop", exc_info = e)
-                self._error_handler(e)
-    
+
     def __init__(self, hostname="127.0.0.1", port=25639, timeout=10):
         self.timeout = timeout
         self.hostname = hostname
         self.port = port
-        
-        self._event_client = None
+
+        self._socket = None
+        self._receive_thread = None
         self._event_thread = None
-        self._command_client = None
+        self._events = None
+        self._pending = collections.deque()
         self._lock = RLock()
-        
+        self._closed = False
+        self._reply_handler = None
+        self._error_handler = None
+        self._event_type = None
+
         self.schandlerid = None
-        
+
     def change_server(self, schandlerid):
-        if self._event_client is not None:
-            self._write_command(self._event_client, Command(
-                                            'clientnotifyunregister')
-                                      )
-            
+        requests = []
+        if self._event_type is not None:
+            requests.append(self.send_command_async(Command('clientnotifyunregister')))
         self.schandlerid = schandlerid
-        self._send_command(self._command_client, Command(
-                                        'use',
-                                        schandlerid=self.schandlerid)
-                                  )       
-        if self._event_client is not None:    
-            self._send_command(self._event_client, Command(
-                                            'use',
-                                            schandlerid=self.schandlerid)
-                                      )        
-            self._send_command(self._event_client, Command(
-                                            'clientnotifyregister',
-                                            schandlerid=self.schandlerid,
-                                            event=self._event_type
-                                            )
-                                      )
-        
+        requests.append(self.send_command_async(Command('use', schandlerid=self.schandlerid)))
+        if self._event_type is not None:
+            requests.append(self.send_command_async(Command('clientnotifyregister',
+                                                            schandlerid=self.schandlerid,
+                                                            event=self._event_type)))
+        for r in requests:
+            r.wait(self.timeout)
+
     def close(self):
-        if self._event_thread is not None:
-            self._event_thread.stop()
-        self._command_client.close()
-        self._command_client = None
-        if self._event_client is not None:
-            self._event_client.close()
-            self._event_client = None
-    
+        self._lock.acquire()
+        try:
+            self._closed = True
+            if self._socket is not None:
+                try:
+                    self._socket.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self._socket.close()
+                self._socket = None
+        finally:
+            self._lock.release()
+        if self._events is not None:
+            self._events.put(None)
+
     def start(self):
-        self._create_command_client()
-        
-        
-    def send_event_command(self, command):
-        try:   
-            self._lock.acquire()
-            if self._event_client is not None:
-                self._write_command(self._event_client, command)                        
+        self._lock.acquire()
+        try:
+            self._closed = False
+            self._socket = socket.create_connection((self.hostname, self.port), self.timeout)
+            buf = ""
+
+            # Read the greeting up to the 'selected' line, this tells us the
+            # current server connection handler
+            while True:
+                data = self._socket.recv(READ_SIZE)
+                if not data:
+                    raise EOFError()
+                buf += data
+                # ClientQuery ends lines with "\n\r", so all but the first
+                # line start with "\r"
+                lines = buf.split("\n")
+                selected = [ i for i, l in enumerate(lines[:-1]) if l.strip().startswith("selected") ]
+                if selected:
+                    message = MessageFactory.get_message(lines[selected[0]].strip())
+                    self.schandlerid = int(message.args['schandlerid'])
+                    buf = "\n".join(lines[selected[0] + 1:])
+                    break
+
+            self._socket.setblocking(0)
+            self._events = Queue.Queue()
+            self._event_thread = Thread(target = self._dispatch_events, args = (self._events, ))
+            self._event_thread.setDaemon(True)
+            self._event_thread.setName("TS3EventThread")
+            self._event_thread.start()
+            self._receive_thread = Thread(target = self._receive, args = (self._socket, buf))
+            self._receive_thread.setDaemon(True)
+            self._receive_thread.setName("TS3ReceiveThread")
+            self._receive_thread.start()
         finally:
             self._lock.release()
-        
-    def send_command(self, command):  
-        try:   
-            self._lock.acquire()
-            if self._command_client is None:
-                self.start()   
-            return self._send_command(self._command_client, command)                        
+
+    def send_event_command(self, command):
+        """
+        Send a command without waiting for the reply
+        """
+        if self._socket is not None:
+            self.send_command_async(command)
+
+    def send_command(self, command):
+        """
+        Send a command and wait for its reply.
+
+        Keyword arguments:
+        command        -- command to send
+        """
+        if self._socket is None:
+            self.start()
+        return self.send_command_async(command).wait(self.timeout)
+
+    def send_commands(self, commands):
+        """
+        Send several commands in one go, then wait for all of the replies. A
+        list of replies (or exceptions for commands that failed) is returned in
+        the same order as the commands.
+
+        Keyword arguments:
+        commands        -- list of commands to send
+        """
+        if self._socket is None:
+            self.start()
+        requests = self.send_commands_async(commands)
+        replies = []
+        for r in requests:
+            try:
+                replies.append(r.wait(self.timeout))
+            except TS3CommandException as e:
+                replies.append(e)
+        return replies
+
+    def send_command_async(self, command, reply_handler = None, error_handler = None):
+        """
+        Send a command without waiting for the reply. The returned TS3Request
+        may be waited on, or the reply and error handlers will be called
+        (on the receive thread) when the reply arrives.
+
+        Keyword arguments:
+        command        -- command to send
+        reply_handler  -- function called with the reply Message
+        error_handler  -- function called with the TS3CommandException
+        """
+        return self.send_commands_async([ command ], reply_handler, error_handler)[0]
+
+    def send_commands_async(self, commands, reply_handler = None, error_handler = None):
+        """
+        Pipeline several commands with a single write, returning a list of
+        TS3Request objects.
+        """
+        requests = [ TS3Request(c, reply_handler, error_handler) for c in commands ]
+        data = "".join([ "%s\n" % c.output for c in commands ])
+        self._lock.acquire()
+        try:
+            if self._socket is None:
+                raise EOFError()
+            self._pending.extend(requests)
+            for c in commands:
+                logger.debug("Sending command: %s", c.output)
+            self._socket.setblocking(1)
+            try:
+                self._socket.sendall(data)
+            finally:
+                if self._socket is not None:
+                    self._socket.setblocking(0)
         finally:
             self._lock.release()
+        return requests
 
     def subscribe(self, reply_handler, type='any', error_handler = None):
         """
         Shortcut method to subscribe to all messages received from the client.
-        
+
         Keyword arguments:
         reply_handler   -- function called with Message as argument
         error_handler   -- function called with TSCommandException as argument
         type            -- type of event to subscribe to
         """
-        try:
-            self._lock.acquire()
-        
-            if self._event_client is not None:
-                raise Exception("Already subscribed")
-            
-            self._event_type = type
-            self._create_event_client()
-            self._event_thread._reply_handler = reply_handler
-            self._event_thread._error_handler = error_handler
-            self._write_command(self._event_client, Command(
-                                            'clientnotifyregister',
-                                            schandlerid=self.schandlerid,
-                                            event=type
-                                            )
-                                      )
-            
-        finally:
-            self._lock.release()
-                
-            
+        if self._event_type is not None:
+            raise Exception("Already subscribed")
+        self._event_type = type
+        self._reply_handler = reply_handler
+        self._error_handler = error_handler
+        self.send_command(Command('clientnotifyregister',
+                                  schandlerid=self.schandlerid,
+                                  event=type))
+
     """
     Private
     """
-    def _send_command(self, client, command):  
-        try:   
-            self._lock.acquire()
-            self._write_command(client, command)
-            r_reply = None
+    def _receive(self, sock, buf):
+        error = None
+        try:
             while True:
-                reply = _receive_message(client)
-                if reply.command == 'error':
-                    msg = reply.args['msg']
-                    if msg != 'ok':
-                        raise TS3CommandException(int(reply.args['id']), msg)
-                    else:
-                        break
-                else:
-                    if r_reply is None:
-                        r_reply = reply
-                    else:
-                        raise TS3CommandException(9999, "Multiple replies")
-                        
-                    
-            return r_reply
+                if buf:
+                    lines = buf.split("\n")
+                    buf = lines[-1]
+                    for line in lines[:-1]:
+                        self._handle_line(line)
+                r, w, x = select.select([ sock ], [], [ sock ])
+                try:
+                    data = sock.recv(READ_SIZE)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        continue
+                    raise
+                if not data:
+                    raise EOFError()
+                buf += data
+        except Exception as e:
+            if not self._closed:
+                logger.debug("Error in receive loop", exc_info = e)
+            error = e if isinstance(e, EOFError) else EOFError(str(e))
+
+        # Fail anything still waiting for a reply
+        self._lock.acquire()
+        try:
+            pending = list(self._pending)
+            self._pending.clear()
+            if self._socket is sock:
+                self._socket = None
         finally:
             self._lock.release()
-        
-    def _write_command(self, client, command):
-        logger.info("Sending command: %s", command.output)
-        client.write("%s\n" % command.output)
-    
-    def _create_command_client(self):
-        self._command_client = Telnet(host=self.hostname, port=self.port)
-        self.schandlerid = int(_receive_message(self._command_client).args['schandlerid'])
-    
-    def _create_event_client(self):
-        self._event_client = Telnet(host=self.hostname, port=self.port)
-        _receive_message(self._event_client)
-        self._event_thread = self.ReceiveThread(self._event_client)
-        self._event_thread.start()
\ No newline at end of file
+        for r in pending:
+            r._complete(TS3CommandException(9997, "Connection closed"))
+        if not self._closed and self._events is not None:
+            self._events.put(error)
+
+    def _handle_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        message = MessageFactory.get_message(line)
+        if message is None:
+            return
+        command = message.command if not hasattr(message, "responses") else None
+        if command is not None and ( command.startswith("notify") or command == "selected" ):
+            self._events.put(message)
+            return
+
+        self._lock.acquire()
+        try:
+            request = self._pending[0] if self._pending else None
+            if request is not None and command == "error":
+                self._pending.popleft()
+        finally:
+            self._lock.release()
+
+        if request is None:
+            logger.warning("Reply with no command waiting for it. %s", line)
+        elif command == "error":
+            msg = message.args['msg']
+            request._complete(TS3CommandException(int(message.args['id']), msg) if msg != 'ok' else None)
+        else:
+            request._add_reply(message)
+
+    def _dispatch_events(self, events):
+        while True:
+            message = events.get()
+            if message is None:
+                break
+            try:
+                if isinstance(message, Exception):
+                    if self._error_handler:
+                        self._error_handler(message)
+                    break
+                if message.command == "selected":
+                    self.schandlerid = int(message.args['schandlerid'])
+                elif self._reply_handler:
+                    self._reply_handler(message)
+            except Exception as e:
+                logger.error("Error handling event", exc_info = e)
@@ -98,8 +98,16 @@ class Teamspeak3ServerMenuItem(voip.ChannelMenuItem):
         self.activatable = False
         self.radio = False
         self.path = ""
+        self.parent_count = -1
+        self.child_items = []
         
 class Teamspeak3ChannelMenuItem(voip.ChannelMenuItem):
+    """
+    A channel. Channels form a tree, each item holds its parent (a channel, or
+    the server item for top level channels) and its ordered list of direct
+    children. The path and depth are cached and only recalculated after the
+    channel (or one of its parents) is renamed or moved.
+    """
     
     def __init__(self, schandlerid, cid, cpid, name, order, backend):
         voip.ChannelMenuItem.__init__(self, "channel-%s-%d" % (cid, schandlerid), name, backend)
@@ -109,38 +117,55 @@ class Teamspeak3ChannelMenuItem(voip.ChannelMenuItem):
         self.order = order
         self._backend = backend
         self.schandlerid = schandlerid
+        self.parent_item = None
+        self.child_items = []
+        self._path = None
+        self._parent_count = None
 
     @property
     def path(self):
-        result = self.name
-        if self.cpid != 0:
-            parent_item = self.backend._channel_map[self.cpid]
-            result = parent_item.path + "/" + result
-        return result
+        if self._path is None:
+            if self.cpid != 0 and self.parent_item is not None:
+                self._path = self.parent_item.path + "/" + self.name
+            else:
+                self._path = self.name
+        return self._path
 
     @property
     def parent_count(self):
-        result = 0
-        if self.cpid != 0:
-            parent_item = self.backend._channel_map[self.cpid]
-            result = 1 + parent_item.parent_count
-        return result
+        if self._parent_count is None:
+            self._parent_count = 1 + self.parent_item.parent_count if self.parent_item is not None else 0
+        return self._parent_count
 
     @property
     def direct_children(self):
-        return [ child for child in self._backend._channels if type(child) is Teamspeak3ChannelMenuItem and child.cpid == self.cid ]
+        return list(self.child_items)
 
     @property
     def children(self):
         children = []
-        for direct_child in self.direct_children:
-            children.append(direct_child)
-            children.extend(direct_child.children)
+        stack = list(reversed(self.child_items))
+        while stack:
+            child = stack.pop()
+            children.append(child)
+            stack.extend(reversed(child.child_items))
         return children
 
     @property
     def child_count(self):
         return len(self.children)
+    
+    def invalidate_path(self):
+        """
+        Forget the cached path and depth of this channel and all of its 
+        children. Must be called when the name or parent changes.
+        """
+        stack = [ self ]
+        while stack:
+            item = stack.pop()
+            item._path = None
+            item._parent_count = None
+            stack.extend(item.child_items)
 
     def get_theme_properties(self):
         p = voip.ChannelMenuItem.get_theme_properties(self)
@@ -160,7 +185,9 @@ class Teamspeak3Backend(voip.VoipBackend):
         self._buddies = None
         self._buddy_map = {}
         self._channels = None
-        self._channels_map = {}
+        self._channel_map = {}
+        self._servers = None
+        self._server_map = {}
         self._me = None
         self._clid = None
         self._server_uid = None
@@ -186,8 +213,7 @@ class Teamspeak3Backend(voip.VoipBackend):
     
     def get_current_channel(self):
         if self._current_channel is None:
-            if self._channels is None:
-                self.get_channels()
+            channels = self.get_channels()
                 
             reply = self._client.send_command(
                         ts3.Command(
@@ -195,7 +221,7 @@ class Teamspeak3Backend(voip.VoipBackend):
                             ))
             if 'path' in reply.args:
                 channel_path = reply.args['path']
-                for c in self._channels:
+                for c in channels:
                     if c.path == channel_path:
                         self._current_channel = c
             
@@ -214,41 +240,44 @@ class Teamspeak3Backend(voip.VoipBackend):
         return self._buddies
     
     def get_channels(self):
-        if self._channels == None:
+        if self._servers == None:
             self._channel_map = {}
-            self._channels = []
+            self._server_map = {}
+            self._servers = []
 
             reply = self._client.send_command(ts3.Command(
                     'serverconnectionhandlerlist'))
+            schandlerids = [ int(r.args['schandlerid']) for r in ( reply.responses if isinstance(reply, ts3.message.MultipartMessage) else [ reply ] ) ]
             
-            for r in reply.responses if isinstance(reply, ts3.message.MultipartMessage) else [ reply ]:
-                s = int(r.args['schandlerid'])
-                reply = self._client.send_command(ts3.Command(
-                        'use', schandlerid = s))
-
-                # Get the server IP and port
-                try:
-                    reply = self._client.send_command(ts3.Command(
-                            'serverconnectinfo'))
-                    ip = reply.args['ip']
-                    port = int(reply.args['port'])
-     
-                    # A menu item for the server                
-                    item = Teamspeak3ServerMenuItem(s, "%s:%d" % (ip, port), self)
-                    self._channels.append(item)
-                    
-                    reply = self._client.send_command(
-                                ts3.Command(
-                                        'channellist'
-                                    ))
-                    self._parse_channellist_reply(reply, s)
-                except ts3.TS3CommandException as e:
-                    logger.debug("Error when getting channel list", exc_info = e)
+            # Ask for the details of every server connection in one go, then 
+            # switch back to the selected server connection
+            commands = []
+            for s in schandlerids:
+                commands += [ ts3.Command('use', schandlerid = s),
+                              ts3.Command('serverconnectinfo'),
+                              ts3.Command('channellist') ]
+            commands.append(ts3.Command('use', schandlerid = self._client.schandlerid))
+            replies = self._client.send_commands(commands)
+            
+            for i, s in enumerate(schandlerids):
+                connect_info, channel_list = replies[i * 3 + 1:i * 3 + 3]
+                if isinstance(connect_info, ts3.TS3CommandException):
+                    logger.debug("Error when getting channel list", exc_info = connect_info)
+                    continue
+                if isinstance(channel_list, ts3.TS3CommandException):
+                    logger.debug("Error when getting channel list", exc_info = channel_list)
+                    continue
                     
-        
-            # Switch back to the selected server connection
-            reply = self._client.send_command(ts3.Command(
-                    'use', schandlerid = self._client.schandlerid))
+                # A menu item for the server                
+                item = Teamspeak3ServerMenuItem(s, "%s:%d" % (connect_info.args['ip'], int(connect_info.args['port'])), self)
+                self._servers.append(item)
+                self._server_map[s] = item
+                self._parse_channellist_reply(channel_list, item)
+            
+            self._channels = None
+            
+        if self._channels is None:
+            self._channels = self._flatten_channels()
             
         return self._channels
     
@@ -271,8 +300,7 @@ class Teamspeak3Backend(voip.VoipBackend):
         
         # Get initial buddy lists, channel lists and other stuff 
         try:        
-            self._get_clid()
-            self._get_server_uid()
+            self._get_ids()
             self.get_channels()
             self.get_current_channel()
             self.get_buddies()
@@ -412,19 +440,16 @@ class Teamspeak3Backend(voip.VoipBackend):
                                    int(message.args['client_type']),
                                    self._plugin)
         
-    def _get_clid(self):
-        reply = self._client.send_command(ts3.Command(
-            'whoami', virtualserver_unique_identifier=None
-        ))
-        self._clid = int(reply.args['clid'])
+    def _get_ids(self):
+        whoami, servervariable = self._client.send_commands([
+            ts3.Command('whoami', virtualserver_unique_identifier=None),
+            ts3.Command('servervariable', virtualserver_unique_identifier=None) ])
+        for reply in [ whoami, servervariable ]:
+            if isinstance(reply, ts3.TS3CommandException):
+                raise reply
+        self._clid = int(whoami.args['clid'])
         logger.info("Your CLID is %d", self._clid)
-    
-    def _get_server_uid(self):
-        reply = self._client.send_command(ts3.Command(
-            'servervariable', virtualserver_unique_identifier=None
-            
-        ))
-        self._server_uid = reply.args['virtualserver_unique_identifier']
+        self._server_uid = servervariable.args['virtualserver_unique_identifier']
         
     def _do_redraw(self):
         self._plugin.redraw()
@@ -464,16 +489,15 @@ class Teamspeak3Backend(voip.VoipBackend):
             if self._current_channel is not None and item.name == self._current_channel:
                 self._current_channel = None 
             item.name = message.args['channel_name']
+            item.invalidate_path()
             if self._current_channel is None:
                 self.get_current_channel()
 
         # Update the position of the channel in the channel list if it's order has been changed
         if 'channel_order' in message.args:
-            children = self._remove_channel(item)
+            self._remove_channel(item)
             item.order = int(message.args['channel_order'])
             self._insert_channel(item)
-            for child in children:
-                self._insert_channel(child)
 
         self._plugin.channel_updated(item)
         
@@ -491,40 +515,36 @@ class Teamspeak3Backend(voip.VoipBackend):
     def _parse_notifychannelmoved_reply(self, message):
         item = self._channel_map[int(message.args['cid'])]
 
-        children = self._remove_channel(item)
+        self._remove_channel(item)
         item.order = int(message.args['order'])
         item.cpid = int(message.args['cpid'])
+        item.invalidate_path()
         self._insert_channel(item)
-        for child in children:
-            self._insert_channel(child)
 
         self._plugin.channel_moved(item)
+        
+    def _get_parent_item(self, item):
+        return self._server_map[item.schandlerid] if item.cpid == 0 else self._channel_map[item.cpid]
 
     def _remove_channel(self, item):
-        position = self._channels.index(item)
-        children = item.children
-
-        # Update the following item order if necessary
-        try:
-            next_item = self._channels[position + item.child_count + 1]
-            if next_item.cpid == item.cpid:
-                next_item.order = item.order
-        except IndexError as e:
-            logger.debug("Did not found channel to remove", exc_info = e)
-            pass
+        """
+        Remove a channel (and so all of its children) from the tree, returning
+        the children
+        """
+        siblings = item.parent_item.child_items
+        position = siblings.index(item)
+        del siblings[position]
 
-        self._channels.remove(item)
-        for channel in children:
-            self._channels.remove(channel)
+        # The following sibling now comes after our previous sibling
+        if position < len(siblings):
+            siblings[position].order = item.order
 
-        return children
+        item.parent_item = None
+        self._channels = None
+        return item.children
 
     def _find_teamspeak3servermenuitem(self, id):
-        matching_items = [ x for x in self._channels if x.schandlerid == id and type(x) is Teamspeak3ServerMenuItem ]
-        if len(matching_items) > 0:
-            return matching_items[0]
-        else:
-            return None
+        return self._server_map.get(id)
         
     def _parse_notifychannelcreated_reply(self, message):
         item = self._create_channel_item(message, self._client.schandlerid)
@@ -533,27 +553,41 @@ class Teamspeak3Backend(voip.VoipBackend):
         self._plugin.new_channel(item)
 
     def _insert_channel(self, item):
-        # Insert the item at the correct position in the menu
-        if item.cpid == 0 and item.order == 0:
-            # If first channel of server
-            position = self._channels.index(self._find_teamspeak3servermenuitem(item.schandlerid)) + 1
-        elif item.order == 0:
-            # If first sub-channel of a channel
-            position = self._channels.index(self._channel_map[item.cpid]) + 1
-        else:
-            # Other cases
-            future_previous_item = self._channel_map[item.order]
-            position = self._channels.index(future_previous_item) + future_previous_item.child_count + 1
-        self._channels.insert(position, item)
+        """
+        Insert a channel into the tree, after the sibling whose ID is the 
+        channel's order (or first if the order is 0)
+        """
+        parent = self._get_parent_item(item)
+        siblings = parent.child_items
+        position = 0
+        if item.order != 0:
+            for i, sibling in enumerate(siblings):
+                if sibling.cid == item.order:
+                    position = i + 1
+                    break
+        siblings.insert(position, item)
+        item.parent_item = parent
 
         # Update the following item order if necessary
-        try:
-            next_item = self._channels[position + 1]
-            if next_item.cpid == item.cpid:
-                next_item.order = item.cid
-        except IndexError as e:
-            logger.debug("Did not found channel to update", exc_info = e)
-            pass
+        if position + 1 < len(siblings):
+            siblings[position + 1].order = item.cid
+            
+        self._channels = None
+        
+    def _flatten_channels(self):
+        """
+        Build the channel list as shown in TeamSpeak3, each server followed by
+        its channels in tree order
+        """
+        channels = []
+        for server in self._servers:
+            channels.append(server)
+            stack = list(reversed(server.child_items))
+            while stack:
+                item = stack.pop()
+                channels.append(item)
+                stack.extend(reversed(item.child_items))
+        return channels
     
     def _parse_notifyconnectstatuschange_reply(self, message):
         status = message.args['status']
@@ -610,35 +644,34 @@ class Teamspeak3Backend(voip.VoipBackend):
         self._buddies = items    
         self._buddy_map = item_map    
 
-    def _sort_channellist(self, channels):
+    def _parse_channellist_reply(self, message, server_item):
         """
-        Sort the channel list the same way that it's done in TeamSpeak3
+        Build the channel tree for a server. Siblings are ordered by following 
+        the chain of 'channel_order' values, each of which is the ID of the 
+        previous sibling (0 for the first).
         """
-        result = []
-        search_stack = []
-        # Initialize the search stack with the criteria for the first item (always 0,0)
-        search_stack.append((0, 0))
-        while len(channels) > len(result):
-            search_criteria = search_stack.pop()
-            try:
-                item = channels[search_criteria]
-                result.append(item)
-                search_stack.append((item.cpid, item.cid))
-                search_stack.append((item.cid, 0))
-            except KeyError as e:
-                logger.debug("Did not found channels matching search_criteria", exc_info = e)
-                continue
-
-        return result
-
-    def _parse_channellist_reply(self, message, schandlerid):
-        channels = {}
+        by_parent = {}
         for r in message.responses if isinstance(message, ts3.message.MultipartMessage) else [ message ]:
-            item = self._create_channel_item(r, schandlerid)
-            channels[item.cpid, item.order] = item
+            item = self._create_channel_item(r, server_item.schandlerid)
+            by_parent.setdefault(item.cpid, {})[item.order] = item
             self._channel_map[item.cid] = item
 
-        self._channels.extend(self._sort_channellist(channels))
+        for cpid, siblings in by_parent.items():
+            parent = server_item if cpid == 0 else self._channel_map.get(cpid)
+            if parent is None:
+                logger.warning("Channel parent %d not found", cpid)
+                continue
+            order = 0
+            while order in siblings:
+                item = siblings.pop(order)
+                item.parent_item = parent
+                parent.child_items.append(item)
+                order = item.cid
+            if siblings:
+                logger.debug("Channels %s not in order chain, adding at end", str(siblings.values()))
+                for item in siblings.values():
+                    item.parent_item = parent
+                    parent.child_items.append(item)
 
     def _parse_notifyclientupdated(self, message):
         item = self._buddy_map[int(message.args['clid'])]
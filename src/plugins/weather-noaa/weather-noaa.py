@@ -80,9 +80,12 @@ class NOAAWeatherBackend(weather.WeatherBackend):
     def __init__(self, gconf_client, gconf_key):
         weather.WeatherBackend.__init__(self, gconf_client, gconf_key)
     
+    def get_location_key(self):
+        return self._get_station_id()
+    
     def get_weather_data(self):
-        station_id = g15gconf.get_string_or_default(self.gconf_client, "%s/station_id" % self.gconf_key, "KPEO")
-        p = pywapi.get_weather_from_noaa(station_id)
+        station_id = self._get_station_id()
+        p = pywapi.get_weather_from_noaa(station_id, self.open_url)
         
         tm = email.utils.parsedate_tz(p["observation_time_rfc822"])[:9]
         data = {
@@ -102,6 +105,9 @@ class NOAAWeatherBackend(weather.WeatherBackend):
                 
         return data
     
+    def _get_station_id(self):
+        return g15gconf.get_string_or_default(self.gconf_client, "%s/station_id" % self.gconf_key, "KPEO")
+    
     def _get_icon(self, icon):
         night = False
         icon_name = icon
@@ -150,6 +150,9 @@ class YahooWeatherBackend(weather.WeatherBackend):
     def __init__(self, gconf_client, gconf_key):
         weather.WeatherBackend.__init__(self, gconf_client, gconf_key)
         
+    def get_location_key(self):
+        return self._get_location_id()
+        
     def get_weather_data(self):
         return self._do_get_weather_data_xml()
     
@@ -165,7 +168,7 @@ class YahooWeatherBackend(weather.WeatherBackend):
         handler.close()
         
     def _do_get_weather_data_xml(self):
-        location_id = g15gconf.get_string_or_default(self.gconf_client, "%s/location_id" % self.gconf_key, "2487956")
+        location_id = self._get_location_id()
         p = self._get_weather_from_yahoo(location_id)
         if p is None:
             return None
@@ -187,15 +190,7 @@ class YahooWeatherBackend(weather.WeatherBackend):
             logger.debug("Error parsing date, trying alternative method.", exc_info = v)
             import email.utils
             dxt = email.utils.parsedate_tz(condition_el["date"])
-            class TZ(datetime.tzinfo):
-                def dst(self, dt):
-                    return datetime.timedelta(0)
-                
-                def tzname(self, dt):
-                    return dxt[9]
-                
-                def utcoffset(self, dt): return datetime.timedelta(seconds=dxt[9])
-            observed_datetime = datetime.datetime(*dxt[:7],  tzinfo=TZ())
+            observed_datetime = datetime.datetime(*dxt[:7],  tzinfo=weather.FixedOffsetTimezone(dxt[9], dxt[9]))
         
         # Forecasts (we only get 2 from yahoo)
         forecasts_el = p["forecasts"]
@@ -265,6 +260,9 @@ class YahooWeatherBackend(weather.WeatherBackend):
                 
         return data
     
+    def _get_location_id(self):
+        return g15gconf.get_string_or_default(self.gconf_client, "%s/location_id" % self.gconf_key, "2487956")
+    
     def _translate_icon(self, code):
         
         theme_icon = None
@@ -339,7 +337,7 @@ class YahooWeatherBackend(weather.WeatherBackend):
         else:
             unit = 'f'
         url = YAHOO_WEATHER_URL % (location_id, unit)
-        handler = urllib2.urlopen(url)
+        handler = self.open_url(url)
         dom = minidom.parse(handler)    
         handler.close()
             
@@ -227,7 +227,7 @@ def get_weather_from_yahoo(location_id, units = 'metric'):
 
     
     
-def get_weather_from_noaa(station_id):
+def get_weather_from_noaa(station_id, urlopen = urllib2.urlopen):
     """
     Fetches weather report from NOAA: National Oceanic and Atmospheric Administration (United States)
 
@@ -242,6 +242,8 @@ def get_weather_from_noaa(station_id):
 
     Other way to get the station ID: use this library: http://code.google.com/p/python-weather/ and 'Weather.location2station' function.
 
+    urlopen: function used to open the URL
+
     Returns:
     weather_data: a dictionary of weather data that exists in XML feed. 
 
@@ -249,7 +251,7 @@ def get_weather_from_noaa(station_id):
     """
     station_id = quote(station_id)
     url = NOAA_WEATHER_URL % (station_id)
-    handler = urllib2.urlopen(url)
+    handler = urlopen(url)
     dom = minidom.parse(handler)    
     handler.close()
         
@@ -26,6 +26,7 @@ import gnome15.util.g15pythonlang as g15pythonlang
 import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15cairo as g15cairo
 import gnome15.util.g15icontools as g15icontools
+import gnome15.util.g15os as g15os
 import gnome15.g15driver as g15driver
 import gnome15.g15globals as g15globals
 import gnome15.g15text as g15text
@@ -36,6 +37,12 @@ import pango
 import logging
 import time
 import sys
+import datetime
+import hashlib
+import cPickle
+import urllib2
+from threading import Lock
+from threading import Event
 logger = logging.getLogger(__name__)
 
 
@@ -64,6 +71,12 @@ KELVIN=2
 
 DEFAULT_UPDATE_INTERVAL = 60 # minutes
 
+# Where observations are kept between runs
+CACHE_DIR = os.path.join(g15globals.user_cache_dir, "weather")
+
+# How long to wait before trying again when an observation could not be fetched
+RETRY_INTERVAL = 300.0
+
 def create(gconf_key, gconf_client, screen):
     return G15Weather(gconf_key, gconf_client, screen)
 
@@ -200,15 +213,249 @@ class WeatherData():
     
     def __init__(self, location):
         self.location = location
+        
+class FixedOffsetTimezone(datetime.tzinfo):
+    """
+    Timezone with a fixed offset from UTC. Backends should use this rather
+    than defining their own, so observations may be stored in the cache
+    """
+    
+    def __init__(self, offset, name):
+        self._offset = offset
+        self._name = name
+        
+    def __getinitargs__(self):
+        return ( self._offset, self._name )
+        
+    def dst(self, dt):
+        return datetime.timedelta(0)
+    
+    def tzname(self, dt):
+        return self._name
+    
+    def utcoffset(self, dt):
+        return datetime.timedelta(seconds = self._offset)
+        
+class WeatherNotModified(Exception):
+    """
+    Raised by a backend when the server says the observation has not changed
+    since it was last fetched
+    """
+    pass
     
 class WeatherBackend():
     
     def __init__(self, gconf_client, gconf_key):
         self.gconf_client = gconf_client
         self.gconf_key = gconf_key
+        self.etag = None
+        self.last_modified = None
     
     def get_weather_data(self):
         raise Exception("Not implemented")
+    
+    def get_location_key(self):
+        """
+        Get a string that uniquely identifies the location the backend is
+        configured for. Observations are cached using this key, backends
+        that return None are not cached.
+        """
+        return None
+    
+    def open_url(self, url):
+        """
+        Open a URL, sending the validators of the cached observation (if any)
+        so the server can tell us if it has not changed. WeatherNotModified is 
+        raised if that is the case, otherwise the validators are updated from
+        the response and the response is returned.
+        
+        Keyword arguments:
+        url            -- URL to open
+        """
+        request = urllib2.Request(url)
+        if self.etag:
+            request.add_header("If-None-Match", self.etag)
+        if self.last_modified:
+            request.add_header("If-Modified-Since", self.last_modified)
+        try:
+            handler = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                raise WeatherNotModified()
+            raise
+        info = handler.info()
+        self.etag = info.getheader("ETag")
+        self.last_modified = info.getheader("Last-Modified")
+        return handler
+    
+class WeatherObservation():
+    """
+    The weather data fetched for one location from one backend, along with 
+    when it expires and the validators used to check if it has changed. Theme
+    properties built from the data are kept with the observation, so they are
+    only built once for each combination of options, however many screens
+    display it.
+    """
+    
+    def __init__(self, data, expires, etag = None, last_modified = None):
+        self.data = data
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self._properties = {}
+        
+    def is_fresh(self):
+        return time.time() < self.expires
+    
+    def get_properties(self, options):
+        return self._properties.get(options)
+    
+    def set_properties(self, options, properties):
+        self._properties[options] = properties
+        
+    def __getstate__(self):
+        # Built properties contain surfaces, so are not stored
+        state = dict(self.__dict__)
+        state["_properties"] = {}
+        return state
+        
+class WeatherObservationCache():
+    """
+    Process wide cache of observations, keyed by backend type and location.
+    Observations are stored on disk so they survive restarts, and only one
+    fetch for any key is ever in progress at a time. Any other caller asking
+    for the same observation waits for that fetch to finish rather than
+    starting another.
+    """
+    
+    def __init__(self, cache_dir = CACHE_DIR):
+        self._cache_dir = cache_dir
+        self._observations = {}
+        self._pending = {}
+        self._lock = Lock()
+        
+    def get(self, backend_type, backend, ttl):
+        """
+        Get the observation for the location a backend is configured for,
+        fetching it if it has expired. If the fetch fails, the last 
+        observation is returned if there is one, otherwise the error is raised.
+        
+        Keyword arguments:
+        backend_type        -- backend type (e.g. noaa)
+        backend             -- backend instance
+        ttl                 -- how long (in seconds) a new observation is valid for
+        """
+        location_key = backend.get_location_key()
+        if location_key is None:
+            return WeatherObservation(backend.get_weather_data(), time.time() + ttl)
+        key = ( backend_type, location_key )
+        
+        self._lock.acquire()
+        try:
+            observation = self._observations.get(key)
+            if observation is None:
+                observation = self._load(key)
+                if observation is not None:
+                    self._observations[key] = observation
+            if observation is not None and observation.is_fresh():
+                return observation
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = [ Event(), None ]
+                fetch = True
+            else:
+                fetch = False
+        finally:
+            self._lock.release()
+            
+        if not fetch:
+            logger.debug("Waiting for fetch of %s already in progress", str(key))
+            pending[0].wait()
+            if pending[1] is not None:
+                raise pending[1]
+            return self._observations[key]
+        
+        try:
+            if observation is not None:
+                backend.etag = observation.etag
+                backend.last_modified = observation.last_modified
+            try:
+                data = backend.get_weather_data()
+                observation = WeatherObservation(data, time.time() + ttl, backend.etag, backend.last_modified)
+                logger.info("Fetched new weather observation for %s", str(key))
+            except WeatherNotModified:
+                logger.info("Weather observation for %s not modified", str(key))
+                observation.expires = time.time() + ttl
+            except Exception as e:
+                if observation is None:
+                    raise
+                logger.warning("Failed to fetch weather for %s, using last observation", str(key), exc_info = e)
+                observation.expires = time.time() + min(ttl, RETRY_INTERVAL)
+            self._lock.acquire()
+            try:
+                self._observations[key] = observation
+            finally:
+                self._lock.release()
+            self._save(key, observation)
+            return observation
+        except Exception as e:
+            pending[1] = e
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._pending[key]
+            finally:
+                self._lock.release()
+            pending[0].set()
+            
+    """
+    Private
+    """
+    def _get_path(self, key):
+        return os.path.join(self._cache_dir, "%s.pickle" % hashlib.md5(repr(key)).hexdigest())
+        
+    def _load(self, key):
+        path = self._get_path(key)
+        if os.path.exists(path):
+            try:
+                f = open(path, "rb")
+                try:
+                    return cPickle.load(f)
+                finally:
+                    f.close()
+            except Exception as e:
+                logger.debug("Could not load cached weather observation %s", path, exc_info = e)
+        
+    def _save(self, key, observation):
+        path = self._get_path(key)
+        try:
+            g15os.mkdir_p(self._cache_dir)
+            tmp_path = "%s.tmp" % path
+            f = open(tmp_path, "wb")
+            try:
+                cPickle.dump(observation, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except Exception as e:
+            logger.debug("Could not save weather observation %s", path, exc_info = e)
+            
+_observation_cache = None
+_observation_cache_lock = Lock()
+
+def get_observation_cache():
+    """
+    Get the observation cache shared by all screens
+    """
+    global _observation_cache
+    _observation_cache_lock.acquire()
+    try:
+        if _observation_cache is None:
+            _observation_cache = WeatherObservationCache()
+        return _observation_cache
+    finally:
+        _observation_cache_lock.release()
 
 class G15Weather(g15plugin.G15RefreshingPlugin):
     
@@ -241,10 +488,22 @@ class G15Weather(g15plugin.G15RefreshingPlugin):
             backend_type = g15gconf.get_string_or_default(self.gconf_client, "%s/source" % self.gconf_key, None)
             if backend_type:
                 backend = get_backend(backend_type).create_backend(self.gconf_client, "%s/%s" % (self.gconf_key, backend_type) )
-                self._weather = backend.get_weather_data()
+                observation = get_observation_cache().get(backend_type, backend, self.refresh_interval)
+                self._weather = observation.data
+                
+                # Properties only need building once per observation for each set of options
+                options = ( self.gconf_client.get_int(self.gconf_key + "/units"),
+                            g15gconf.get_bool_or_default(self.gconf_client, "%s/twenty_four_hour_times" % self.gconf_key, True),
+                            g15gconf.get_bool_or_default(self.gconf_client, "%s/use_theme_icons" % self.gconf_key, True) )
+                built = observation.get_properties(options)
+                if built is None:
+                    built = self._build_properties()
+                    observation.set_properties(options, built)
+                self._page_properties = dict(built[0])
+                self._page_attributes = dict(built[1])
             else:
                 self._weather = None
-            self._page_properties, self._page_attributes = self._build_properties()
+                self._page_properties, self._page_attributes = self._build_properties()
         except Exception as e:
             logger.debug("Error while refreshing", exc_info = e)
             self._weather = None
@@ -17,14 +17,28 @@
 from receivers import G19Receiver
 
 import sys
+import errno
 import threading
 import time
 import usb
 from PIL import Image as Img
 import logging
 import array
+import collections
 logger = logging.getLogger(__name__)
 
+# How long each key endpoint read waits for data before checking whether it
+# should stop (in milliseconds)
+KEY_READ_TIMEOUT = 500
+
+def is_timeout(e):
+    '''Returns whether a USBError is just a read timing out.'''
+    return e.message == "Connection timed out" or getattr(e, "errno", None) == errno.ETIMEDOUT
+
+# Maximum number of frames waiting to be written. When full, the oldest frame
+# is dropped
+MAX_QUEUED_FRAMES = 2
+
 class G19(object):
     '''Simple access to Logitech G19 features.
 
@@ -41,7 +55,18 @@ class G19(object):
         self.__usbDevice = G19UsbController(resetOnStart, enable_mm_keys, reset_wait)
         self.__usbDeviceMutex = threading.Lock()
         self.__keyReceiver = G19Receiver(self)
-        self.__threadDisplay = None
+        self.__keyReaders = []
+        self.__keyThreads = []
+        self.on_frame_error = None
+        self.on_read_error = None
+        
+        self.__frames = collections.deque()
+        self.__framesCondition = threading.Condition()
+        self.__writingFrames = True
+        self.__threadFrames = threading.Thread(target=self.__write_frames)
+        self.__threadFrames.name = "FrameThread"
+        self.__threadFrames.setDaemon(True)
+        self.__threadFrames.start()
         
         self.__frame_content = [0x10, 0x0F, 0x00, 0x58, 0x02, 0x00, 0x00, 0x00,
                  0x00, 0x00, 0x00, 0x3F, 0x01, 0xEF, 0x00, 0x0F]
@@ -123,63 +148,60 @@ class G19(object):
         '''
         self.send_frame(self.convert_image_to_frame(filename))
 
-    def read_g_and_m_keys(self, maxLen=20):
+    def read_g_and_m_keys(self, maxLen=20, timeout=10):
         '''Reads interrupt data from G, M and light switch keys.
 
-        @return maxLen Maximum number of bytes to read.
-        @return Read data or empty list.
+        Reads do not take the device lock, so a read waiting for a key press
+        never holds up frames or control messages.
+
+        @param maxLen Maximum number of bytes to read.
+        @param timeout Time to wait for data (in milliseconds).
+        @return Read data or empty list if the read timed out.
+        @raise usb.USBError on any other error.
 
         '''
-        self.__usbDeviceMutex.acquire()
         val = []
         try:
             val = list(self.__usbDevice.handleIf1.interruptRead(
-                0x83, maxLen, 10))
+                0x83, maxLen, timeout))
         except usb.USBError as e:
-            if e.message != "Connection timed out":
-                logger.debug("Error reading g and m keys", exc_info = e)
-            pass
-        finally:
-            self.__usbDeviceMutex.release()
+            if not is_timeout(e):
+                raise
         return val
 
-    def read_display_menu_keys(self):
+    def read_display_menu_keys(self, timeout=10):
         '''Reads interrupt data from display keys.
 
-        @return Read data or empty list.
+        @param timeout Time to wait for data (in milliseconds).
+        @return Read data or empty list if the read timed out.
+        @raise usb.USBError on any other error.
 
         '''
-        self.__usbDeviceMutex.acquire()
         val = []
         try:
-            val = list(self.__usbDevice.handleIf0.interruptRead(0x81, 2, 10))
+            val = list(self.__usbDevice.handleIf0.interruptRead(0x81, 2, timeout))
         except usb.USBError as e:
-            if e.message != "Connection timed out":
-                logger.debug("Error reading display menu keys", exc_info = e)
-            pass
-        finally:
-            self.__usbDeviceMutex.release()
+            if not is_timeout(e):
+                raise
         return val
 
-    def read_multimedia_keys(self):
+    def read_multimedia_keys(self, timeout=10):
         '''Reads interrupt data from multimedia keys.
 
-        @return Read data or empty list.
+        @param timeout Time to wait for data (in milliseconds).
+        @return Read data or empty list if the read timed out.
+        @raise usb.USBError on any other error.
 
         '''
         if not self.enable_mm_keys:
             return False
         
-        self.__usbDeviceMutex.acquire()
         val = []
         try:
-            val = list(self.__usbDevice.handleIfMM.interruptRead(0x82, 2, 10))
+            val = list(self.__usbDevice.handleIfMM.interruptRead(0x82, 2, timeout))
         except usb.USBError as e:
-            if e.message != "Connection timed out":
-                logger.debug("Error reading multimedia keys", exc_info = e)
-            pass
-        finally:
-            self.__usbDeviceMutex.release()
+            if not is_timeout(e):
+                raise
         return val
 
     def reset(self):
@@ -206,7 +228,12 @@ class G19(object):
             self.__usbDeviceMutex.release()
 
     def send_frame(self, data):
-        '''Sends a frame to display.
+        '''Queues a frame to be sent to the display.
+
+        This returns immediately, the frame is written by a separate thread.
+        At most MAX_QUEUED_FRAMES frames wait to be written, if more arrive
+        the oldest are dropped. Write errors are passed to on_frame_error (if
+        set) on the writing thread.
 
         @param data 320x240x2 bytes, containing the frame in little-endian
         16bit highcolor (5-6-5) format.
@@ -218,14 +245,42 @@ class G19(object):
         if len(data) != (320 * 240 * 2):
             raise ValueError("illegal frame size: " + str(len(data))
                     + " should be 320x240x2=" + str(320 * 240 * 2))
-        frame = list(self.__frame_content)
-        frame += data
-
-        self.__usbDeviceMutex.acquire()
+        self.__framesCondition.acquire()
         try:
-            self.__usbDevice.handleIf0.bulkWrite(2, frame, self.__write_timeout)
+            while len(self.__frames) >= MAX_QUEUED_FRAMES:
+                self.__frames.popleft()
+            self.__frames.append(data)
+            self.__framesCondition.notify()
         finally:
-            self.__usbDeviceMutex.release()
+            self.__framesCondition.release()
+
+    def __write_frames(self):
+        while True:
+            self.__framesCondition.acquire()
+            try:
+                while self.__writingFrames and len(self.__frames) == 0:
+                    self.__framesCondition.wait()
+                if not self.__writingFrames:
+                    break
+                data = self.__frames.popleft()
+            finally:
+                self.__framesCondition.release()
+                
+            frame = list(self.__frame_content)
+            frame += data
+            error = None
+            self.__usbDeviceMutex.acquire()
+            try:
+                self.__usbDevice.handleIf0.bulkWrite(2, frame, self.__write_timeout)
+            except usb.USBError as e:
+                error = e
+            finally:
+                self.__usbDeviceMutex.release()
+            if error is not None:
+                if self.on_frame_error:
+                    self.on_frame_error(error)
+                else:
+                    logger.debug("Failed to send frame.", exc_info = error)
 
     def set_bg_color(self, r, g, b):
         '''Sets backlight to given color.'''
@@ -276,12 +331,14 @@ class G19(object):
 
         '''
         self.stop_event_handling()
-        self.__threadDisplay = threading.Thread(
-                target=self.__keyReceiver.run)
-        self.__keyReceiver.start()
-        self.__threadDisplay.name = "EventThread"
-        self.__threadDisplay.setDaemon(True)
-        self.__threadDisplay.start()
+        self.__keyReaders = self.__keyReceiver.create_readers(KEY_READ_TIMEOUT, self.__read_error)
+        for reader in self.__keyReaders:
+            reader.start()
+            thread = threading.Thread(target=reader.run)
+            thread.name = "EventThread-%s" % reader.name
+            thread.setDaemon(True)
+            thread.start()
+            self.__keyThreads.append(thread)
 
     def stop_event_handling(self):
         '''Stops event processing (aka keyboard driver).
@@ -289,14 +346,31 @@ class G19(object):
         This method is NOT thread-safe.
 
         '''
-        self.__keyReceiver.stop()
-        if self.__threadDisplay:
-            self.__threadDisplay.join()
-            self.__threadDisplay = None
+        for reader in self.__keyReaders:
+            reader.stop()
+        for thread in self.__keyThreads:
+            thread.join()
+        self.__keyReaders = []
+        self.__keyThreads = []
+
+    def __read_error(self, error):
+        # Called on the reader thread, which has stopped itself
+        if self.on_read_error:
+            self.on_read_error(error)
+        else:
+            logger.warning("Failed to read keys, key events stopped.", exc_info = error)
 
     def close(self):
         logger.info("Closing G19")
         self.stop_event_handling()
+        self.__framesCondition.acquire()
+        try:
+            self.__writingFrames = False
+            self.__framesCondition.notify()
+        finally:
+            self.__framesCondition.release()
+        if threading.current_thread() != self.__threadFrames:
+            self.__threadFrames.join()
         self.__usbDevice.close()
 
 
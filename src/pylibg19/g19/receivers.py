@@ -22,6 +22,9 @@ import time
 import logging
 logger = logging.getLogger(__name__)
 
+# Time a reader waits before trying again after an error, if nothing handles it
+ERROR_BACKOFF = 1.0
+
 class InputProcessor(object):
     '''Object to process key presses.'''
 
@@ -236,14 +239,18 @@ class State(object):
         return InputEvent(oldState, newState, keysDown, keysUp)
 
 
-class G19Receiver(Runnable):
-    '''This receiver consumes all data sent by special keys.'''
+class G19Receiver(object):
+    '''Consumes all data sent by special keys. Each interrupt endpoint is read
+    by its own G19EndpointReader, which hands packets over as soon as they
+    arrive.
+
+    '''
 
     def __init__(self, g19):
-        Runnable.__init__(self)
         self.__g19 = g19
         self.__ips = []
         self.__mutex = threading.Lock()
+        self.__stateMutex = threading.Lock()
         self.__state = State()
 
     def add_input_processor(self, processor):
@@ -253,49 +260,53 @@ class G19Receiver(Runnable):
         self.__mutex.release()
         pass
 
-    def execute(self):
-        gotData = False
-        processors = self.list_all_input_processors()
-
-        if self.__g19.enable_mm_keys:
-            data = self.__g19.read_multimedia_keys()        
-            if data:
-                logger.debug('MM keys data %s', len(data))
-                evt = self.__state.packet_received_mm(data)
-                if evt:
-                    for proc in processors:
-                        if proc.process_input(evt):
-                            break
-                else:
-                    logger.info('MM keys ignored')
-                gotData = True
-
-        data = self.__g19.read_g_and_m_keys()
-        if data:
-            logger.debug('G/M keys data %s', len(data))
-            evt = self.__state.packet_received_g_and_m(data)
-            if evt:
-                for proc in processors:
-                    if proc.process_input(evt):
-                        break
-            else:
-                logger.info('G/M keys ignored')
-            gotData = True
+    def create_readers(self, timeout, on_error = None):
+        '''Creates a reader for each of the key endpoints in use.
+
+        @param timeout Time each read waits for data (in milliseconds).
+        @param on_error Function called with the exception if a read fails.
+        @return List of G19EndpointReader.
 
-        data = self.__g19.read_display_menu_keys()
-        if data:
-            logger.debug('Menu keys Data %s', len(data))
-            evt = self.__state.packet_received_d(data)
+        '''
+        g19 = self.__g19
+        readers = [ G19EndpointReader("GKeys",
+                                      lambda: g19.read_g_and_m_keys(timeout = timeout),
+                                      self.g_and_m_keys_received, on_error),
+                    G19EndpointReader("MenuKeys",
+                                      lambda: g19.read_display_menu_keys(timeout = timeout),
+                                      self.display_menu_keys_received, on_error) ]
+        if g19.enable_mm_keys:
+            readers.append(G19EndpointReader("MMKeys",
+                                             lambda: g19.read_multimedia_keys(timeout = timeout),
+                                             self.multimedia_keys_received, on_error))
+        return readers
+
+    def multimedia_keys_received(self, data):
+        logger.debug('MM keys data %s', len(data))
+        self.__dispatch(self.__state.packet_received_mm, data, 'MM keys ignored')
+
+    def g_and_m_keys_received(self, data):
+        logger.debug('G/M keys data %s', len(data))
+        self.__dispatch(self.__state.packet_received_g_and_m, data, 'G/M keys ignored')
+
+    def display_menu_keys_received(self, data):
+        logger.debug('Menu keys Data %s', len(data))
+        self.__dispatch(self.__state.packet_received_d, data, 'Menu keys ignored')
+
+    def __dispatch(self, packet_received, data, ignored_message):
+        # Packets from different endpoints arrive on different threads, but
+        # the key state they update is shared
+        self.__stateMutex.acquire()
+        try:
+            evt = packet_received(data)
             if evt:
-                for proc in processors:
+                for proc in self.list_all_input_processors():
                     if proc.process_input(evt):
-                        break 
+                        break
             else:
-                logger.info('Menu keys ignored')
-            gotData = True
-
-        if not gotData:
-            time.sleep(0.05)
+                logger.info(ignored_message)
+        finally:
+            self.__stateMutex.release()
 
     def list_all_input_processors(self):
         '''Returns a list of all input processors currently registered to this
@@ -309,3 +320,47 @@ class G19Receiver(Runnable):
         allProcessors = list(self.__ips)
         self.__mutex.release()
         return allProcessors
+
+
+class G19EndpointReader(Runnable):
+    '''Waits for data on a single interrupt endpoint, passing each packet to
+    a callback as soon as it arrives.
+
+    '''
+
+    def __init__(self, name, read, callback, on_error = None):
+        '''Creates a reader.
+
+        @param name Name of the endpoint (used for the thread name).
+        @param read Function that waits for and returns the next packet, or an
+        empty list if none arrived.
+        @param callback Function called with each packet.
+        @param on_error Function called with the exception if a read fails.
+        The reader stops after calling it. Without it, the reader waits
+        ERROR_BACKOFF seconds and tries again.
+
+        '''
+        Runnable.__init__(self)
+        self.name = name
+        self.__read = read
+        self.__callback = callback
+        self.__on_error = on_error
+
+    def execute(self):
+        try:
+            data = self.__read()
+        except Exception as e:
+            if self.is_about_to_stop():
+                return
+            if self.__on_error:
+                self.stop()
+                self.__on_error(e)
+            else:
+                logger.debug("Error reading %s", self.name, exc_info = e)
+                time.sleep(ERROR_BACKOFF)
+            return
+        if data and not self.is_about_to_stop():
+            try:
+                self.__callback(data)
+            except ValueError as e:
+                logger.warning("Invalid key packet on %s", self.name, exc_info = e)